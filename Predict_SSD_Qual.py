@@ -1,9 +1,14 @@
 import numpy as np
 import pandas as pd
 import streamlit as st
-import joblib
 import json
 import ipaddress
+from scoring import score
+from model_store import load_backend, load_model
+import metrics
+from artifacts import source_digest
+from hierarchy import load_hierarchy, load_locations
+from vocab import load_vocabularies
 
 # Description
 st.markdown("""
@@ -57,7 +62,7 @@ pages = {
 }
 
 # Load the pre-trained model
-model = joblib.load('model/Supermodel API Pre-Ping.pkl')
+model = load_model()
 
 # Function to numerize IP address
 def numerize_ip(ip_address):
@@ -77,40 +82,52 @@ def get_time_category(hour):
 # Title of the app
 st.title("Structured Data Prediction")
 
-# Cache the data loading function
+# Cache the data loading function, keyed on the workbook so a new xlsx rebuilds the vocabularies
 @st.cache_data
-def load_data():
-    df =  pd.read_excel('data/Processed Linkout ML Propensity Data V8.xlsx')
-    as_description_list = df['AS Description'].unique().tolist()
-    country_list = df['country'].unique().tolist()
-    state_list = df['state'].unique().tolist()
-    city_list = df['city'].unique().tolist()
-    isp_list = df['isp'].unique().tolist()
-    source_list = df['source'].unique().tolist()
-    subid_list = df['subid'].unique().tolist()
-    connection_type_list = df['connection_type'].unique().tolist()
-    coreg_path_list = df['coreg_path'].unique().tolist()
-    return df, as_description_list, country_list, state_list, city_list, isp_list, source_list, subid_list, connection_type_list, coreg_path_list
+def load_data(digest):
+    vocabularies = load_vocabularies()
+    # State, city, subid and AS Description options come from the cascade below
+    country_list = vocabularies['country']
+    isp_list = vocabularies['isp']
+    source_list = vocabularies['source']
+    connection_type_list = vocabularies['connection_type']
+    coreg_path_list = vocabularies['coreg_path']
+    return country_list, isp_list, source_list, connection_type_list, coreg_path_list
+
+# Parent -> child options and city locations; cache_resource hands out the same dicts without copying them
+@st.cache_resource
+def load_cascade(digest):
+    return load_hierarchy(), load_locations()
 
 # Load the data
-df, as_description_list, country_list, state_list, city_list, isp_list, source_list, subid_list, connection_type_list, coreg_path_list = load_data()
+# The digest keys both caches, so a changed workbook is picked up without restarting the app
+digest = source_digest()
+country_list, isp_list, source_list, connection_type_list, coreg_path_list = load_data(digest)
+hierarchy, locations = load_cascade(digest)
+
+# Used when a state + city has no recorded location
+DEFAULT_LOCATION = {'postalcode': 33603, 'Latitude (generated)': 27.9478, 'Longitude (generated)': -82.4584}
+
+# Cascading selectors sit outside the form so each choice narrows the options of the next
+country = st.selectbox("Country", options=country_list)
+state = st.selectbox("State", options=hierarchy['state'].get(country, []))
+city = st.selectbox("City", options=hierarchy['city'].get(state, []))
+source = st.selectbox("Source", options=source_list)
+subid = st.selectbox("Sub ID", options=hierarchy['subid'].get(source, []))
+isp = st.selectbox("ISP", options=isp_list)
+as_description = st.selectbox("AS Description", options=hierarchy['AS Description'].get(isp, []))
+location = locations.get((state, city), DEFAULT_LOCATION)
 
 # Form for input
 with st.form(key='input_form'):
-    as_description = st.selectbox("AS Description", options=as_description_list)
-    country = st.selectbox("Country", options=country_list)
-    state = st.selectbox("State", options=state_list)
-    city = st.selectbox("City", options=city_list)
-    postalcode = st.number_input("Postal Code", value=33603)
+    # Keyed on the city so a new city refills its postal code and coordinates
+    postalcode = st.number_input("Postal Code", value=location['postalcode'], key=f"postalcode-{state}-{city}")
     connection_type = st.selectbox("Connection Type", options=connection_type_list)
     coreg_path = st.selectbox("Coreg Path", options=coreg_path_list)
-    isp = st.selectbox("ISP", options=isp_list)
     male_female = st.radio("Gender", options=["Male", "Female"], index=0)
-    source = st.selectbox("Source", options=source_list)
-    subid = st.selectbox("Sub ID", options=subid_list)
     age = st.number_input("Age", value=62)
-    latitude = st.number_input("Latitude (generated)", value=27.9478)
-    longitude = st.number_input("Longitude (generated)", value=-82.4584)
+    latitude = st.number_input("Latitude (generated)", value=location['Latitude (generated)'], key=f"latitude-{state}-{city}")
+    longitude = st.number_input("Longitude (generated)", value=location['Longitude (generated)'], key=f"longitude-{state}-{city}")
     hour = st.number_input("Hour", value=22, min_value=0, max_value=23)
     ip_address = st.text_input("IP Address", value="35.138.16.9")
 
@@ -118,7 +135,8 @@ with st.form(key='input_form'):
     state_city = f"{state} - {city}"
     source_subid = f"{source} - {subid}"
     time_category = get_time_category(hour)
-    ip_address_numerized = numerize_ip(ip_address)
+    with metrics.timer('numerize_ip'):
+        ip_address_numerized = numerize_ip(ip_address)
 
     st.write(f"State + City: {state_city}")
     st.write(f"Source + Sub Id: {source_subid}")
@@ -154,30 +172,36 @@ if submit_button:
     }
 
     # Convert the input data to a DataFrame
-    df = pd.DataFrame([input_data])
+    with metrics.timer('dataframe'):
+        df = pd.DataFrame([input_data])
 
-    # Make prediction
-    predictions = model.predict(df)
-    predict_proba = model.predict_proba(df)
-
-    # Simplify the predict_proba output and get the probability score of class 1
-    simplified_proba = [proba[pred] for pred, proba in zip(predictions, predict_proba)]
-    probability_score_of_1 = [proba[1] for proba in predict_proba]
-    
-    # Transform probability score to 0 or 1 based on the threshold 0.5
-    transformed_proba = [1 if score >= 0.5 else 0 for score in probability_score_of_1]
+    # Make prediction with a single pass through the ensemble
+    scores = score(model, df)
 
     # Prepare the response
     response = {
-        'predictions': predictions.tolist(),
-        'simplified_proba': simplified_proba,
-        'probability_score_of_1': probability_score_of_1,
-        'transformed_proba': transformed_proba
+        'predictions': scores['predictions'].tolist(),
+        'simplified_proba': scores['simplified_proba'].tolist(),
+        'probability_score_of_1': scores['probability_score_of_1'].tolist(),
+        'transformed_proba': scores['transformed_proba'].tolist()
     }
 
-    final_response = predict_proba[:, 1].tolist()
+    final_response = response['probability_score_of_1']
     
     # Display final results
     st.write("## Probability Score:")
     st.write(f"### The probability score of the SSD being qualified is: {final_response[0]}")
-    
+
+    # Per-feature contributions to the log-odds, relative to an average training lead
+    with st.expander("Why this score?"):
+        contributions, base_value = load_backend('numpy').explain(df)
+        explanation = pd.DataFrame({
+            'feature': load_backend('numpy').feature_names,
+            'contribution': contributions[0],
+        }).sort_values('contribution', key=np.abs, ascending=False)
+        st.write(f"Base log-odds: {base_value:.4f}")
+        st.dataframe(explanation, hide_index=True)
+
+# Per-stage timings and batch sizes collected in this process
+with st.expander("Scoring metrics"):
+    st.code(metrics.render(), language="text")
@@ -0,0 +1,574 @@
+import argparse
+import hmac
+import os
+from contextlib import asynccontextmanager
+
+import msgspec
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, Response
+
+import metrics
+from audit import AuditSink
+from drift import DriftMonitor, load_drift_baseline, load_score_baseline
+from encoding import load_encoder
+from features import build_features
+from ip_index import fill_network_fields, fill_record_network_fields, load_ip_index
+from microbatch import MicroBatcher
+from model_store import backend_path, load_backend, model_stats
+from registry import ModelManager, write_pointer
+from sharding import ShardedScorer
+from score_cache import ScoreCache, cache_key, frame_keys
+from schema import (decode_items, decode_record, decode_table, merge_results, merge_results_arrow, read_record_table,
+                    record_to_dict, split_batch)
+from scoring import THRESHOLD, decide, score
+from utils import FEATURE_COLUMNS, build_input_data
+
+# Standalone scoring service for the endpoints documented in pages/🔥_API_Demo.py
+#
+#   python api.py --workers 4 --port 8000
+#
+# Every worker process loads the model once and warms it up before /ready
+# starts answering 200, so a load balancer only routes pings to hot workers.
+# The model arrays are memory-mapped, so workers share them through the page cache.
+# New model versions are published to the registry (registry.py) and swapped in
+# by each worker in the background, without a restart.
+
+MODEL_PATH = os.environ.get('MODEL_PATH', 'model/Supermodel API Pre-Ping.pkl')
+# 'sklearn' runs the pickled VotingClassifier, 'numpy' the extracted soft vote in fast_model.py
+# and 'onnx' the export from onnx_model.py through onnxruntime
+SCORING_BACKEND = os.environ.get('SCORING_BACKEND', 'sklearn')
+WARMUP_ROUNDS = int(os.environ.get('WARMUP_ROUNDS', '20'))
+# Score cache for repeated leads, SCORE_CACHE_SIZE=0 turns it off
+SCORE_CACHE_SIZE = int(os.environ.get('SCORE_CACHE_SIZE', '100000'))
+SCORE_CACHE_TTL = float(os.environ.get('SCORE_CACHE_TTL', '3600'))
+# Integer-code the categorical columns of /predicts batches against the training vocabularies
+ENCODE_CATEGORIES = os.environ.get('ENCODE_CATEGORIES', '1') == '1'
+# Fill missing AS Description, isp and connection_type from the IP range index
+ENRICH_FROM_IP = os.environ.get('ENRICH_FROM_IP', '1') == '1'
+# Coalesce concurrent /predict calls into one model call (MICROBATCH_MAX_SIZE, MICROBATCH_MAX_DELAY_MS)
+MICROBATCH = os.environ.get('MICROBATCH', '1') == '1'
+# Split /predicts bodies over SHARD_SIZE records across SHARD_WORKERS threads or processes (SHARD_MODE)
+SHARDING = os.environ.get('SHARDING', '1') == '1'
+# Compare scored traffic with the V8 baseline in fixed-size sketches, reported at /admin/drift
+DRIFT_MONITOR = os.environ.get('DRIFT_MONITOR', '1') == '1'
+# Log every scored lead to rotating Arrow files in AUDIT_DIR for replays (audit.py)
+AUDIT_LOG = os.environ.get('AUDIT_LOG', '0') == '1'
+# Required in the X-Admin-Token header of /admin calls; without it every /admin call is refused
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+
+ARROW_STREAM_TYPE = 'application/vnd.apache.arrow.stream'
+PARQUET_TYPES = ('application/vnd.apache.parquet', 'application/x-parquet')
+
+# Record used to warm up the model, taken from the API documentation
+SAMPLE_RECORD = {
+    "Timestamp": "2024-05-13 00:00:00",
+    "AS Description": "ATT-INTERNET4",
+    "country": "US",
+    "state": "FL",
+    "city": "FORT LAUDERDALE",
+    "postalcode": 33325,
+    "connection_type": "Cable/DSL",
+    "coreg_path": "3",
+    "isp": "AT&T Internet",
+    "Male/Female": 0,
+    "source": "whatifmedia-linkout",
+    "subid": "2027",
+    "Age": 62,
+    "Latitude (generated)": 26.1223,
+    "Longitude (generated)": -80.1434,
+    "IP Address": "99.73.70.54"
+}
+
+# Per-worker state, filled in during startup
+state = {'encoder': None, 'ip_index': None, 'drift': None, 'ready': False}
+score_cache = ScoreCache(SCORE_CACHE_SIZE, SCORE_CACHE_TTL) if SCORE_CACHE_SIZE > 0 else None
+if score_cache is not None:
+    metrics.register_gauges('score_cache', score_cache.stats)
+# Contributions of repeated feature rows, for explain=true
+explanation_cache = ScoreCache(SCORE_CACHE_SIZE, SCORE_CACHE_TTL) if SCORE_CACHE_SIZE > 0 else None
+if explanation_cache is not None:
+    metrics.register_gauges('explanation_cache', explanation_cache.stats)
+
+
+# Function to build the model input, skipping the DataFrame for backends that take records
+def model_input(model, all_input_data):
+    if getattr(model, 'accepts_records', False):
+        return all_input_data
+    return pd.DataFrame(all_input_data)
+
+
+# Function to build the warm-up input of a model from the sample record
+def warm_up_input(model):
+    return model_input(model, [build_input_data(SAMPLE_RECORD)])
+
+
+# Function to load the score baseline of a newly loaded model, off the request path
+# A model whose baseline cannot be built is still served, its scores are just not monitored
+def prepare_slot(slot):
+    if not DRIFT_MONITOR:
+        return
+    try:
+        slot['score_baseline'] = load_score_baseline(slot['path'])
+    except Exception as e:
+        metrics.count_error(f'drift_{type(e).__name__}')
+        slot['score_baseline'] = None
+
+
+# Active and shadow models of this worker, loaded and swapped in the background (see registry.py)
+manager = ModelManager(SCORING_BACKEND, warm_up_input, fallback_path=MODEL_PATH, prepare=prepare_slot)
+
+# Scored leads are buffered and written in the background, see audit.py
+auditor = AuditSink() if AUDIT_LOG else None
+if auditor is not None:
+    metrics.register_gauges('audit', auditor.stats)
+
+# Large /predicts bodies are scored in parallel shards, see sharding.py
+sharder = ShardedScorer(backend=SCORING_BACKEND) if SHARDING else None
+
+
+# Function to get the active model slot, dropping cached scores when a new version was swapped in
+# and measuring score drift against that version's baseline
+def current_slot():
+    slot = manager.active
+    if score_cache is not None:
+        score_cache.validate(slot['signature'])
+    if explanation_cache is not None:
+        explanation_cache.validate(slot['signature'])
+    drift = state['drift']
+    if drift is not None and drift.score_model != slot['signature']:
+        drift.set_score_baseline(slot.get('score_baseline'), slot['signature'])
+    return slot
+
+
+# Function to name the version of a model slot for the audit log, the pickle name for the fallback model
+def slot_version(slot):
+    return slot['version'] or os.path.basename(slot['path'])
+
+
+# Function to run a few predictions so the first real request is not the slow one
+def warm_up(model, rounds=WARMUP_ROUNDS):
+    df = warm_up_input(model)
+    for _ in range(rounds):
+        model.predict_proba(df)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Load the active model once per worker; later versions are loaded by the registry watcher
+    manager.start()
+    if ENCODE_CATEGORIES:
+        state['encoder'] = load_encoder()
+    if ENRICH_FROM_IP:
+        state['ip_index'] = load_ip_index()
+    if DRIFT_MONITOR:
+        # The score baseline comes from the active slot, see current_slot
+        state['drift'] = DriftMonitor(load_drift_baseline())
+        metrics.register_gauges('drift', state['drift'].gauges)
+    model = current_slot()['model']
+    warm_up(model)
+    if auditor is not None:
+        auditor.start()
+    state['ready'] = True
+    yield
+    state['ready'] = False
+    if batcher is not None:
+        await batcher.stop()
+    if sharder is not None:
+        sharder.shutdown()
+    manager.stop()
+    if auditor is not None:
+        auditor.stop()
+
+
+app = FastAPI(title="Propensity Model API", lifespan=lifespan)
+
+
+# Function to turn a bad record into the documented error response
+def error_response(e):
+    metrics.count_error(type(e).__name__)
+    if isinstance(e, KeyError):
+        message = f"Missing required field: {e.args[0]}"
+    else:
+        message = f"An error occurred: {e}"
+    return JSONResponse(status_code=400, content={'error': message})
+
+
+# Function to answer a failure of the service itself, e.g. in the model or the micro-batcher
+def server_error_response(e):
+    metrics.count_error(type(e).__name__)
+    return JSONResponse(status_code=500, content={'error': 'Internal server error'})
+
+
+@app.get("/health")
+def health():
+    return {'status': 'ok'}
+
+
+@app.get("/ready")
+def ready():
+    if not state['ready']:
+        return JSONResponse(status_code=503, content={'status': 'warming up'})
+    return {
+        'status': 'ready',
+        'backend': SCORING_BACKEND,
+        'version': manager.active['version'],
+        'model': model_stats(backend_path(SCORING_BACKEND, manager.active['path'])),
+        'cache': score_cache.stats() if score_cache is not None else None,
+    }
+
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+# Function to run a handler in the worker thread under the sampled profiler
+def profiled_call(name, fn, *args):
+    with metrics.profiled(name):
+        return fn(*args)
+
+
+# Function to score a /predicts body in parallel shards and reassemble the results in input order
+def score_sharded(items):
+    slot = current_slot()
+    # Shards scored in worker processes cannot reach this process's drift monitor or audit writer,
+    # so the frames come back and are recorded here
+    with_frames = state['drift'] is not None or auditor is not None
+    results = sharder.map(items, slot, state['encoder'], state['ip_index'], with_frames)
+    index = np.concatenate([shard_index for shard_index, _, _, _ in results])
+    scores = [value for _, shard_scores, _, _ in results for value in shard_scores]
+    errors = [entry for _, _, shard_errors, _ in results for entry in shard_errors]
+    if errors:
+        metrics.increment('scoring_invalid_records_total', len(errors))
+    for _, shard_scores, _, frames in results:
+        if frames is None:
+            continue
+        raw, df = frames
+        if state['drift'] is not None:
+            with metrics.timer('drift'):
+                state['drift'].update(df, shard_scores, raw)
+        if auditor is not None:
+            auditor.record_frame(raw, df, slot_version(slot), shard_scores)
+    return merge_results(len(items), index, scores, errors)
+
+
+# Function to score a /predicts body; bad records get error entries and the rest are still scored
+def score_batch(body, explain=False, decision=False):
+    try:
+        with metrics.timer('decode'):
+            items = split_batch(body)
+    except (msgspec.DecodeError, msgspec.ValidationError) as e:
+        return error_response(e)
+    if sharder is not None and sharder.enabled(len(items)) and not explain and not decision:
+        return score_sharded(items)
+
+    with metrics.timer('decode'):
+        raw, index, errors = decode_items(items)
+    size = len(items)
+    if errors:
+        metrics.increment('scoring_invalid_records_total', len(errors))
+    if len(raw) == 0:
+        return merge_results(size, index, [], errors)
+
+    if state['ip_index'] is not None:
+        raw = fill_network_fields(raw, state['ip_index'])
+    df = build_features(raw, state['encoder'])
+    slot = current_slot()
+    keys = None
+    if score_cache is not None or explanation_cache is not None:
+        with metrics.timer('cache_keys'):
+            keys = frame_keys(df)
+    if decision:
+        # Decisions carry no score, so they are not added to the drift monitor or the audit log
+        return merge_results(size, index, decide_frame(slot, df, keys), errors)
+    scores = score_frame(slot, df, keys)
+    if state['drift'] is not None:
+        with metrics.timer('drift'):
+            state['drift'].update(df, scores, raw)
+    if auditor is not None:
+        auditor.record_frame(raw, df, slot_version(slot), scores)
+    if not explain:
+        return merge_results(size, index, scores, errors)
+    # Nested per-record dicts are much faster to encode with msgspec than with FastAPI's encoder
+    results = merge_results(size, index, with_explanations(slot, df, scores, keys), errors)
+    return Response(msgspec.json.encode(results), media_type='application/json')
+
+
+# Function to score a feature DataFrame, sending only the rows missing from the score cache to the model
+def score_frame(slot, df, keys):
+    if score_cache is None:
+        scores = score(slot['model'], df)['probability_score_of_1']
+        manager.maybe_shadow(df, scores)
+        return scores.tolist()
+
+    with metrics.timer('cache_lookup'):
+        scores, missing = score_cache.get_many(keys)
+    if missing:
+        missed_df = df.iloc[missing]
+        missed_scores = score(slot['model'], missed_df)['probability_score_of_1']
+        manager.maybe_shadow(missed_df, missed_scores)
+        # Scores of a model swapped out meanwhile are not cached
+        cacheable = manager.active is slot
+        for i, missed_score in zip(missing, missed_scores.tolist()):
+            scores[i] = missed_score
+            if cacheable:
+                score_cache.put(keys[i], missed_score)
+    return scores
+
+
+# Function to score an Arrow IPC stream or Parquet body of records, answering with an Arrow IPC stream
+# of probability_score and error columns (one row per record, the error set where the score is null)
+def score_table(body, body_format):
+    try:
+        with metrics.timer('decode'):
+            table, cast_errors = read_record_table(body, body_format)
+            raw, index, errors = decode_table(table, cast_errors)
+    except (pa.ArrowException, KeyError, ValueError) as e:
+        return error_response(e)
+    if errors:
+        metrics.increment('scoring_invalid_records_total', len(errors))
+
+    scores = []
+    if len(raw):
+        if state['ip_index'] is not None:
+            raw = fill_network_fields(raw, state['ip_index'])
+        df = build_features(raw, state['encoder'])
+        slot = current_slot()
+        keys = None
+        if score_cache is not None:
+            with metrics.timer('cache_keys'):
+                keys = frame_keys(df)
+        scores = score_frame(slot, df, keys)
+        if state['drift'] is not None:
+            with metrics.timer('drift'):
+                state['drift'].update(df, scores, raw)
+        if auditor is not None:
+            auditor.record_frame(raw, df, slot_version(slot), scores)
+
+    sink = pa.BufferOutputStream()
+    results = merge_results_arrow(len(table), index, scores, errors)
+    with pa.ipc.new_stream(sink, results.schema) as writer:
+        writer.write_table(results)
+    return Response(sink.getvalue().to_pybytes(), media_type=ARROW_STREAM_TYPE)
+
+
+# Function to get the 0/1 decisions of a feature DataFrame, from the score cache where it has the score
+def decide_frame(slot, df, keys):
+    decisions = np.zeros(len(df), dtype=int)
+    missing = list(range(len(df)))
+    if score_cache is not None:
+        with metrics.timer('cache_lookup'):
+            scores, missing = score_cache.get_many(keys)
+        for i, cached in enumerate(scores):
+            if cached is not None:
+                decisions[i] = cached >= THRESHOLD
+    if missing:
+        decisions[missing], _ = decide(slot['model'], df.iloc[missing])
+    return decisions.tolist()
+
+
+# Function to add per-feature log-odds contributions to the scores of a feature DataFrame
+def with_explanations(slot, df, scores, keys=None):
+    # The contributions come from the linear tables of fast_model.py, whatever backend scores
+    explainer = load_backend('numpy', slot['path'])
+    order = [explainer.feature_names.index(column) for column in FEATURE_COLUMNS]
+
+    with metrics.timer('explain'):
+        if explanation_cache is None:
+            keys = None
+        elif keys is None:
+            keys = frame_keys(df)
+        if keys is not None:
+            rows, missing = explanation_cache.get_many(keys)
+        else:
+            rows, missing = [None] * len(df), list(range(len(df)))
+        if missing:
+            contributions, base_value = explainer.explain(df.iloc[missing])
+            for i, row in zip(missing, contributions[:, order].tolist()):
+                rows[i] = (base_value, row)
+                if keys is not None and manager.active is slot:
+                    explanation_cache.put(keys[i], rows[i])
+
+    return [
+        {'probability_score': probability_score, 'base_value': base_value,
+         'contributions': dict(zip(FEATURE_COLUMNS, row))}
+        for probability_score, (base_value, row) in zip(scores, rows)
+    ]
+
+
+# Function to decode a /predict body into its raw and feature dictionaries, or an error response
+def prepare_one(body):
+    try:
+        with metrics.timer('decode'):
+            data = record_to_dict(decode_record(body))
+        if state['ip_index'] is not None:
+            data = fill_record_network_fields(data, state['ip_index'])
+        with metrics.timer('build_input_data'):
+            return data, build_input_data(data)
+    except (msgspec.DecodeError, msgspec.ValidationError, ValueError) as e:
+        return error_response(e)
+
+
+# Function to score a list of feature dictionaries with one model call
+def score_inputs(all_input_data):
+    slot = current_slot()
+    with metrics.timer('dataframe'):
+        df = model_input(slot['model'], all_input_data)
+    scores = score(slot['model'], df)['probability_score_of_1']
+    manager.maybe_shadow(df, scores)
+    scores = scores.tolist()
+    if score_cache is not None and manager.active is slot:
+        for input_data, probability_score in zip(all_input_data, scores):
+            score_cache.put(cache_key(input_data), probability_score)
+    return scores
+
+
+# Function to look up a feature dictionary in the score cache
+def cached_score(input_data):
+    if score_cache is None:
+        return None
+    current_slot()
+    return score_cache.get(cache_key(input_data))
+
+
+# Function to hand a scored record to the audit log and the drift monitor, returning True when
+# the drift buffer is due to be flushed
+def record_scored(data, input_data, probability_score):
+    if auditor is not None:
+        auditor.record(data, input_data, slot_version(manager.active), probability_score)
+    return state['drift'] is not None and state['drift'].record(input_data, probability_score)
+
+
+# Function to score a /predict body on its own
+def score_one(body, explain=False, decision=False):
+    prepared = prepare_one(body)
+    if isinstance(prepared, JSONResponse):
+        return prepared
+    data, input_data = prepared
+    probability_score = cached_score(input_data)
+    if decision:
+        if probability_score is not None:
+            return int(probability_score >= THRESHOLD)
+        model = current_slot()['model']
+        return int(decide(model, model_input(model, [input_data]))[0][0])
+    if probability_score is None:
+        probability_score = score_inputs([input_data])[0]
+    if record_scored(data, input_data, probability_score):
+        state['drift'].flush()
+    if explain:
+        return with_explanations(current_slot(), pd.DataFrame([input_data]), [probability_score])[0]
+    return probability_score
+
+
+# Concurrent /predict calls are scored together, see microbatch.py
+batcher = MicroBatcher(lambda items: profiled_call('predict', score_inputs, items)) if MICROBATCH else None
+
+
+# explain=true returns {probability_score, base_value, contributions} per record instead of the score,
+# decision=true only the 0/1 decision at THRESHOLD, evaluating identical ensemble members once (see scoring.decide)
+@app.post("/predicts")
+async def predicts(request: Request, explain: bool = False, decision: bool = False):
+    with metrics.timer('request_predicts'):
+        if explain and decision:
+            return error_response(ValueError("explain and decision cannot be combined"))
+        body = await request.body()
+        return await run_in_threadpool(profiled_call, 'predicts', score_batch, body, explain, decision)
+
+
+# Bulk upload of an Arrow IPC stream, or Parquet with format=parquet or a Parquet Content-Type
+@app.post("/predicts/arrow")
+async def predicts_arrow(request: Request, format: str | None = None):
+    with metrics.timer('request_predicts_arrow'):
+        if format is None:
+            content_type = request.headers.get('content-type', '').split(';')[0].strip()
+            format = 'parquet' if content_type in PARQUET_TYPES else 'arrow'
+        body = await request.body()
+        return await run_in_threadpool(profiled_call, 'predicts_arrow', score_table, body, format)
+
+
+@app.post("/predict")
+async def predict(request: Request, explain: bool = False, decision: bool = False):
+    with metrics.timer('request_predict'):
+        if explain and decision:
+            return error_response(ValueError("explain and decision cannot be combined"))
+        body = await request.body()
+        if batcher is None or explain or decision:
+            return await run_in_threadpool(profiled_call, 'predict', score_one, body, explain, decision)
+
+        # Decoding takes microseconds, so it stays on the event loop and only the model call is batched
+        prepared = prepare_one(body)
+        if isinstance(prepared, JSONResponse):
+            return prepared
+        data, input_data = prepared
+        probability_score = cached_score(input_data)
+        if probability_score is None:
+            # The record was validated by prepare_one, so anything failing here is on the service side
+            try:
+                probability_score = await batcher.submit(input_data)
+            except Exception as e:
+                return server_error_response(e)
+        if record_scored(data, input_data, probability_score):
+            await run_in_threadpool(state['drift'].flush)
+        return probability_score
+
+
+# Function to reject admin calls without the configured token, and every admin call when none is configured
+def admin_denied(request):
+    if not ADMIN_TOKEN or not hmac.compare_digest(request.headers.get('X-Admin-Token', '').encode(), ADMIN_TOKEN.encode()):
+        return JSONResponse(status_code=403, content={'error': 'Forbidden'})
+    return None
+
+
+@app.get("/admin/models")
+def admin_models(request: Request):
+    return admin_denied(request) or manager.describe()
+
+
+# Drift of the recent traffic against the V8 baseline, see drift.py
+@app.get("/admin/drift")
+def admin_drift(request: Request, top: int = 10):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    if state['drift'] is None:
+        return JSONResponse(status_code=404, content={'error': 'Drift monitoring is turned off'})
+    return state['drift'].report(top)
+
+
+# Points the registry at a version; every worker loads and swaps it in the background
+@app.post("/admin/models/{version}/activate")
+def admin_activate(version: str, request: Request):
+    return admin_pointer(request, 'CURRENT', version)
+
+
+# Shadow-scores a version on SHADOW_SAMPLE_RATE of the traffic, 'none' stops shadowing
+@app.post("/admin/models/{version}/shadow")
+def admin_shadow(version: str, request: Request):
+    return admin_pointer(request, 'SHADOW', None if version == 'none' else version)
+
+
+def admin_pointer(request, name, version):
+    denied = admin_denied(request)
+    if denied is not None:
+        return denied
+    try:
+        write_pointer(name, version, manager.registry_dir)
+    except ValueError as e:
+        return JSONResponse(status_code=404, content={'error': str(e)})
+    manager.wake()
+    return JSONResponse(status_code=202, content=manager.describe())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the propensity scoring service")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    uvicorn.run('api:app', host=args.host, port=args.port, workers=args.workers)
@@ -0,0 +1,113 @@
+import hashlib
+import os
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Small Parquet artifacts precomputed from the training workbook
+#
+#   python artifacts.py
+#
+# Each artifact records the SHA-256 of the workbook it was built from and is
+# rebuilt on load whenever the workbook changes, so the app never has to parse
+# the xlsx on a warm start.
+
+DATA_PATH = 'data/Processed Linkout ML Propensity Data V8.xlsx'
+ARTIFACT_DIR = 'data/artifacts'
+
+
+# Digests already computed, keyed by path, modification time and size
+_digests = {}
+
+
+# Function to fingerprint the source workbook; the file is only hashed again when its mtime or size changes
+def source_digest(source=DATA_PATH):
+    stat = os.stat(source)
+    key = (os.path.abspath(source), stat.st_mtime_ns, stat.st_size)
+    cached = _digests.get(key)
+    if cached is not None:
+        return cached
+    digest = hashlib.sha256()
+    with open(source, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    _digests[key] = digest.hexdigest()
+    return _digests[key]
+
+
+# Function to read the source workbook
+def read_source(source=DATA_PATH):
+    return pd.read_excel(source)
+
+
+# Function to get the path of a named artifact
+def artifact_path(name):
+    return os.path.join(ARTIFACT_DIR, f'{name}.parquet')
+
+
+# Function to write an artifact atomically, tagged with the source digest
+def write_artifact(name, table, digest):
+    metadata = dict(table.schema.metadata or {})
+    metadata[b'source_sha256'] = digest.encode()
+    table = table.replace_schema_metadata(metadata)
+
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    path = artifact_path(name)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+# Function to load an artifact, rebuilding it when the workbook has changed
+def load_artifact(name, build, source=DATA_PATH, df=None):
+    digest = source_digest(source)
+    path = artifact_path(name)
+    if os.path.exists(path):
+        metadata = pq.read_schema(path).metadata or {}
+        if metadata.get(b'source_sha256') == digest.encode():
+            return pq.read_table(path)
+
+    if df is None:
+        df = read_source(source)
+    table = build(df)
+    write_artifact(name, table, digest)
+    return table
+
+
+# Function to read an integer stored in the artifact metadata
+def metadata_int(table, key):
+    return int(table.schema.metadata[key.encode()])
+
+
+# Function to attach integer counts to an artifact table
+def with_metadata(table, **values):
+    metadata = dict(table.schema.metadata or {})
+    metadata.update({key.encode(): str(value).encode() for key, value in values.items()})
+    return table.replace_schema_metadata(metadata)
+
+
+# Builders for every artifact, so a deploy can precompute them in one pass
+def registered_artifacts():
+    import drift
+    import encoding
+    import hierarchy
+    import ip_index
+    import vocab
+    from model_store import MODEL_PATH
+    return {
+        vocab.ARTIFACT_NAME: vocab.build_vocabularies,
+        encoding.ARTIFACT_NAME: encoding.build_encodings,
+        ip_index.ARTIFACT_NAME: ip_index.build_ip_ranges,
+        hierarchy.ARTIFACT_NAME: hierarchy.build_hierarchy,
+        hierarchy.LOCATION_ARTIFACT_NAME: hierarchy.build_locations,
+        drift.ARTIFACT_NAME: drift.build_drift_baseline,
+        drift.score_artifact_name(MODEL_PATH): drift.build_score_baseline,
+    }
+
+
+if __name__ == "__main__":
+    df = read_source()
+    digest = source_digest()
+    for name, build in registered_artifacts().items():
+        write_artifact(name, build(df), digest)
+        print(f"Built {artifact_path(name)}")
@@ -0,0 +1,358 @@
+import argparse
+import glob
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import metrics
+from encoding import BASE_FIELDS, PAIR_FIELDS
+from features import build_features
+from schema import RECORD_ARROW_SCHEMA, RECORD_FIELDS
+from utils import FEATURE_COLUMNS
+
+# Audit log of every scored lead, for replays and score disputes
+#
+#   python audit.py replay --model model/registry/2024-06-02/model.pkl --output replay.parquet
+#
+# The API hands each scored record (or whole /predicts batch) to AuditSink,
+# which only appends it to an in-memory ring buffer of AUDIT_BUFFER_ROWS rows.
+# A background thread drains the buffer every AUDIT_FLUSH_SECONDS and writes it
+# as record batches to Arrow IPC stream files in AUDIT_DIR, starting a new file
+# after AUDIT_FILE_ROWS rows or AUDIT_FILE_SECONDS. When the writer falls behind
+# the oldest buffered rows are overwritten, so a slow disk never blocks scoring;
+# the rows lost are counted in audit_rows_dropped_total.
+#
+# Each row holds the scoring time, the model version, the score, the raw record
+# as scored (after the network fields were filled in from the IP index) and the
+# model features. A file is written as <name>.arrows.partial and renamed to
+# <name>.arrows once complete; both can be read with pyarrow.ipc.open_stream.
+
+AUDIT_DIR = os.environ.get('AUDIT_DIR', 'audit')
+AUDIT_BUFFER_ROWS = int(os.environ.get('AUDIT_BUFFER_ROWS', '200000'))
+AUDIT_FLUSH_SECONDS = float(os.environ.get('AUDIT_FLUSH_SECONDS', '1'))
+AUDIT_FILE_ROWS = int(os.environ.get('AUDIT_FILE_ROWS', '1000000'))
+AUDIT_FILE_SECONDS = float(os.environ.get('AUDIT_FILE_SECONDS', '3600'))
+# Completed files to keep, oldest deleted first; 0 keeps every file
+AUDIT_MAX_FILES = int(os.environ.get('AUDIT_MAX_FILES', '0'))
+
+FILE_SUFFIX = '.arrows'
+PARTIAL_SUFFIX = '.partial'
+
+RAW_TYPE = pa.struct(list(RECORD_ARROW_SCHEMA))
+# The categorical features are strings; IP Address Numerized is kept as float64, which is what the model computes with
+NUMERIC_FEATURE_TYPES = {
+    'postalcode': pa.int64(),
+    'Male/Female': pa.int64(),
+    'Age': pa.int64(),
+    'Latitude (generated)': pa.float64(),
+    'Longitude (generated)': pa.float64(),
+    'Hour': pa.int64(),
+    'IP Address Numerized': pa.float64(),
+}
+FEATURE_TYPE = pa.struct([pa.field(column, NUMERIC_FEATURE_TYPES.get(column, pa.string())) for column in FEATURE_COLUMNS])
+
+AUDIT_SCHEMA = pa.schema([
+    pa.field('scored_at', pa.timestamp('ms', tz='UTC')),
+    pa.field('model_version', pa.string()),
+    pa.field('probability_score', pa.float64()),
+    pa.field('raw', RAW_TYPE),
+    pa.field('features', FEATURE_TYPE),
+])
+
+
+# Function to get the model features as plain columns; encoded categoricals fold unseen values
+# into one bucket, so the categorical features are rebuilt from the raw strings instead
+def feature_columns(raw, features):
+    columns = {}
+    for column in FEATURE_COLUMNS:
+        if column in BASE_FIELDS:
+            columns[column] = raw[column]
+        elif column in PAIR_FIELDS:
+            left, right = PAIR_FIELDS[column]
+            columns[column] = raw[left].astype(str) + ' - ' + raw[right].astype(str)
+        elif column == 'Time Category':
+            columns[column] = features[column].astype(str)
+        else:
+            columns[column] = features[column]
+    return columns
+
+
+# Function to build an audit table from a raw frame, its features and the scores (scored_at in epoch ms)
+def audit_table(raw, features, versions, scores, scored_at):
+    raw_array = pa.StructArray.from_arrays(
+        [column_array(raw[field], RAW_TYPE.field(field).type) for field in RECORD_FIELDS],
+        fields=list(RAW_TYPE),
+    )
+    columns = feature_columns(raw, features)
+    feature_array = pa.StructArray.from_arrays(
+        [column_array(columns[column], FEATURE_TYPE.field(column).type) for column in FEATURE_COLUMNS],
+        fields=list(FEATURE_TYPE),
+    )
+    return pa.Table.from_arrays([
+        pa.array(np.asarray(scored_at, dtype=np.int64), AUDIT_SCHEMA.field('scored_at').type),
+        pa.array(versions, pa.string()),
+        pa.array(np.asarray(scores, dtype=np.float64)),
+        raw_array,
+        feature_array,
+    ], schema=AUDIT_SCHEMA)
+
+
+# Function to convert one column to its Arrow type, None becoming null in string columns
+def column_array(values, arrow_type):
+    if arrow_type == pa.string():
+        return pa.array(np.asarray(values, dtype=object), arrow_type, from_pandas=True)
+    return pa.array(np.asarray(values, dtype=arrow_type.to_pandas_dtype()), arrow_type)
+
+
+class AuditSink:
+    def __init__(self, directory=AUDIT_DIR, capacity=AUDIT_BUFFER_ROWS, flush_seconds=AUDIT_FLUSH_SECONDS,
+                 file_rows=AUDIT_FILE_ROWS, file_seconds=AUDIT_FILE_SECONDS, max_files=AUDIT_MAX_FILES):
+        self.directory = directory
+        self.capacity = capacity
+        self.flush_seconds = flush_seconds
+        self.file_rows = file_rows
+        self.file_seconds = file_seconds
+        self.max_files = max_files
+
+        # Entries of ((kind, payload), rows); only the append and the drain hold the lock
+        self._entries = deque()
+        self._rows = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        # A forked child inherits the sink but not its writer thread, so it skips it
+        self._pid = os.getpid()
+
+        self._writer = None
+        self._path = None
+        self._file_rows = 0
+        self._file_opened = 0.0
+        self._sequence = 0
+
+    # Function to buffer a scored batch: the raw frame, its features, the model version and the scores
+    def record_frame(self, raw, features, version, scores):
+        if len(raw):
+            self.append(('frame', (raw, features, version, scores, time.time())), len(raw))
+
+    # Function to buffer one scored record: the raw dictionary, the input_data features, the version and the score
+    def record(self, data, input_data, version, probability_score):
+        self.append(('record', (data, input_data, version, probability_score, time.time())), 1)
+
+    def append(self, entry, rows):
+        if os.getpid() != self._pid:
+            return
+        dropped = 0
+        with self._lock:
+            self._entries.append((entry, rows))
+            self._rows += rows
+            # The ring is full: overwrite the oldest rows instead of waiting for the writer
+            while self._rows > self.capacity:
+                _, old_rows = self._entries.popleft()
+                self._rows -= old_rows
+                dropped += old_rows
+        metrics.increment('audit_rows_total', rows)
+        if dropped:
+            metrics.increment('audit_rows_dropped_total', dropped, reason='buffer_full')
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name='audit-writer', daemon=True)
+        self._thread.start()
+
+    def run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_seconds)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+        self.close_file()
+
+    # Function to stop the writer after it has written what is still buffered
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    # Function to drain the buffer and write it to the current file
+    def flush(self):
+        with self._lock:
+            entries = list(self._entries)
+            self._entries.clear()
+            self._rows = 0
+        if not entries:
+            return
+        rows = sum(entry_rows for _, entry_rows in entries)
+        try:
+            with metrics.timer('audit_write'):
+                table = self.to_table([entry for entry, _ in entries])
+                self.write(table)
+        except Exception as e:
+            metrics.count_error(f'audit_{type(e).__name__}')
+            metrics.increment('audit_rows_dropped_total', rows, reason='write_error')
+            # Start over in a new file, the current one may be truncated
+            self.close_file()
+            return
+        metrics.increment('audit_rows_written_total', rows)
+
+    # Function to turn buffered entries into one audit table; single records are written together
+    def to_table(self, entries):
+        tables = []
+        records = [payload for kind, payload in entries if kind == 'record']
+        for kind, (raw, features, version, scores, scored_at) in entries:
+            if kind == 'frame':
+                tables.append(audit_table(raw, features, [version] * len(raw), scores, [int(scored_at * 1000)] * len(raw)))
+        if records:
+            data, input_data, versions, scores, scored_at = zip(*records)
+            tables.append(audit_table(pd.DataFrame(list(data)), pd.DataFrame(list(input_data)), list(versions),
+                                      list(scores), [int(t * 1000) for t in scored_at]))
+        return pa.concat_tables(tables)
+
+    def write(self, table):
+        now = time.time()
+        if self._writer is not None and (self._file_rows >= self.file_rows or now - self._file_opened >= self.file_seconds):
+            self.close_file()
+        if self._writer is None:
+            self._sequence += 1
+            stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))
+            self._path = os.path.join(self.directory, f'audit-{stamp}-{self._pid}-{self._sequence:04d}{FILE_SUFFIX}{PARTIAL_SUFFIX}')
+            self._writer = pa.ipc.new_stream(self._path, AUDIT_SCHEMA)
+            self._file_rows = 0
+            self._file_opened = now
+        self._writer.write_table(table)
+        self._file_rows += len(table)
+
+    # Function to finish the current file and rename it to its final name
+    def close_file(self):
+        if self._writer is None:
+            return
+        try:
+            self._writer.close()
+            os.replace(self._path, self._path[:-len(PARTIAL_SUFFIX)])
+            metrics.increment('audit_files_total')
+            self.prune()
+        except OSError as e:
+            metrics.count_error(f'audit_{type(e).__name__}')
+        finally:
+            self._writer = None
+            self._path = None
+
+    # Function to delete the oldest completed files beyond max_files
+    def prune(self):
+        if self.max_files <= 0:
+            return
+        files = audit_files(self.directory)
+        for path in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(path)
+
+    # Function to get the buffer level for the metrics gauges
+    def stats(self):
+        return {'buffered_rows': self._rows, 'capacity': self.capacity}
+
+
+# Function to list the completed audit files, oldest first
+def audit_files(directory=AUDIT_DIR, include_partial=False):
+    paths = glob.glob(os.path.join(directory, f'*{FILE_SUFFIX}'))
+    if include_partial:
+        paths += glob.glob(os.path.join(directory, f'*{FILE_SUFFIX}{PARTIAL_SUFFIX}'))
+    # The names start with the UTC time the file was opened
+    return sorted(paths, key=os.path.basename)
+
+
+# Function to stream the record batches of audit files; a file cut short by a crash yields what it holds
+def read_audit(paths):
+    for path in paths:
+        with pa.OSFile(path, 'rb') as source:
+            reader = pa.ipc.open_stream(source)
+            while True:
+                try:
+                    yield path, reader.read_next_batch()
+                except StopIteration:
+                    break
+                except pa.ArrowInvalid:
+                    metrics.count_error('audit_truncated_file')
+                    break
+
+
+# Function to get a column of structs as a DataFrame
+def struct_frame(batch, name):
+    column = batch.column(name)
+    return pd.DataFrame({field.name: column.field(i).to_numpy(zero_copy_only=False) for i, field in enumerate(column.type)})
+
+
+# Function to score audit files again with a model and compare with the logged scores
+def replay(paths, model, from_features=False, output=None, threshold=0.5):
+    from scoring import score
+
+    summary = {}
+    writer = None
+    for path, batch in read_audit(paths):
+        if batch.num_rows == 0:
+            continue
+        if from_features:
+            df = struct_frame(batch, 'features')[FEATURE_COLUMNS]
+        else:
+            df = build_features(struct_frame(batch, 'raw'))
+        logged = batch.column('probability_score').to_numpy()
+        replayed = score(model, df)['probability_score_of_1']
+        diff = np.abs(replayed - logged)
+        flips = (replayed >= threshold) != (logged >= threshold)
+
+        versions = batch.column('model_version').to_pylist()
+        for version in set(versions):
+            rows = np.asarray(versions, dtype=object) == version
+            entry = summary.setdefault(version, {'rows': 0, 'max_abs_diff': 0.0, 'sum_abs_diff': 0.0, 'decision_flips': 0})
+            entry['rows'] += int(rows.sum())
+            entry['max_abs_diff'] = max(entry['max_abs_diff'], float(diff[rows].max()))
+            entry['sum_abs_diff'] += float(diff[rows].sum())
+            entry['decision_flips'] += int(flips[rows].sum())
+
+        if output is not None:
+            result = pa.table({
+                'scored_at': batch.column('scored_at'),
+                'model_version': batch.column('model_version'),
+                'probability_score': batch.column('probability_score'),
+                'replay_score': pa.array(replayed),
+            })
+            if writer is None:
+                writer = pq.ParquetWriter(output, result.schema)
+            writer.write_table(result)
+    if writer is not None:
+        writer.close()
+
+    for entry in summary.values():
+        entry['mean_abs_diff'] = entry.pop('sum_abs_diff') / entry['rows']
+    return summary
+
+
+if __name__ == "__main__":
+    from model_store import MODEL_PATH, load_backend
+
+    parser = argparse.ArgumentParser(description="Work with the scoring audit log")
+    commands = parser.add_subparsers(dest='command', required=True)
+    replay_parser = commands.add_parser('replay', help="Score the audit log again and compare with the logged scores")
+    replay_parser.add_argument('files', nargs='*', help="Audit files, default every completed file in --dir")
+    replay_parser.add_argument('--dir', default=AUDIT_DIR)
+    replay_parser.add_argument('--include-partial', action='store_true', help="Also read files still being written")
+    replay_parser.add_argument('--model', default=MODEL_PATH)
+    replay_parser.add_argument('--backend', default='sklearn', choices=['sklearn', 'numpy', 'onnx'])
+    replay_parser.add_argument('--from-features', action='store_true', help="Score the logged features instead of rebuilding them from the raw records")
+    replay_parser.add_argument('--output', help="Parquet file for the logged and replayed score of every row")
+    args = parser.parse_args()
+
+    paths = args.files or audit_files(args.dir, args.include_partial)
+    if not paths:
+        parser.error(f"No audit files in {args.dir}")
+    summary = replay(paths, load_backend(args.backend, args.model), args.from_features, args.output)
+    for version, entry in sorted(summary.items()):
+        print(f"{version}: {entry['rows']} rows, mean abs diff {entry['mean_abs_diff']:.3g}, "
+              f"max abs diff {entry['max_abs_diff']:.3g}, {entry['decision_flips']} decision flips")
@@ -0,0 +1,323 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from encoding import load_encoder
+from features import STRING_FIELDS, build_features
+from ip_index import NETWORK_FIELDS, fill_network_fields, load_ip_index
+from model_store import MODEL_PATH, load_backend
+from schema import coerce_numbers, invalid_values
+from scoring import score
+from utils import FEATURE_COLUMNS
+
+# Streaming batch scorer for large lead files
+#
+#   python batch_score.py leads.csv scores.csv --chunk-size 50000 --workers 4
+#
+# Input is read in fixed-size chunks (CSV, JSONL, Parquet or xlsx), scored in
+# worker processes that each load the model once, and written out in input
+# order as soon as each chunk is done. At most two chunks per worker are in
+# flight, so memory stays bounded whatever the file size. A checkpoint file next
+# to the output records progress, and --resume continues from it: the rows it
+# has already written are skipped by the reader, not parsed again.
+#
+# Records can be raw API records (Timestamp, IP Address, ...) or rows that
+# already carry the engineered columns, like the V8 workbook. Raw records may
+# leave out AS Description, isp and connection_type, see ip_index.py. Raw
+# records with a Timestamp, IP Address or numeric field that cannot be parsed
+# are not scored: their row gets a message in the error column and the run
+# carries on.
+
+CHUNK_SIZE = 50_000
+
+
+# Function to read a CSV file in chunks, skipping the first skip_rows records without parsing them
+def read_csv_chunks(path, chunk_size, skip_rows=0):
+    dtype = {field: str for field in STRING_FIELDS}
+    skiprows = range(1, skip_rows + 1) if skip_rows else None
+    yield from pd.read_csv(path, chunksize=chunk_size, dtype=dtype, skiprows=skiprows)
+
+
+# Function to read a JSON Lines file in chunks; skipped records are passed over as plain lines
+def read_jsonl_chunks(path, chunk_size, skip_rows=0):
+    dtype = {field: str for field in STRING_FIELDS}
+    with open(path) as f:
+        skipped = 0
+        while skipped < skip_rows:
+            line = f.readline()
+            if not line:
+                return
+            skipped += bool(line.strip())
+        yield from pd.read_json(f, lines=True, chunksize=chunk_size, dtype=dtype)
+
+
+# Function to read a Parquet file in chunks; whole row groups before skip_rows are not read at all
+def read_parquet_chunks(path, chunk_size, skip_rows=0):
+    parquet = pq.ParquetFile(path)
+    row_groups = []
+    for i in range(parquet.metadata.num_row_groups):
+        rows = parquet.metadata.row_group(i).num_rows
+        if skip_rows >= rows and not row_groups:
+            skip_rows -= rows
+        else:
+            row_groups.append(i)
+    if not row_groups:
+        return
+    for batch in parquet.iter_batches(batch_size=chunk_size, row_groups=row_groups):
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        yield batch.slice(skip_rows).to_pandas()
+        skip_rows = 0
+
+
+# Function to read an xlsx workbook in chunks without loading the whole sheet
+def read_xlsx_chunks(path, chunk_size, skip_rows=0):
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        header = list(next(workbook.active.iter_rows(max_row=1, values_only=True)))
+        rows = workbook.active.iter_rows(min_row=2 + skip_rows, values_only=True)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield pd.DataFrame(chunk, columns=header)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=header)
+    finally:
+        workbook.close()
+
+
+READERS = {
+    '.csv': read_csv_chunks,
+    '.jsonl': read_jsonl_chunks,
+    '.parquet': read_parquet_chunks,
+    '.xlsx': read_xlsx_chunks,
+}
+
+
+# Function to pick the chunk reader from the file extension
+def read_chunks(path, chunk_size, skip_rows=0):
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in READERS:
+        raise ValueError(f"Unsupported input format: {extension}")
+    return READERS[extension](path, chunk_size, skip_rows)
+
+
+# Function to build model features for a chunk of raw or already engineered records
+# Returns the features of the valid rows and the error message of every other row, by position
+def prepare_chunk(chunk, encoder=None):
+    # Spreadsheet and Parquet cells may hold numbers for String fields such as subid
+    for field in STRING_FIELDS:
+        if field in chunk.columns and not pd.api.types.is_string_dtype(chunk[field]):
+            chunk[field] = chunk[field].map(lambda value: value if value is None or isinstance(value, str) else str(value))
+    if 'Timestamp' in chunk.columns and 'IP Address' in chunk.columns:
+        chunk, errors = coerce_numbers(chunk)
+        for i, message in invalid_values(chunk).items():
+            errors.setdefault(i, message)
+        if errors:
+            keep = np.ones(len(chunk), dtype=bool)
+            keep[list(errors)] = False
+            chunk = chunk[keep].reset_index(drop=True)
+        # Raw records; network fields that are missing or empty come from the IP range index
+        if any(field not in chunk.columns or chunk[field].isna().any() for field in NETWORK_FIELDS):
+            chunk = fill_network_fields(chunk, worker_ip_index())
+        return build_features(chunk, encoder), errors
+    return chunk[FEATURE_COLUMNS], {}
+
+
+# Model and category encoder of this worker process, loaded once by init_worker
+_worker_model = None
+_worker_encoder = None
+_worker_ip_index = None
+
+
+def init_worker(backend, model_path, encode_categories=True):
+    global _worker_model, _worker_encoder
+    _worker_model = load_backend(backend, model_path)
+    _worker_encoder = load_encoder() if encode_categories else None
+
+
+# Function to load the IP range index the first time a chunk needs it
+def worker_ip_index():
+    global _worker_ip_index
+    if _worker_ip_index is None:
+        _worker_ip_index = load_ip_index()
+    return _worker_ip_index
+
+
+# Function to score one chunk inside a worker process; rejected rows keep their place with an error message
+def score_chunk(chunk, first_row, keep_columns):
+    result = pd.DataFrame({'row': range(first_row, first_row + len(chunk))})
+    for column in keep_columns:
+        result[column] = chunk[column].to_numpy()
+    features, errors = prepare_chunk(chunk, _worker_encoder)
+
+    valid = np.ones(len(chunk), dtype=bool)
+    valid[list(errors)] = False
+    probability_score = np.full(len(chunk), np.nan)
+    transformed_proba = pd.array([pd.NA] * len(chunk), dtype='Int64')
+    if len(features):
+        scores = score(_worker_model, features)
+        probability_score[valid] = scores['probability_score_of_1']
+        transformed_proba[valid] = scores['transformed_proba']
+    result['probability_score'] = probability_score
+    result['transformed_proba'] = transformed_proba
+    messages = [None] * len(chunk)
+    for i, message in errors.items():
+        messages[i] = message
+    result['error'] = pd.array(messages, dtype='string')
+    return result
+
+
+class CsvOutput:
+    def __init__(self, path, resume_bytes):
+        # Drop anything written after the last checkpoint, e.g. a chunk cut short by a crash
+        mode = 'r+b' if resume_bytes is not None and os.path.exists(path) else 'wb'
+        self.f = open(path, mode)
+        if mode == 'r+b':
+            self.f.truncate(resume_bytes)
+            self.f.seek(resume_bytes)
+
+    def write(self, result):
+        result.to_csv(self.f, header=self.f.tell() == 0, index=False)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        return self.f.tell()
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetOutput:
+    # Parquet files cannot be appended to, so every chunk becomes a part file in the output directory
+    def __init__(self, path, part):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.part = part
+
+    def write(self, result):
+        part_path = os.path.join(self.path, f'part-{self.part:06d}.parquet')
+        tmp_path = f'{part_path}.tmp'
+        pq.write_table(pa.Table.from_pandas(result, preserve_index=False), tmp_path)
+        os.replace(tmp_path, part_path)
+        self.part += 1
+        return self.part
+
+    def close(self):
+        pass
+
+
+# Function to open the output writer, a CSV file or a directory of Parquet parts
+def open_output(path, resume_bytes, chunks_done):
+    if path.endswith('.csv'):
+        return CsvOutput(path, resume_bytes)
+    return ParquetOutput(path, chunks_done)
+
+
+# Function to read the checkpoint of a previous run
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+# Function to save progress atomically after every written chunk
+def write_checkpoint(path, checkpoint):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp_path, path)
+
+
+# Function to stream an input file through the model and write the scores incrementally
+def run(input_path, output_path, chunk_size=CHUNK_SIZE, workers=1, backend='sklearn',
+        model_path=MODEL_PATH, keep_columns=(), resume=False, encode_categories=True, log=sys.stderr):
+    checkpoint_path = f'{output_path}.checkpoint.json'
+    checkpoint = read_checkpoint(checkpoint_path) if resume else None
+    if checkpoint is not None and (checkpoint['input'] != os.path.abspath(input_path) or checkpoint['chunk_size'] != chunk_size):
+        raise ValueError("Checkpoint was written for a different input or chunk size")
+    if checkpoint is None:
+        checkpoint = {'input': os.path.abspath(input_path), 'chunk_size': chunk_size,
+                      'chunks_done': 0, 'rows_done': 0, 'output_position': 0}
+
+    output = open_output(output_path, checkpoint['output_position'] if resume else None, checkpoint['chunks_done'])
+    executor = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(backend, model_path, encode_categories)) if workers > 1 else None
+    if executor is None:
+        init_worker(backend, model_path, encode_categories)
+
+    start = time.perf_counter()
+    rows_processed = 0
+    rows_rejected = 0
+    pending = []
+    # A resumed run starts reading after the rows the checkpoint has written
+    first_row = checkpoint['rows_done']
+
+    # Function to write the oldest pending chunk and record the progress
+    def write_next():
+        nonlocal rows_processed, rows_rejected
+        result = pending.pop(0)
+        result = result.result() if executor is not None else result
+        rows_rejected += int(result['error'].notna().sum())
+        checkpoint['output_position'] = output.write(result)
+        checkpoint['chunks_done'] += 1
+        checkpoint['rows_done'] += len(result)
+        write_checkpoint(checkpoint_path, checkpoint)
+
+        rows_processed += len(result)
+        elapsed = time.perf_counter() - start
+        print(f"chunk {checkpoint['chunks_done']}: {checkpoint['rows_done']} rows, "
+              f"{rows_processed / elapsed:,.0f} rows/s", file=log)
+
+    try:
+        for chunk in read_chunks(input_path, chunk_size, first_row):
+            if executor is not None:
+                pending.append(executor.submit(score_chunk, chunk, first_row, keep_columns))
+                if len(pending) >= 2 * workers:
+                    write_next()
+            else:
+                pending.append(score_chunk(chunk, first_row, keep_columns))
+                write_next()
+            first_row += len(chunk)
+        while pending:
+            write_next()
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        output.close()
+
+    elapsed = time.perf_counter() - start
+    if rows_rejected:
+        print(f"{rows_rejected} rows could not be scored, see the error column", file=log)
+    print(f"Scored {rows_processed - rows_rejected} of {rows_processed} rows in {elapsed:.1f}s "
+          f"({rows_processed / elapsed if elapsed else 0:,.0f} rows/s)", file=log)
+    return checkpoint
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score a large lead file in chunks")
+    parser.add_argument('input', help="CSV, JSONL, Parquet or xlsx file of leads")
+    parser.add_argument('output', help="CSV file, or a directory of Parquet parts for any other name")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--backend', choices=['sklearn', 'numpy', 'onnx'], default='numpy')
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--keep-column', action='append', default=[], help="Copy this input column to the output")
+    parser.add_argument('--resume', action='store_true', help="Continue from the checkpoint of a previous run")
+    parser.add_argument('--no-encode-categories', action='store_true', help="Keep categorical columns as strings")
+    args = parser.parse_args()
+
+    run(args.input, args.output, args.chunk_size, args.workers, args.backend, args.model,
+        args.keep_column, args.resume, not args.no_encode_categories)
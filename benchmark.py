@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from encoding import load_encoder
+from features import build_features, records_to_frame
+from model_store import MODEL_PATH, load_backend
+from parity import load_rows, to_raw_records
+from scoring import score
+from utils import build_input_data, get_time_categories, get_time_category, numerize_ip, numerize_ips
+
+# Reproducible latency, throughput and cold-start benchmarks
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --output bench.json --baseline benchmarks/baseline.json
+#
+# Rows of the V8 workbook are turned back into raw API records and replayed
+# through the same functions the service uses. Metrics ending in _ms or _s are
+# lower-is-better, metrics ending in _per_s are higher-is-better; --baseline
+# fails with exit code 1 when any of them regresses by more than --tolerance.
+
+BATCH_SIZES = [1, 10, 100, 1000, 10000]
+SEED = 0
+
+
+# Function to time a callable in milliseconds
+def timed(fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+# Function to summarize a list of latencies
+def percentiles(samples_ms):
+    samples_ms = np.asarray(samples_ms)
+    return {
+        'p50_ms': float(np.percentile(samples_ms, 50)),
+        'p95_ms': float(np.percentile(samples_ms, 95)),
+        'p99_ms': float(np.percentile(samples_ms, 99)),
+        'mean_ms': float(samples_ms.mean()),
+    }
+
+
+# Function to build the model input the way api.py does for each backend
+def model_input(model, all_input_data):
+    if getattr(model, 'accepts_records', False):
+        return all_input_data
+    return pd.DataFrame(all_input_data)
+
+
+# Function to measure single-record /predict-style latency
+def bench_single(model, records, samples):
+    # Warm up so the first call's allocations are not measured
+    for record in records[:5]:
+        score(model, model_input(model, [build_input_data(record)]))
+
+    latencies = []
+    for record in records[:samples]:
+        start = time.perf_counter()
+        score(model, model_input(model, [build_input_data(record)]))
+        latencies.append((time.perf_counter() - start) * 1000)
+    return percentiles(latencies)
+
+
+# Function to measure /predicts-style throughput for each batch size
+def bench_batches(model, records, batch_sizes, repeats):
+    results = {}
+    for batch_size in batch_sizes:
+        batch = [records[i % len(records)] for i in range(batch_size)]
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            score(model, build_features(records_to_frame(batch)))
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        results[str(batch_size)] = {'batch_s': best, 'rows_per_s': batch_size / best}
+    return results
+
+
+# Function to separate feature-engineering cost from model cost
+def bench_stages(model, records, encoder):
+    ips = [record['IP Address'] for record in records]
+    hours = [int(record['Timestamp'][11:13]) for record in records]
+    all_input_data = [build_input_data(record) for record in records]
+    raw = records_to_frame(records)
+    df = build_features(raw)
+    n = len(records)
+
+    return {
+        'rows': n,
+        'numerize_ip_per_record_ms': timed(lambda: [numerize_ip(ip) for ip in ips]),
+        'numerize_ips_vectorized_ms': timed(numerize_ips, ips),
+        'get_time_category_per_record_ms': timed(lambda: [get_time_category(hour) for hour in hours]),
+        'get_time_categories_vectorized_ms': timed(get_time_categories, hours),
+        'build_input_data_loop_ms': timed(lambda: [build_input_data(record) for record in records]),
+        'dataframe_from_dicts_ms': timed(pd.DataFrame, all_input_data),
+        'records_to_frame_ms': timed(records_to_frame, records),
+        'build_features_ms': timed(build_features, raw),
+        'build_features_encoded_ms': timed(build_features, raw, encoder),
+        'model_ms': timed(score, model, df),
+        'model_encoded_ms': timed(score, model, build_features(raw, encoder)),
+    }
+
+
+# Function to measure cold start in a fresh interpreter
+def bench_cold_start(model_path):
+    script = f"""
+import json, time, warnings
+warnings.filterwarnings('ignore')
+result = {{}}
+start = time.perf_counter()
+import joblib
+model = joblib.load({model_path!r})
+result['joblib_load_s'] = time.perf_counter() - start
+
+start = time.perf_counter()
+import pandas as pd
+df = pd.read_excel('data/Processed Linkout ML Propensity Data V8.xlsx')
+lists = [df[c].unique().tolist() for c in ['AS Description', 'country', 'state', 'city', 'isp', 'source', 'subid', 'connection_type', 'coreg_path']]
+result['load_data_xlsx_s'] = time.perf_counter() - start
+
+start = time.perf_counter()
+from vocab import load_vocabularies
+load_vocabularies()
+result['load_vocabularies_s'] = time.perf_counter() - start
+print(json.dumps(result))
+"""
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+# Function to flatten nested results into metric names
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{name}.'))
+        else:
+            flat[name] = value
+    return flat
+
+
+# Function to list metrics that got worse than the baseline by more than the tolerance
+def compare(current, baseline, tolerance):
+    regressions = []
+    current, baseline = flatten(current), flatten(baseline)
+    for name, base in baseline.items():
+        if name not in current or not isinstance(base, (int, float)) or base <= 0:
+            continue
+        value = current[name]
+        if name.endswith(('_ms', '_s')) and value > base * (1 + tolerance):
+            regressions.append(f"{name}: {value:.4g} vs baseline {base:.4g}")
+        elif name.endswith('_per_s') and value < base * (1 - tolerance):
+            regressions.append(f"{name}: {value:.4g} vs baseline {base:.4g}")
+    return regressions
+
+
+# Function to run the whole suite
+def run(backends, single_samples, batch_sizes, repeats, model_path=MODEL_PATH, cold_start=True):
+    rng = np.random.default_rng(SEED)
+    rows = load_rows()
+    rows = rows.iloc[rng.permutation(len(rows))].reset_index(drop=True)
+    records = to_raw_records(rows).to_dict('records')
+
+    encoder = load_encoder()
+    results = {'single': {}, 'batch': {}, 'stages': {}}
+    for backend in backends:
+        model = load_backend(backend, model_path)
+        results['single'][backend] = bench_single(model, records, single_samples)
+        results['batch'][backend] = bench_batches(model, records, batch_sizes, repeats)
+        results['stages'][backend] = bench_stages(model, records[:max(batch_sizes)], encoder)
+    if cold_start:
+        results['cold_start'] = bench_cold_start(model_path)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scoring paths")
+    parser.add_argument('--backend', action='append', choices=['sklearn', 'numpy', 'onnx'], help="Backends to measure (default: sklearn and numpy)")
+    parser.add_argument('--single-samples', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, action='append', help="Batch sizes to measure (default: 1 10 100 1000 10000)")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--no-cold-start', action='store_true')
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', help="Compare against this earlier output")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    results = run(args.backend or ['sklearn', 'numpy'], args.single_samples, args.batch_size or BATCH_SIZES,
+                  args.repeats, cold_start=not args.no_cold_start)
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        raise SystemExit(1 if regressions else 0)
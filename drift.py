@@ -0,0 +1,382 @@
+import os
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from artifacts import load_artifact, source_digest, with_metadata
+from model_store import MODEL_PATH
+from utils import FEATURE_COLUMNS
+
+# Streaming drift and data-quality monitor with fixed-size sketches
+#
+# Scored leads update, per categorical field, counts over the training
+# vocabulary plus one bucket for unseen values, a count-min sketch of every
+# value and a space-saving heavy-hitter list, and per numeric field (plus the
+# output score) a histogram over fixed bins cut at the V8 percentiles. Updates are vectorized
+# per batch; single leads are buffered and flushed in batches. Once the monitor
+# has seen DRIFT_WINDOW rows every count is halved, so the report follows
+# recent traffic and memory never grows.
+#
+# report() compares the sketches with the 'drift_baseline' artifact built from
+# the V8 workbook: the population stability index (PSI) of every field, the
+# share of values never seen in training and the heavy hitters next to their
+# training share. The score is compared with a 'score_baseline' artifact of the
+# model being served, built from that model's scores on the V8 rows, so a new
+# model version is not reported as drift.
+
+ARTIFACT_NAME = 'drift_baseline'
+SCORE_ARTIFACT_NAME = 'score_baseline'
+
+CATEGORICAL_FIELDS = ['AS Description', 'country', 'state', 'city', 'connection_type', 'coreg_path', 'isp', 'source', 'subid']
+NUMERIC_FIELDS = ['Age', 'Hour', 'Latitude (generated)', 'Longitude (generated)', 'postalcode']
+SCORE_FIELD = 'score'
+
+# Percentiles that cut the numeric bins
+BIN_PERCENTILES = np.linspace(1, 99, 49)
+SKETCH_WIDTH = 2048
+SKETCH_DEPTH = 4
+HEAVY_HITTERS = 32
+BUFFER_ROWS = 256
+
+DRIFT_WINDOW = int(os.environ.get('DRIFT_WINDOW', '100000'))
+# PSI above this, or a share of unseen values above DRIFT_UNSEEN_RATE, flags a field
+DRIFT_PSI_THRESHOLD = float(os.environ.get('DRIFT_PSI_THRESHOLD', '0.2'))
+DRIFT_UNSEEN_RATE = float(os.environ.get('DRIFT_UNSEEN_RATE', '0.05'))
+
+# Odd multipliers for the count-min rows
+HASH_SEEDS = np.array([0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5], dtype=np.uint64)
+
+
+# Function to build the baseline shares of every monitored field from the training DataFrame
+def build_drift_baseline(df):
+    fields, values, edges, shares = [], [], [], []
+    for field in CATEGORICAL_FIELDS:
+        counts = df[field].astype(str).value_counts(normalize=True)
+        fields.extend([field] * len(counts))
+        values.extend(counts.index.tolist())
+        edges.extend([None] * len(counts))
+        shares.extend(counts.tolist())
+    numeric = {field: df[field].to_numpy(dtype=np.float64) for field in NUMERIC_FIELDS}
+    return baseline_table(fields, values, edges, shares, numeric, len(df))
+
+
+# Function to build the baseline shares of a model's score on the training DataFrame
+def build_score_baseline(df, model_path=MODEL_PATH):
+    from model_store import load_model
+
+    scores = load_model(model_path).predict_proba(df[FEATURE_COLUMNS])[:, 1]
+    return baseline_table([], [], [], [], {SCORE_FIELD: scores}, len(df))
+
+
+# Function to add the percentile bins of numeric columns to the baseline rows and build the table
+def baseline_table(fields, values, edges, shares, numeric, rows):
+    for field, column in numeric.items():
+        field_edges = np.unique(np.percentile(column, BIN_PERCENTILES))
+        counts = np.bincount(np.searchsorted(field_edges, column, side='right'), minlength=len(field_edges) + 1)
+        fields.extend([field] * len(counts))
+        values.extend([None] * len(counts))
+        # Row i holds the lower edge of bin i, the first bin has none
+        edges.extend([None] + field_edges.tolist())
+        shares.extend((counts / len(column)).tolist())
+
+    table = pa.table({
+        'field': pa.array(fields, pa.string()).dictionary_encode(),
+        'value': pa.array(values, pa.string()),
+        'edge': pa.array(edges, pa.float64()),
+        'share': pa.array(shares, pa.float64()),
+    })
+    return with_metadata(table, rows=rows)
+
+
+# Function to load the baseline artifact
+def load_drift_baseline(df=None):
+    return load_artifact(ARTIFACT_NAME, build_drift_baseline, df=df)
+
+
+# Function to name the score baseline artifact of a model file; the name carries the model's digest,
+# so every version keeps its own artifact and the workbook digest still triggers rebuilds
+def score_artifact_name(model_path=MODEL_PATH):
+    return f'{SCORE_ARTIFACT_NAME}-{source_digest(model_path)[:16]}'
+
+
+# Function to load the score baseline artifact of a model file
+def load_score_baseline(model_path=MODEL_PATH, df=None):
+    return load_artifact(score_artifact_name(model_path), lambda df: build_score_baseline(df, model_path), df=df)
+
+
+# Function to read the columns of a baseline table
+def baseline_columns(table):
+    fields = np.asarray(table.column('field').to_pylist(), dtype=object)
+    values = np.asarray(table.column('value').to_pylist(), dtype=object)
+    edges = table.column('edge').to_numpy(zero_copy_only=False)
+    shares = table.column('share').to_numpy()
+    return fields, values, edges, shares
+
+
+# Function to set up the empty histogram of a numeric field from its baseline rows
+def numeric_state(fields, edges, shares, field):
+    rows = fields == field
+    return {
+        'edges': edges[rows][1:],
+        'baseline_shares': shares[rows],
+        'counts': np.zeros(int(rows.sum()), dtype=np.float64),
+        'missing': 0.0,
+    }
+
+
+# Function to set up the empty score histogram from a score baseline table
+def score_state(score_table):
+    fields, _, edges, shares = baseline_columns(score_table)
+    return numeric_state(fields, edges, shares, SCORE_FIELD)
+
+
+# Function to compute the population stability index of two share vectors
+def psi(expected, actual, floor=1e-4):
+    expected = np.maximum(np.asarray(expected, dtype=np.float64), floor)
+    actual = np.maximum(np.asarray(actual, dtype=np.float64), floor)
+    return float(np.sum((actual - expected) * np.log(actual / expected)))
+
+
+class CountMinSketch:
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.counts = np.zeros((depth, width), dtype=np.float64)
+        self.seeds = HASH_SEEDS[:depth]
+
+    # Function to get the column of every hash in every row, shape (depth, n)
+    def columns(self, hashes):
+        with np.errstate(over='ignore'):
+            mixed = hashes[None, :] * self.seeds[:, None]
+        return ((mixed >> np.uint64(32)) % np.uint64(self.width)).astype(np.intp)
+
+    def add(self, hashes, counts):
+        for row, columns in enumerate(self.columns(hashes)):
+            np.add.at(self.counts[row], columns, counts)
+
+    def estimate(self, hashes):
+        columns = self.columns(hashes)
+        return np.min([self.counts[row, columns[row]] for row in range(len(columns))], axis=0)
+
+
+class HeavyHitters:
+    # Space-saving top-k: a new value replaces the smallest entry and inherits its count as the error bound
+    def __init__(self, capacity=HEAVY_HITTERS):
+        self.capacity = capacity
+        self.counts = {}
+
+    def add(self, value, count):
+        if value in self.counts or len(self.counts) < self.capacity:
+            self.counts[value] = self.counts.get(value, 0.0) + count
+            return
+        smallest = min(self.counts, key=self.counts.get)
+        self.counts[value] = self.counts.pop(smallest) + count
+
+    def scale(self, factor):
+        for value in self.counts:
+            self.counts[value] *= factor
+
+    def top(self, n):
+        return sorted(self.counts.items(), key=lambda item: -item[1])[:n]
+
+
+# Function to hash string values to uint64 with a fixed key
+def hash_values(values):
+    return pd.util.hash_array(np.asarray(values, dtype=object), categorize=True)
+
+
+class DriftMonitor:
+    # Without a score table the score is not monitored until set_score_baseline is called
+    def __init__(self, baseline_table, score_table=None, window=DRIFT_WINDOW, score_model=None):
+        self.window = window
+        self.rows = 0.0
+        self._lock = threading.Lock()
+        self._buffer = []
+        # Identifies the model the score baseline belongs to
+        self.score_model = score_model
+
+        fields, values, edges, shares = baseline_columns(baseline_table)
+
+        self.categorical = {}
+        for field in CATEGORICAL_FIELDS:
+            rows = fields == field
+            vocabulary = pd.Index(values[rows])
+            self.categorical[field] = {
+                'vocabulary': vocabulary,
+                'baseline': dict(zip(vocabulary, shares[rows])),
+                # The last slot is everything outside the training vocabulary
+                'baseline_shares': np.append(shares[rows], 0.0),
+                'counts': np.zeros(len(vocabulary) + 1, dtype=np.float64),
+                'sketch': CountMinSketch(),
+                'heavy_hitters': HeavyHitters(),
+            }
+        self.numeric = {field: numeric_state(fields, edges, shares, field) for field in NUMERIC_FIELDS}
+        if score_table is not None:
+            self.numeric[SCORE_FIELD] = score_state(score_table)
+
+    # Function to compare scores with another model's baseline from now on; the score counts start
+    # over, since the scores seen so far came from the previous model. None stops monitoring the score
+    def set_score_baseline(self, score_table, score_model=None):
+        self.flush()
+        state = score_state(score_table) if score_table is not None else None
+        with self._lock:
+            self.score_model = score_model
+            if state is not None:
+                self.numeric[SCORE_FIELD] = state
+            else:
+                self.numeric.pop(SCORE_FIELD, None)
+
+    # Function to add a scored feature DataFrame to the sketches; encoded categorical columns fold
+    # unseen values into one bucket, so those are taken from the raw frame when it is given
+    def update(self, df, scores, raw=None):
+        if len(df) == 0:
+            return
+        source = raw if raw is not None else df
+        columns = {field: source[field] for field in CATEGORICAL_FIELDS}
+        columns.update({field: df[field] for field in NUMERIC_FIELDS})
+        columns[SCORE_FIELD] = scores
+        self.update_columns(columns, len(df))
+
+    # Function to buffer one scored feature dictionary, returning True once the buffer should be flushed
+    def record(self, input_data, probability_score):
+        with self._lock:
+            self._buffer.append((input_data, probability_score))
+            return len(self._buffer) >= BUFFER_ROWS
+
+    # Function to add the buffered dictionaries to the sketches in one vectorized update
+    def flush(self):
+        with self._lock:
+            buffer, self._buffer = self._buffer, []
+        self.update_records(buffer)
+
+    def update_records(self, buffer):
+        if not buffer:
+            return
+        columns = {field: [input_data[field] for input_data, _ in buffer] for field in CATEGORICAL_FIELDS + NUMERIC_FIELDS}
+        columns[SCORE_FIELD] = [probability_score for _, probability_score in buffer]
+        self.update_columns(columns, len(buffer))
+
+    def update_columns(self, columns, n):
+        # Count every distinct value of the batch once, outside the lock
+        batch = {}
+        for field in CATEGORICAL_FIELDS:
+            # Most common first, so the heavy hitters of the batch claim their slots before the tail
+            counts = pd.Series(np.asarray(columns[field], dtype=object)).astype(str).value_counts()
+            values = counts.index.to_numpy(dtype=object)
+            vocabulary = self.categorical[field]['vocabulary']
+            codes = vocabulary.get_indexer(values)
+            codes[codes < 0] = len(vocabulary)
+            batch[field] = (values, hash_values(values), counts.to_numpy(dtype=np.float64), codes)
+        # The score histogram may be replaced meanwhile, so the counts are kept with the state they were binned for
+        numeric = []
+        for field, state in list(self.numeric.items()):
+            column = np.asarray(columns[field], dtype=np.float64)
+            valid = np.isfinite(column)
+            bins = np.searchsorted(state['edges'], column[valid], side='right')
+            numeric.append((state, np.bincount(bins, minlength=len(state['counts'])), int((~valid).sum())))
+
+        with self._lock:
+            for field in CATEGORICAL_FIELDS:
+                state = self.categorical[field]
+                values, hashes, counts, codes = batch[field]
+                np.add.at(state['counts'], codes, counts)
+                state['sketch'].add(hashes, counts)
+                for value, count in zip(values.tolist(), counts.tolist()):
+                    state['heavy_hitters'].add(value, count)
+            for state, counts, missing in numeric:
+                state['counts'] += counts
+                state['missing'] += missing
+            self.rows += n
+            if self.rows > self.window:
+                self.decay(0.5)
+
+    # Function to scale every count down, so old traffic weighs less and the counts stay bounded
+    def decay(self, factor):
+        self.rows *= factor
+        for state in self.categorical.values():
+            state['counts'] *= factor
+            state['sketch'].counts *= factor
+            state['heavy_hitters'].scale(factor)
+        for state in self.numeric.values():
+            state['counts'] *= factor
+            state['missing'] *= factor
+
+    # Function to compare the sketches with the training baseline
+    def report(self, top=10):
+        self.flush()
+        with self._lock:
+            rows = self.rows
+            fields = {}
+            if rows == 0:
+                return {'rows': 0, 'fields': fields, 'drifted': []}
+            for field, state in self.categorical.items():
+                fields[field] = {
+                    'psi': psi(state['baseline_shares'], state['counts'] / rows),
+                    'unseen_rate': float(state['counts'][-1] / rows),
+                    'heavy_hitters': self.heavy_hitters(state, rows, top),
+                }
+            for field, state in self.numeric.items():
+                # A histogram with nothing counted yet, e.g. the score right after a model swap, shows no drift
+                counted = state['counts'].sum()
+                fields[field] = {
+                    'psi': psi(state['baseline_shares'], state['counts'] / counted) if counted else 0.0,
+                    'missing_rate': state['missing'] / rows,
+                    'quantiles': self.quantiles(state, [0.05, 0.5, 0.95]) if counted else None,
+                }
+
+        drifted = [
+            field for field, info in fields.items()
+            if info['psi'] > DRIFT_PSI_THRESHOLD or info.get('unseen_rate', 0.0) > DRIFT_UNSEEN_RATE
+        ]
+        return {'rows': rows, 'window': self.window, 'fields': fields, 'drifted': drifted}
+
+    # Function to list the most common values; the count-min estimate bounds the
+    # space-saving count, which overstates values that took over a slot late
+    def heavy_hitters(self, state, rows, top):
+        candidates = state['heavy_hitters'].top(HEAVY_HITTERS)
+        if not candidates or top == 0:
+            return []
+        values = [value for value, _ in candidates]
+        estimated = np.minimum(state['sketch'].estimate(hash_values(values)), [count for _, count in candidates])
+        order = np.argsort(-estimated, kind='stable')[:top]
+        return [
+            {'value': values[i], 'share': float(estimated[i] / rows), 'training_share': float(state['baseline'].get(values[i], 0.0))}
+            for i in order
+        ]
+
+    # Function to read approximate quantiles off the fixed bins, interpolating inside each bin
+    def quantiles(self, state, probabilities):
+        edges = state['edges']
+        cumulative = np.cumsum(state['counts']) / state['counts'].sum()
+        result = {}
+        for p in probabilities:
+            i = int(np.searchsorted(cumulative, p))
+            # The open first and last bins are reported at their inner edge
+            if i == 0:
+                value = edges[0]
+            elif i >= len(edges):
+                value = edges[-1]
+            else:
+                below = cumulative[i - 1]
+                fraction = (p - below) / (cumulative[i] - below) if cumulative[i] > below else 0.0
+                value = edges[i - 1] + fraction * (edges[i] - edges[i - 1])
+            result[f'p{int(p * 100)}'] = float(value)
+        return result
+
+    # Function to get flat numbers for the metrics gauges
+    def gauges(self):
+        report = self.report(top=0)
+        values = {'rows': report['rows'], 'drifted_fields': len(report['drifted'])}
+        for field, info in report['fields'].items():
+            name = re.sub(r'[^a-z0-9]+', '_', field.lower()).strip('_')
+            values[f'psi_{name}'] = float(info['psi'])
+            if 'unseen_rate' in info:
+                values[f'unseen_rate_{name}'] = info['unseen_rate']
+        return values
+
+
+# Function to load a monitor with the V8 baseline and the score baseline of a model file
+def load_drift_monitor(df=None, model_path=MODEL_PATH):
+    return DriftMonitor(load_drift_baseline(df), load_score_baseline(model_path, df))
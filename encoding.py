@@ -0,0 +1,157 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import metrics
+from artifacts import load_artifact, with_metadata
+
+# Integer-coded vocabularies for the categorical model columns
+#
+# Every categorical column is encoded against the values seen in the V8
+# workbook, so a batch carries small integer codes that share one set of
+# category strings instead of an object column per request. Values outside the
+# vocabulary go to an explicit UNKNOWN bucket and are counted in
+# encoding_unknown_total. The model never saw them either, so they score the
+# same as the original strings would.
+#
+# State + City and Source + Sub Id are looked up from the codes of their two
+# parts, so the combined strings are only formatted once, when the artifact is
+# built.
+
+ARTIFACT_NAME = 'encodings'
+
+UNKNOWN = '__unknown__'
+
+# Raw fields that are model columns as they are
+BASE_FIELDS = [
+    'AS Description',
+    'country',
+    'state',
+    'city',
+    'connection_type',
+    'coreg_path',
+    'isp',
+    'source',
+    'subid',
+]
+
+# Combined model columns and the raw fields they are built from
+PAIR_FIELDS = {
+    'State + City': ('state', 'city'),
+    'Source + Sub Id': ('source', 'subid'),
+}
+
+# Time Category labels in bin order, see utils.get_time_categories
+TIME_CATEGORIES = ['0 - 6', '6 - 12', '12 - 18', '18 - 24']
+TIME_CATEGORY_BINS = [0, 6, 12, 18]
+
+
+# Function to build the encoding artifact from the training DataFrame
+def build_encodings(df):
+    fields, values, lefts, rights = [], [], [], []
+    vocabularies = {}
+    for field in BASE_FIELDS:
+        vocabulary = pd.Index(sorted(df[field].astype(str).unique()))
+        vocabularies[field] = vocabulary
+        fields.extend([field] * len(vocabulary))
+        values.extend(vocabulary)
+        lefts.extend([None] * len(vocabulary))
+        rights.extend([None] * len(vocabulary))
+
+    for field, (left, right) in PAIR_FIELDS.items():
+        pairs = pd.DataFrame({
+            'left': vocabularies[left].get_indexer(df[left].astype(str)),
+            'right': vocabularies[right].get_indexer(df[right].astype(str)),
+        }).drop_duplicates().sort_values(['left', 'right'])
+        fields.extend([field] * len(pairs))
+        values.extend(f"{vocabularies[left][l]} - {vocabularies[right][r]}" for l, r in zip(pairs['left'], pairs['right']))
+        lefts.extend(pairs['left'].tolist())
+        rights.extend(pairs['right'].tolist())
+
+    table = pa.table({
+        'field': pa.array(fields, pa.string()).dictionary_encode(),
+        'value': pa.array(values, pa.string()),
+        'left': pa.array(lefts, pa.int32()),
+        'right': pa.array(rights, pa.int32()),
+    })
+    return with_metadata(table, rows=len(df))
+
+
+class Encoder:
+    def __init__(self, table):
+        fields = np.asarray(table.column('field').to_pylist(), dtype=object)
+        values = np.asarray(table.column('value').to_pylist(), dtype=object)
+        lefts = table.column('left').to_numpy(zero_copy_only=False)
+        rights = table.column('right').to_numpy(zero_copy_only=False)
+
+        # The last category of every dtype is the UNKNOWN bucket
+        self.vocabularies = {}
+        self.dtypes = {}
+        self.pair_keys = {}
+        for field in BASE_FIELDS + list(PAIR_FIELDS):
+            rows = fields == field
+            self.vocabularies[field] = pd.Index(values[rows])
+            self.dtypes[field] = pd.CategoricalDtype(list(values[rows]) + [UNKNOWN])
+            if field in PAIR_FIELDS:
+                # Pairs are sorted by (left, right), so their combined keys are sorted too
+                self.pair_keys[field] = self.pair_key(field, lefts[rows].astype(np.int64), rights[rows].astype(np.int64))
+        self.dtypes['Time Category'] = pd.CategoricalDtype(TIME_CATEGORIES)
+
+    # Function to combine the codes of a pair's two parts into one integer key
+    def pair_key(self, field, left_codes, right_codes):
+        right = PAIR_FIELDS[field][1]
+        return left_codes * (len(self.vocabularies[right]) + 1) + right_codes
+
+    # Function to count the values that fell in the UNKNOWN bucket
+    def count_unknown(self, field, codes):
+        unknown = int(np.count_nonzero(codes == len(self.vocabularies[field])))
+        if unknown:
+            metrics.increment('encoding_unknown_total', unknown, field=field)
+
+    # Function to encode one raw column, unseen values get the UNKNOWN code
+    def encode_field(self, field, values):
+        codes = self.vocabularies[field].get_indexer(values)
+        codes[codes < 0] = len(self.vocabularies[field])
+        self.count_unknown(field, codes)
+        return codes
+
+    # Function to encode a combined column from the codes of its parts
+    def encode_pair(self, field, left_codes, right_codes):
+        left, right = PAIR_FIELDS[field]
+        keys = self.pair_key(field, left_codes.astype(np.int64), right_codes.astype(np.int64))
+        pair_keys = self.pair_keys[field]
+        codes = np.searchsorted(pair_keys, keys)
+        found = codes < len(pair_keys)
+        found[found] = pair_keys[codes[found]] == keys[found]
+        # A pair with an unseen part is unseen as well
+        found &= (left_codes < len(self.vocabularies[left])) & (right_codes < len(self.vocabularies[right]))
+        codes[~found] = len(pair_keys)
+        self.count_unknown(field, codes)
+        return codes
+
+    # Function to wrap codes in a categorical column that shares the vocabulary strings
+    def categorical(self, field, codes):
+        return pd.Categorical.from_codes(codes, dtype=self.dtypes[field])
+
+    # Function to encode every categorical model column of a raw DataFrame
+    def encode(self, raw, hour):
+        codes = {}
+        for field in BASE_FIELDS:
+            values = raw[field]
+            if not pd.api.types.is_string_dtype(values) or values.isna().any():
+                values = values.astype(str)
+            codes[field] = self.encode_field(field, values)
+        for field, (left, right) in PAIR_FIELDS.items():
+            codes[field] = self.encode_pair(field, codes[left], codes[right])
+        codes['Time Category'] = (np.digitize(np.asarray(hour), TIME_CATEGORY_BINS) - 1) % len(TIME_CATEGORIES)
+        return {field: self.categorical(field, field_codes) for field, field_codes in codes.items()}
+
+
+# Function to load the encoding artifact
+def load_encoding_table(df=None):
+    return load_artifact(ARTIFACT_NAME, build_encodings, df=df)
+
+
+# Function to load the encoder built from the training workbook
+def load_encoder(df=None):
+    return Encoder(load_encoding_table(df))
@@ -0,0 +1,251 @@
+import math
+
+import numpy as np
+import pandas as pd
+from sklearn.compose import ColumnTransformer
+from sklearn.linear_model import LogisticRegression
+from sklearn.preprocessing import FunctionTransformer, StandardScaler, TargetEncoder
+
+# Pure-NumPy evaluation of the VotingClassifier soft vote
+#
+# Every estimator in the pickle is TargetEncoder -> StandardScaler ->
+# LogisticRegression. Target encoding, scaling and the linear model compose into
+# a per-category logit contribution plus one weight per numeric column, so a
+# member's logit is a handful of table lookups and a dot product. Identical
+# members are merged and their vote weights added together.
+#
+# The same tables give exact per-feature contributions: a member's logit is its
+# intercept plus weight * (scaled input - training mean) summed over the
+# features, so each term is that feature's share of the log-odds relative to an
+# average training lead.
+
+
+# Function to check a remainder transformer passes columns through unchanged
+def is_passthrough(transformer):
+    if transformer == 'passthrough':
+        return True
+    return isinstance(transformer, FunctionTransformer) and transformer.func is None
+
+
+# Function to fold one fitted pipeline into logit tables and numeric weights
+def extract_component(pipeline):
+    steps = [step for _, step in pipeline.steps]
+    if len(steps) != 3 or not (
+        isinstance(steps[0], ColumnTransformer)
+        and isinstance(steps[1], StandardScaler)
+        and isinstance(steps[2], LogisticRegression)
+    ):
+        raise ValueError("Only TargetEncoder -> StandardScaler -> LogisticRegression pipelines are supported")
+    column_transformer, scaler, classifier = steps
+    if len(classifier.classes_) != 2:
+        raise ValueError("Only binary classifiers are supported")
+
+    coef = classifier.coef_[0]
+    mean = scaler.mean_ if scaler.with_mean else np.zeros_like(coef)
+    scale = scaler.scale_ if scaler.with_std else np.ones_like(coef)
+    weight = coef / scale
+    bias = classifier.intercept_[0] - np.dot(weight, mean)
+
+    # weight * training mean of every scaled input; the bias already subtracts their sum
+    offset = weight * mean
+
+    categorical_columns, categories, tables, categorical_offsets = [], [], [], []
+    numeric_columns, numeric_weights, numeric_offsets = [], [], []
+    feature_names = column_transformer.feature_names_in_
+    for name, transformer, columns in column_transformer.transformers_:
+        if transformer == 'drop':
+            continue
+        output = column_transformer.output_indices_[name]
+        columns = [feature_names[c] if isinstance(c, (int, np.integer)) else c for c in columns]
+        if isinstance(transformer, TargetEncoder):
+            if transformer.target_type_ != 'binary':
+                raise ValueError("Only binary target encodings are supported")
+            for j, column in enumerate(columns):
+                # The extra last slot holds unseen categories, which TargetEncoder maps to the target mean
+                encodings = np.append(transformer.encodings_[j], transformer.target_mean_)
+                categorical_columns.append(column)
+                categories.append(np.asarray(transformer.categories_[j]))
+                tables.append(weight[output.start + j] * encodings)
+                categorical_offsets.append(offset[output.start + j])
+        elif is_passthrough(transformer):
+            numeric_columns.extend(columns)
+            numeric_weights.extend(weight[output.start:output.stop])
+            numeric_offsets.extend(offset[output.start:output.stop])
+        else:
+            raise ValueError(f"Unsupported transformer: {type(transformer).__name__}")
+
+    return {
+        'categorical_columns': categorical_columns,
+        'categories': categories,
+        'tables': tables,
+        'numeric_columns': numeric_columns,
+        'numeric_weights': np.asarray(numeric_weights, dtype=np.float64),
+        'bias': float(bias),
+        'intercept': float(classifier.intercept_[0]),
+        'categorical_offsets': np.asarray(categorical_offsets, dtype=np.float64),
+        'numeric_offsets': np.asarray(numeric_offsets, dtype=np.float64),
+    }
+
+
+# Function to check two components can be merged into one
+def same_component(a, b):
+    return (
+        a['bias'] == b['bias']
+        and np.array_equal(a['numeric_weights'], b['numeric_weights'])
+        and all(np.array_equal(x, y) for x, y in zip(a['tables'], b['tables']))
+    )
+
+
+class FastModel:
+    # Records can be passed straight to predict_proba, without building a DataFrame
+    accepts_records = True
+
+    def __init__(self, model):
+        self.classes_ = model.classes_
+        weights = model.weights if model.weights is not None else [1.0] * len(model.estimators_)
+
+        # Merge identical members; the soft vote only needs their total weight
+        components, component_weights, member_counts = [], [], []
+        for estimator, w in zip(model.estimators_, weights):
+            if w is None:
+                continue
+            component = extract_component(estimator)
+            for i, existing in enumerate(components):
+                if same_component(existing, component):
+                    component_weights[i] += w
+                    member_counts[i] += 1
+                    break
+            else:
+                components.append(component)
+                component_weights.append(float(w))
+                member_counts.append(1)
+
+        first = components[0]
+        for component in components[1:]:
+            if component['categorical_columns'] != first['categorical_columns'] \
+                    or component['numeric_columns'] != first['numeric_columns'] \
+                    or not all(np.array_equal(a, b) for a, b in zip(component['categories'], first['categories'])):
+                raise ValueError("All ensemble members must share the same feature encoding")
+
+        self.categorical_columns = first['categorical_columns']
+        self.numeric_columns = first['numeric_columns']
+        self.categories = first['categories']
+        self.code_maps = [{value: i for i, value in enumerate(c)} for c in self.categories]
+        # get_indexer maps values outside the training categories to -1
+        self.category_indexes = [pd.Index(c) for c in self.categories]
+        self._remaps = {}
+
+        # tables[j] has shape (components, categories + 1), weights has shape (numeric columns, components)
+        self.tables = [np.stack([c['tables'][j] for c in components]) for j in range(len(self.categorical_columns))]
+        self.numeric_weights = np.stack([c['numeric_weights'] for c in components], axis=1)
+        self.bias = np.array([c['bias'] for c in components])
+        self.vote_weights = np.asarray(component_weights) / np.sum(component_weights)
+        self.member_counts = member_counts
+
+        # Terms of the explanation: logit = intercept + sum(table - offset) + sum(weight * x - offset)
+        self.intercepts = np.array([c['intercept'] for c in components])
+        self.categorical_offsets = np.stack([c['categorical_offsets'] for c in components], axis=1)
+        self.numeric_offsets = np.stack([c['numeric_offsets'] for c in components], axis=1)
+        self.feature_names = self.categorical_columns + self.numeric_columns
+
+    # Function to map the codes of a categorical dtype (e.g. from encoding.Encoder) to table slots
+    def category_remap(self, j, dtype):
+        cached = self._remaps.get(j)
+        if cached is not None and cached[0] is dtype:
+            return cached[1]
+        slots = self.category_indexes[j].get_indexer(dtype.categories)
+        # The extra last entry takes code -1 (missing), everything unseen goes to the unknown slot
+        remap = np.append(np.where(slots < 0, len(self.categories[j]), slots), len(self.categories[j])).astype(np.intp)
+        self._remaps[j] = (dtype, remap)
+        return remap
+
+    # Function to turn a feature DataFrame into category codes and a numeric matrix
+    def encode(self, df):
+        codes = np.empty((len(df), len(self.categorical_columns)), dtype=np.intp)
+        for j, column in enumerate(self.categorical_columns):
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                # Already integer coded, only the code numbering differs
+                codes[:, j] = self.category_remap(j, df[column].dtype)[df[column].cat.codes.to_numpy()]
+                continue
+            column_codes = self.category_indexes[j].get_indexer(df[column])
+            codes[:, j] = np.where(column_codes < 0, len(self.categories[j]), column_codes)
+        numeric = df[self.numeric_columns].to_numpy(dtype=np.float64)
+        return codes, numeric
+
+    # Function to encode feature dictionaries without going through pandas
+    def encode_records(self, records):
+        codes = np.array([
+            [code_map.get(record[column], len(code_map)) for column, code_map in zip(self.categorical_columns, self.code_maps)]
+            for record in records
+        ], dtype=np.intp).reshape(len(records), len(self.categorical_columns))
+        numeric = np.array([
+            [record[column] for column in self.numeric_columns] for record in records
+        ], dtype=np.float64).reshape(len(records), len(self.numeric_columns))
+        return codes, numeric
+
+    # Function to compute every member's logit, shape (rows, components)
+    def logits(self, codes, numeric):
+        z = numeric @ self.numeric_weights + self.bias
+        for j, table in enumerate(self.tables):
+            z += table[:, codes[:, j]].T
+        return z
+
+    # Function to run the soft vote on pre-encoded arrays
+    def predict_proba_encoded(self, codes, numeric):
+        p1 = (1.0 / (1.0 + np.exp(-self.logits(codes, numeric)))) @ self.vote_weights
+        return np.column_stack([1.0 - p1, p1])
+
+    def predict_proba(self, X):
+        return self.predict_proba_encoded(*self.encode_any(X))
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+    # Function to encode a DataFrame or a list of feature dictionaries
+    def encode_any(self, X):
+        if isinstance(X, pd.DataFrame):
+            return self.encode(X)
+        return self.encode_records(X)
+
+    # Function to get each merged member's probability of class 1 on pre-encoded arrays
+    def member_proba_encoded(self, codes, numeric, k):
+        z = numeric @ self.numeric_weights[:, k] + self.bias[k]
+        for j, table in enumerate(self.tables):
+            z += table[k, codes[:, j]]
+        return 1.0 / (1.0 + np.exp(-z))
+
+    # Function to get the soft-vote members as (vote weight, function scoring a subset of rows, members merged
+    # into it), for scoring.decide
+    def vote_members(self, X):
+        codes, numeric = self.encode_any(X)
+        return [
+            (self.vote_weights[k], lambda rows, k=k: self.member_proba_encoded(codes[rows], numeric[rows], k),
+             self.member_counts[k])
+            for k in range(len(self.vote_weights))
+        ]
+
+    # Function to get per-feature log-odds contributions, shape (rows, features) in feature_names order
+    # Each member's contributions are exact; members are combined with the vote weights, so with
+    # several distinct members the sum is the weighted mean logit rather than the logit of the vote
+    def explain(self, X):
+        codes, numeric = self.encode_any(X)
+        n_categorical = len(self.categorical_columns)
+        terms = np.empty((len(codes), len(self.feature_names), len(self.vote_weights)))
+        for j, table in enumerate(self.tables):
+            terms[:, j, :] = table[:, codes[:, j]].T - self.categorical_offsets[j]
+        terms[:, n_categorical:, :] = numeric[:, :, None] * self.numeric_weights[None] - self.numeric_offsets[None]
+        contributions = terms @ self.vote_weights
+        base_value = float(self.intercepts @ self.vote_weights)
+        return contributions, base_value
+
+    # Function to score one feature dictionary in plain Python, for single pre-ping leads
+    def predict_proba_one(self, input_data):
+        p1 = 0.0
+        for k, vote_weight in enumerate(self.vote_weights):
+            z = self.bias[k]
+            for j, (column, code_map) in enumerate(zip(self.categorical_columns, self.code_maps)):
+                z += self.tables[j][k, code_map.get(input_data[column], len(code_map))]
+            for i, column in enumerate(self.numeric_columns):
+                z += self.numeric_weights[i, k] * input_data[column]
+            p1 += vote_weight / (1.0 + math.exp(-z))
+        return p1
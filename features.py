@@ -0,0 +1,83 @@
+import pandas as pd
+
+import metrics
+from utils import FEATURE_COLUMNS, get_time_categories, numerize_ips
+
+# Fields every raw API record must contain (see Data Fields in pages/🔥_API_Demo.py)
+RAW_FIELDS = [
+    "Timestamp",
+    "AS Description",
+    "country",
+    "state",
+    "city",
+    "postalcode",
+    "connection_type",
+    "coreg_path",
+    "isp",
+    "Male/Female",
+    "source",
+    "subid",
+    "Age",
+    "Latitude (generated)",
+    "Longitude (generated)",
+    "IP Address",
+]
+
+# Fields documented as String, which file readers must not turn into numbers (e.g. subid "1006")
+STRING_FIELDS = [
+    "Timestamp",
+    "AS Description",
+    "country",
+    "state",
+    "city",
+    "connection_type",
+    "coreg_path",
+    "isp",
+    "source",
+    "subid",
+    "IP Address",
+]
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+# Function to turn a list of raw API records into a raw DataFrame
+def records_to_frame(data_list):
+    return pd.DataFrame.from_records(data_list)
+
+
+# Function to build the model features from raw records with whole-column operations
+# With an encoding.Encoder the categorical columns come back as integer-coded categoricals
+def build_features(raw, encoder=None):
+    missing = [field for field in RAW_FIELDS if field not in raw.columns]
+    if missing:
+        raise KeyError(missing[0])
+
+    # Compute derived fields
+    with metrics.timer('parse_timestamp'):
+        timestamps = pd.to_datetime(raw['Timestamp'], format=TIMESTAMP_FORMAT)
+        if timestamps.isna().any():
+            raise ValueError("Timestamp is required for every record")
+        hour = timestamps.dt.hour.to_numpy()
+
+    if encoder is not None:
+        with metrics.timer('encode_categories'):
+            features = pd.DataFrame(encoder.encode(raw, hour), index=raw.index)
+        for column in FEATURE_COLUMNS:
+            if column in raw.columns and column not in features.columns:
+                features[column] = raw[column]
+        features['Hour'] = hour
+        with metrics.timer('numerize_ip'):
+            features['IP Address Numerized'] = numerize_ips(raw['IP Address'].to_numpy())
+        return features[FEATURE_COLUMNS]
+
+    with metrics.timer('derived_fields'):
+        features = raw[[column for column in FEATURE_COLUMNS if column in raw.columns]].copy()
+        features['State + City'] = raw['state'].astype(str) + ' - ' + raw['city'].astype(str)
+        features['Source + Sub Id'] = raw['source'].astype(str) + ' - ' + raw['subid'].astype(str)
+        features['Hour'] = hour
+        features['Time Category'] = get_time_categories(hour)
+
+    with metrics.timer('numerize_ip'):
+        features['IP Address Numerized'] = numerize_ips(raw['IP Address'].to_numpy())
+    return features[FEATURE_COLUMNS]
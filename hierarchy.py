@@ -0,0 +1,79 @@
+import pyarrow as pa
+
+from artifacts import load_artifact, with_metadata
+
+# Parent -> child indexes of the form fields, for cascading selectors
+#
+# Each child field only offers the values seen with the selected parent in the
+# V8 workbook (e.g. the cities of one state), most common first, so the form
+# ships a few dozen options instead of every unique value. LOCATION_ARTIFACT
+# holds the most common postal code and coordinates of every state + city.
+
+ARTIFACT_NAME = 'hierarchy'
+LOCATION_ARTIFACT_NAME = 'locations'
+
+# Child field -> parent field
+PARENTS = {
+    'state': 'country',
+    'city': 'state',
+    'subid': 'source',
+    'AS Description': 'isp',
+}
+
+LOCATION_FIELDS = ['postalcode', 'Latitude (generated)', 'Longitude (generated)']
+
+
+# Function to build the parent -> child artifact from the training DataFrame
+def build_hierarchy(df):
+    fields, parents, values, counts = [], [], [], []
+    for child, parent in PARENTS.items():
+        pairs = df[[parent, child]].astype(str).value_counts(sort=False).rename('count').reset_index()
+        pairs = pairs.sort_values([parent, 'count', child], ascending=[True, False, True])
+        fields.extend([child] * len(pairs))
+        parents.extend(pairs[parent].tolist())
+        values.extend(pairs[child].tolist())
+        counts.extend(pairs['count'].tolist())
+
+    table = pa.table({
+        'field': pa.array(fields, pa.string()).dictionary_encode(),
+        'parent': pa.array(parents, pa.string()),
+        'value': pa.array(values, pa.string()),
+        'count': pa.array(counts, pa.int64()),
+    })
+    return with_metadata(table, rows=len(df))
+
+
+# Function to build the state + city -> postal code and coordinates artifact
+def build_locations(df):
+    locations = df[['state', 'city'] + LOCATION_FIELDS].copy()
+    locations['state'] = locations['state'].astype(str)
+    locations['city'] = locations['city'].astype(str)
+    # Most common postal code of each city, with the coordinates seen alongside it
+    locations = locations.groupby(['state', 'city'] + LOCATION_FIELDS).size().rename('count').reset_index()
+    locations = locations.sort_values(['state', 'city', 'count'], ascending=[True, True, False])
+    locations = locations.drop_duplicates(['state', 'city'])
+
+    table = pa.table({
+        'state': pa.array(locations['state'].tolist(), pa.string()),
+        'city': pa.array(locations['city'].tolist(), pa.string()),
+        'postalcode': pa.array(locations['postalcode'].tolist(), pa.int64()),
+        'Latitude (generated)': pa.array(locations['Latitude (generated)'].tolist(), pa.float64()),
+        'Longitude (generated)': pa.array(locations['Longitude (generated)'].tolist(), pa.float64()),
+    })
+    return with_metadata(table, rows=len(df))
+
+
+# Function to load the child options of every parent value, keyed by child field
+def load_hierarchy():
+    table = load_artifact(ARTIFACT_NAME, build_hierarchy)
+    hierarchy = {child: {} for child in PARENTS}
+    for field, parent, value in zip(*(table.column(name).to_pylist() for name in ['field', 'parent', 'value'])):
+        hierarchy[field].setdefault(parent, []).append(value)
+    return hierarchy
+
+
+# Function to load the postal code and coordinates of every (state, city)
+def load_locations():
+    table = load_artifact(LOCATION_ARTIFACT_NAME, build_locations)
+    columns = [table.column(name).to_pylist() for name in ['state', 'city'] + LOCATION_FIELDS]
+    return {(state, city): dict(zip(LOCATION_FIELDS, values)) for state, city, *values in zip(*columns)}
@@ -0,0 +1,197 @@
+import bisect
+import ipaddress
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+import metrics
+from artifacts import load_artifact, with_metadata
+from utils import IPV4_PATTERN, numerize_ips
+
+# Offline IP-range index that fills in the network fields of a lead from its IP
+#
+# The V8 workbook maps every /24 network it has seen to the most common
+# AS Description, isp and connection_type of its leads. Neighbouring networks
+# with the same values are merged into one range. An optional local range file
+# (IP_RANGE_FILE, a CSV with start, end, AS Description, isp and
+# connection_type columns; start and end inclusive, dotted or integer) is
+# searched first. Ranges are held as sorted NumPy arrays, so a whole batch is
+# one searchsorted call. Every range is IPv4; IPv6 addresses always miss, even
+# those whose integer value is small enough to fall inside an IPv4 range.
+#
+# Only missing (null) fields are filled. IPs outside every range get
+# MISSING_VALUE and are counted in ip_index_misses_total. The workbook uses
+# 'unknown' for isp and connection_type when enrichment found nothing; it has
+# no such value for AS Description, where 'unknown' is simply a category the
+# model never saw and scores like any other new AS Description.
+
+ARTIFACT_NAME = 'ip_ranges'
+
+NETWORK_FIELDS = ['AS Description', 'isp', 'connection_type']
+MISSING_VALUE = 'unknown'
+
+IP_RANGE_FILE = os.environ.get('IP_RANGE_FILE')
+
+
+# Function to build the /24 range artifact from the training DataFrame
+def build_ip_ranges(df):
+    blocks = pd.DataFrame({'block': df['IP Address Numerized'].to_numpy(dtype=np.int64) >> 8})
+    for field in NETWORK_FIELDS:
+        # Most common value of each /24, ties go to the value that sorts first
+        counts = df.groupby([blocks['block'], df[field].astype(str)]).size().rename('n').reset_index()
+        counts = counts.sort_values(['block', 'n', field], ascending=[True, False, True])
+        blocks = blocks.merge(counts.drop_duplicates('block')[['block', field]], on='block', how='left')
+    blocks = blocks.drop_duplicates('block').sort_values('block').reset_index(drop=True)
+
+    # Merge runs of adjacent /24 networks with the same values into one range
+    block = blocks['block'].to_numpy()
+    same = (np.diff(block) == 1)
+    for field in NETWORK_FIELDS:
+        values = blocks[field].to_numpy()
+        same &= values[1:] == values[:-1]
+    first = np.concatenate([[True], ~same])
+    last = np.concatenate([~same, [True]])
+
+    table = pa.table({
+        'start': pa.array(block[first] << 8, pa.int64()),
+        'end': pa.array((block[last] + 1) << 8, pa.int64()),
+        **{field: pa.array(blocks.loc[first, field].tolist(), pa.string()).dictionary_encode() for field in NETWORK_FIELDS},
+    })
+    return with_metadata(table, rows=len(df))
+
+
+# Function to read a local range file into the same layout as the artifact
+def read_range_file(path):
+    ranges = pd.read_csv(path, dtype={field: str for field in NETWORK_FIELDS})
+    bounds = {}
+    for column in ['start', 'end']:
+        if pd.api.types.is_integer_dtype(ranges[column]):
+            bounds[column] = ranges[column].to_numpy(dtype=np.int64)
+        else:
+            bounds[column] = np.asarray(numerize_ips(ranges[column].astype(str).to_numpy()), dtype=np.int64)
+    return pa.table({
+        'start': pa.array(bounds['start'], pa.int64()),
+        'end': pa.array(bounds['end'] + 1, pa.int64()),
+        **{field: pa.array(ranges[field].tolist(), pa.string()).dictionary_encode() for field in NETWORK_FIELDS},
+    })
+
+
+class IpRanges:
+    # One sorted set of half-open [start, end) ranges with dictionary-coded values
+    def __init__(self, table):
+        order = np.argsort(table.column('start').to_numpy(), kind='stable')
+        self.starts = table.column('start').to_numpy()[order]
+        self.ends = table.column('end').to_numpy()[order]
+        self.codes, self.values = {}, {}
+        for field in NETWORK_FIELDS:
+            column = table.column(field).combine_chunks()
+            if not pa.types.is_dictionary(column.type):
+                column = column.dictionary_encode()
+            self.codes[field] = column.indices.to_numpy(zero_copy_only=False)[order]
+            self.values[field] = np.asarray(column.dictionary.to_pylist(), dtype=object)
+        self.start_list = self.starts.tolist()
+        self.end_list = self.ends.tolist()
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Function to find the range of every IP integer, -1 where none covers it
+    def find(self, ips):
+        positions = np.searchsorted(self.starts, ips, side='right') - 1
+        hit = positions >= 0
+        hit[hit] = ips[hit] < self.ends[positions[hit]]
+        positions[~hit] = -1
+        return positions
+
+    # Function to find the range of one IP integer without NumPy overhead
+    def find_one(self, ip):
+        position = bisect.bisect_right(self.start_list, ip) - 1
+        if position >= 0 and ip < self.end_list[position]:
+            return position
+        return -1
+
+    def value(self, field, position):
+        return self.values[field][self.codes[field][position]]
+
+
+class IpIndex:
+    # Range sets searched in order, the first one covering an IP wins
+    def __init__(self, layers):
+        self.layers = [layer for layer in layers if len(layer)]
+
+    # Function to look up the network fields of an array of IP integers, None where no range covers them
+    # is_ipv4 tells the address families apart, which the integers alone cannot
+    def lookup(self, ips, is_ipv4):
+        ips = np.asarray(ips)
+        found = {field: np.full(len(ips), None, dtype=object) for field in NETWORK_FIELDS}
+        pending = np.flatnonzero(is_ipv4)
+        pending_ips = ips[pending].astype(np.int64)
+        for layer in self.layers:
+            if not len(pending):
+                break
+            positions = layer.find(pending_ips)
+            hit = positions >= 0
+            for field in NETWORK_FIELDS:
+                found[field][pending[hit]] = layer.values[field][layer.codes[field][positions[hit]]]
+            pending, pending_ips = pending[~hit], pending_ips[~hit]
+        return found
+
+    # Function to look up the network fields of one IP integer of the given version (4 or 6)
+    def lookup_one(self, ip, version):
+        if version == 4:
+            for layer in self.layers:
+                position = layer.find_one(ip)
+                if position >= 0:
+                    return {field: layer.value(field, position) for field in NETWORK_FIELDS}
+        return None
+
+
+# Function to fill the missing network fields of a raw DataFrame from its IP addresses
+def fill_network_fields(raw, ip_index):
+    missing = np.zeros(len(raw), dtype=bool)
+    for field in NETWORK_FIELDS:
+        if field not in raw.columns:
+            raw[field] = None
+        missing |= raw[field].isna().to_numpy()
+    if not missing.any():
+        return raw
+
+    with metrics.timer('ip_lookup'):
+        rows = np.flatnonzero(missing)
+        addresses = pd.Series(raw['IP Address'].to_numpy()[rows], dtype=object).astype(str)
+        found = ip_index.lookup(numerize_ips(addresses.to_numpy()), addresses.str.match(IPV4_PATTERN).to_numpy(dtype=bool))
+        misses = int(np.count_nonzero(pd.isna(found[NETWORK_FIELDS[0]])))
+        if misses:
+            metrics.increment('ip_index_misses_total', misses)
+        for field in NETWORK_FIELDS:
+            values = raw[field].to_numpy(dtype=object, na_value=None)
+            fill = pd.isna(values[rows])
+            values[rows[fill]] = np.where(pd.isna(found[field][fill]), MISSING_VALUE, found[field][fill])
+            raw[field] = values
+    return raw
+
+
+# Function to fill the missing network fields of one raw record from its IP address
+def fill_record_network_fields(data, ip_index):
+    if all(data.get(field) is not None for field in NETWORK_FIELDS):
+        return data
+    address = ipaddress.ip_address(data['IP Address'])
+    found = ip_index.lookup_one(int(address), address.version)
+    if found is None:
+        metrics.increment('ip_index_misses_total')
+    data = dict(data)
+    for field in NETWORK_FIELDS:
+        if data.get(field) is None:
+            data[field] = found[field] if found is not None else MISSING_VALUE
+    return data
+
+
+# Function to load the IP index, with the local range file ahead of the workbook ranges
+def load_ip_index(range_file=IP_RANGE_FILE, df=None):
+    layers = []
+    if range_file:
+        layers.append(IpRanges(read_range_file(range_file)))
+    layers.append(IpRanges(load_artifact(ARTIFACT_NAME, build_ip_ranges, df=df)))
+    return IpIndex(layers)
@@ -0,0 +1,210 @@
+import bisect
+import cProfile
+import json
+import os
+import random
+import threading
+import time
+
+# Low-overhead in-process metrics for the scoring path
+#
+# Stages are timed with `with timer('model'):` and recorded in fixed-bucket
+# histograms, so recording is a bisect and three additions. render() returns the
+# Prometheus text format for the /metrics endpoint and dump() a JSON-friendly
+# dict. Every process keeps its own registry, so with several API workers each
+# scrape reports the worker that answered it.
+#
+# Setting PROFILE_SAMPLE_RATE (e.g. 0.01) runs that fraction of profiled()
+# blocks under cProfile and writes the stats to PROFILE_DIR for hot-path analysis.
+
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    # Function to get cumulative bucket counts, as in the Prometheus format
+    def cumulative(self):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        cumulative, running = [], 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+            running += bucket_count
+            cumulative.append((bound, running))
+        return cumulative, total, count
+
+
+_histograms = {}
+_counters = {}
+_gauges = {}
+_lock = threading.Lock()
+
+
+# Function to turn keyword labels into a hashable, ordered key
+def label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+# Function to get or create a histogram
+def histogram(name, buckets=LATENCY_BUCKETS, **labels):
+    key = (name, label_key(labels))
+    hist = _histograms.get(key)
+    if hist is None:
+        with _lock:
+            hist = _histograms.setdefault(key, Histogram(buckets))
+    return hist
+
+
+def observe(name, value, buckets=LATENCY_BUCKETS, **labels):
+    histogram(name, buckets, **labels).observe(value)
+
+
+def increment(name, amount=1, **labels):
+    key = (name, label_key(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+# Function to register a callback whose dict of numbers is reported at render time
+def register_gauges(name, callback):
+    _gauges[name] = callback
+
+
+class timer:
+    # Records the wall time of the block in the scoring_stage_seconds histogram
+    def __init__(self, stage):
+        self.hist = histogram('scoring_stage_seconds', stage=stage)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.hist.observe(time.perf_counter() - self.start)
+        return False
+
+
+def observe_batch_size(size):
+    observe('scoring_batch_size', size, BATCH_SIZE_BUCKETS)
+
+
+def count_error(kind):
+    increment('scoring_errors_total', kind=kind)
+
+
+class profiled:
+    # Runs a sampled fraction of blocks under cProfile and writes the stats to PROFILE_DIR
+    def __init__(self, name, sample_rate=None):
+        self.name = name
+        self.sample_rate = PROFILE_SAMPLE_RATE if sample_rate is None else sample_rate
+        self.profiler = None
+
+    def __enter__(self):
+        if self.sample_rate > 0 and random.random() < self.sample_rate:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.profiler is not None:
+            self.profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            path = os.path.join(PROFILE_DIR, f'{self.name}-{os.getpid()}-{time.time_ns()}.prof')
+            self.profiler.dump_stats(path)
+        return False
+
+
+# Function to format labels for the Prometheus text format
+def format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+# Function to render every metric in the Prometheus text exposition format
+def render():
+    lines = []
+    typed = set()
+    for (name, labels), hist in sorted(_histograms.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {name} histogram')
+            typed.add(name)
+        cumulative, total, count = hist.cumulative()
+        for bound, running in cumulative:
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{name}_bucket{format_labels(labels, [("le", le)])} {running}')
+        lines.append(f'{name}_sum{format_labels(labels)} {total}')
+        lines.append(f'{name}_count{format_labels(labels)} {count}')
+    for (name, labels), value in sorted(_counters.items()):
+        if name not in typed:
+            lines.append(f'# TYPE {name} counter')
+            typed.add(name)
+        lines.append(f'{name}{format_labels(labels)} {value}')
+    for name, callback in sorted(_gauges.items()):
+        for key, value in callback().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f'# TYPE {name}_{key} gauge')
+                lines.append(f'{name}_{key} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+# Function to dump every metric as a dict, e.g. for st.json or a file
+def dump():
+    histograms = {}
+    for (name, labels), hist in _histograms.items():
+        cumulative, total, count = hist.cumulative()
+        histograms.setdefault(name, []).append({
+            'labels': dict(labels),
+            'count': count,
+            'sum': total,
+            'buckets': [[bound if bound != float('inf') else '+Inf', running] for bound, running in cumulative],
+        })
+    counters = {}
+    for (name, labels), value in _counters.items():
+        counters.setdefault(name, []).append({'labels': dict(labels), 'value': value})
+    gauges = {name: callback() for name, callback in _gauges.items()}
+    return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+
+# Function to write the dump to a JSON file
+def dump_to_file(path):
+    with open(path, 'w') as f:
+        json.dump(dump(), f, indent=2)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+# A forked child (e.g. a batch_score.py worker) may inherit a lock another thread was holding
+def _reinit_locks_after_fork():
+    global _lock
+    _lock = threading.Lock()
+    for hist in list(_histograms.values()):
+        hist._lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reinit_locks_after_fork)
@@ -0,0 +1,97 @@
+import asyncio
+import os
+import time
+
+from fastapi.concurrency import run_in_threadpool
+
+import metrics
+
+# Coalesces concurrent single-record requests into one model call
+#
+# Each request awaits submit(item). A collector task takes the first queued
+# item, adds whatever else is already waiting and then keeps collecting until
+# the batch holds MICROBATCH_MAX_SIZE items or MICROBATCH_MAX_DELAY_MS has
+# passed since the first one. The batch is scored in the thread pool with one
+# call to score_many and every caller gets its own result back. While a batch
+# is being scored the next one fills up, so under load batches grow on their
+# own and the delay window only matters when traffic is light.
+#
+# Batch sizes go to microbatch_size and the time each item waited before its
+# batch started to microbatch_queue_seconds.
+
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', '64'))
+MICROBATCH_MAX_DELAY_MS = float(os.environ.get('MICROBATCH_MAX_DELAY_MS', '2'))
+
+
+class MicroBatcher:
+    def __init__(self, score_many, max_batch_size=MICROBATCH_MAX_SIZE, max_delay_ms=MICROBATCH_MAX_DELAY_MS):
+        # score_many(items) returns one result per item, in order
+        self.score_many = score_many
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay_ms / 1000
+        self._queue = None
+        self._task = None
+
+    # Function to score one item as part of the next batch
+    async def submit(self, item):
+        if self._task is None:
+            # Created lazily so the queue and the task belong to the running event loop
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((item, future, time.perf_counter()))
+        return await future
+
+    # Function to collect one batch, waiting at most max_delay after its first item
+    async def collect(self):
+        batch = [await self._queue.get()]
+        deadline = batch[0][2] + self.max_delay
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def run(self):
+        queue_hist = metrics.histogram('microbatch_queue_seconds')
+        while True:
+            batch = await self.collect()
+            start = time.perf_counter()
+            for _, _, enqueued in batch:
+                queue_hist.observe(start - enqueued)
+            metrics.observe('microbatch_size', len(batch), metrics.BATCH_SIZE_BUCKETS)
+
+            try:
+                results = await run_in_threadpool(self.score_many, [item for item, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                # A caller that disconnected has a cancelled future
+                if not future.done():
+                    future.set_result(result)
+
+    # Function to stop the collector, failing anything still queued
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        while not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Service is shutting down"))
+        self._task = None
+        self._queue = None
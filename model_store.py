@@ -0,0 +1,127 @@
+import os
+import resource
+import threading
+import time
+
+import joblib
+
+# Process-wide model cache shared by the Streamlit pages, the API and the batch tools
+#
+# Streamlit re-executes page scripts on every interaction but imports modules
+# only once per process, so a model kept here is deserialized a single time and
+# shared by every page and session. NumPy arrays are memory-mapped from the
+# pickle, which lets worker processes share those pages through the OS cache.
+
+MODEL_PATH = 'model/Supermodel API Pre-Ping.pkl'
+# onnxruntime intra-op threads for the 'onnx' backend, 0 lets onnxruntime use every core
+ONNX_INTRA_OP_THREADS = int(os.environ.get('ONNX_INTRA_OP_THREADS', '0'))
+
+_models = {}
+_lock = threading.Lock()
+
+
+# Function to identify a model file, so a replaced artifact is loaded again
+def model_signature(path=MODEL_PATH):
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+# Function to get the resident set size of this process in bytes
+def resident_size():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # ru_maxrss is the peak, in kilobytes on Linux and bytes on macOS
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Function to load a file once per process and record how long it took and how much memory it used
+def load_cached(path, loader, **stats):
+    signature = model_signature(path)
+    entry = _models.get(signature[0])
+    if entry is not None and entry['signature'] == signature:
+        return entry['model']
+
+    with _lock:
+        entry = _models.get(signature[0])
+        if entry is not None and entry['signature'] == signature:
+            return entry['model']
+
+        rss_before = resident_size()
+        start = time.perf_counter()
+        model = loader(path)
+        load_seconds = time.perf_counter() - start
+
+        _models[signature[0]] = {
+            'model': model,
+            'signature': signature,
+            'backends': {},
+            'stats': {
+                'path': path,
+                'file_bytes': signature[2],
+                'load_seconds': load_seconds,
+                'resident_bytes': resident_size(),
+                'resident_delta_bytes': resident_size() - rss_before,
+                **stats,
+            },
+        }
+        return model
+
+
+# Function to load the model once per process, memory-mapping its arrays when possible
+def load_model(path=MODEL_PATH, mmap=True):
+    return load_cached(path, lambda p: joblib.load(p, mmap_mode='r' if mmap else None), memory_mapped=mmap)
+
+
+# Function to find the file a backend scores from; the ONNX export sits next to the pickle
+def backend_path(backend='sklearn', path=MODEL_PATH):
+    if backend == 'onnx':
+        return os.path.splitext(path)[0] + '.onnx'
+    return path
+
+
+# Function to load the ONNX export of a model, without unpickling the sklearn objects
+def load_onnx_model(path, intra_op_threads=ONNX_INTRA_OP_THREADS):
+    from onnx_model import OnnxModel
+    return load_cached(path, lambda p: OnnxModel(p, intra_op_threads), intra_op_threads=intra_op_threads)
+
+
+# Function to get a scoring backend: 'sklearn', 'numpy' (fast_model.py) or 'onnx' (onnx_model.py)
+def load_backend(backend='sklearn', path=MODEL_PATH):
+    if backend == 'onnx':
+        return load_onnx_model(backend_path(backend, path))
+
+    model = load_model(path)
+    if backend == 'sklearn':
+        return model
+
+    entry = _models[os.path.abspath(path)]
+    with _lock:
+        if backend not in entry['backends']:
+            if backend == 'numpy':
+                from fast_model import FastModel
+                entry['backends'][backend] = FastModel(model)
+            else:
+                raise ValueError(f"Unknown scoring backend: {backend}")
+        return entry['backends'][backend]
+
+
+# Function to report load time and resident size of a loaded model
+def model_stats(path=MODEL_PATH):
+    entry = _models.get(os.path.abspath(path))
+    if entry is None:
+        return None
+    return dict(entry['stats'])
+
+
+# Function to drop one cached model, e.g. an old version after a hot swap
+def evict_model(path):
+    with _lock:
+        return _models.pop(os.path.abspath(path), None) is not None
+
+
+# Function to drop cached models, e.g. after swapping the artifact on disk
+def clear_models():
+    with _lock:
+        _models.clear()
@@ -0,0 +1,132 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# ONNX export of the VotingClassifier and an onnxruntime scoring backend
+#
+#   python onnx_model.py --output "model/Supermodel API Pre-Ping.onnx"
+#
+# The graph takes the 19 engineered columns (one string tensor per categorical
+# column and one double tensor per numeric column) and contains the target
+# encoding, scaling, every logistic regression and the soft vote. It is built
+# from the tables extracted by fast_model.py, so the scoring processes only need
+# onnxruntime and never unpickle the sklearn objects.
+
+MODEL_PATH = 'model/Supermodel API Pre-Ping.pkl'
+ONNX_PATH = 'model/Supermodel API Pre-Ping.onnx'
+# IR version 8 goes with opset 17 and keeps the graph loadable by older onnxruntime releases
+IR_VERSION = 8
+OPSET = 17
+ML_OPSET = 2
+
+
+# Function to convert the fitted ensemble into an ONNX model
+def export_onnx(model, output=ONNX_PATH):
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    from fast_model import FastModel
+
+    fast_model = FastModel(model)
+    n_components = len(fast_model.bias)
+
+    inputs, nodes, initializers = [], [], []
+    contributions = []
+    for j, column in enumerate(fast_model.categorical_columns):
+        inputs.append(helper.make_tensor_value_info(column, TensorProto.STRING, [None]))
+        categories = [str(value) for value in fast_model.categories[j]]
+        # Unseen strings get the extra last code, which holds the target-mean contribution
+        nodes.append(helper.make_node(
+            'LabelEncoder', [column], [f'code_{j}'], domain='ai.onnx.ml',
+            keys_strings=categories, values_int64s=list(range(len(categories))), default_int64=len(categories),
+        ))
+        initializers.append(numpy_helper.from_array(np.ascontiguousarray(fast_model.tables[j].T), f'table_{j}'))
+        nodes.append(helper.make_node('Gather', [f'table_{j}', f'code_{j}'], [f'contribution_{j}'], axis=0))
+        contributions.append(f'contribution_{j}')
+
+    for column in fast_model.numeric_columns:
+        inputs.append(helper.make_tensor_value_info(column, TensorProto.DOUBLE, [None]))
+    nodes.append(helper.make_node('Concat', fast_model.numeric_columns, ['numeric'], axis=0))
+    initializers.append(numpy_helper.from_array(np.array([len(fast_model.numeric_columns), -1], dtype=np.int64), 'numeric_shape'))
+    nodes.append(helper.make_node('Reshape', ['numeric', 'numeric_shape'], ['numeric_by_column']))
+    nodes.append(helper.make_node('Transpose', ['numeric_by_column'], ['numeric_rows'], perm=[1, 0]))
+
+    initializers.append(numpy_helper.from_array(np.ascontiguousarray(fast_model.numeric_weights), 'numeric_weights'))
+    initializers.append(numpy_helper.from_array(fast_model.bias, 'bias'))
+    nodes.append(helper.make_node('MatMul', ['numeric_rows', 'numeric_weights'], ['numeric_logit']))
+    nodes.append(helper.make_node('Sum', ['numeric_logit', 'bias'] + contributions, ['logit']))
+    nodes.append(helper.make_node('Sigmoid', ['logit'], ['member_proba']))
+
+    # Soft vote, then stack [P(0), P(1)] like predict_proba
+    initializers.append(numpy_helper.from_array(fast_model.vote_weights.reshape(n_components, 1), 'vote_weights'))
+    initializers.append(numpy_helper.from_array(np.array(1.0), 'one'))
+    nodes.append(helper.make_node('MatMul', ['member_proba', 'vote_weights'], ['proba_1']))
+    nodes.append(helper.make_node('Sub', ['one', 'proba_1'], ['proba_0']))
+    nodes.append(helper.make_node('Concat', ['proba_0', 'proba_1'], ['probabilities'], axis=1))
+
+    outputs = [helper.make_tensor_value_info('probabilities', TensorProto.DOUBLE, [None, 2])]
+    graph = helper.make_graph(nodes, 'propensity_voting_classifier', inputs, outputs, initializers)
+    onnx_model = helper.make_model(graph, ir_version=IR_VERSION, opset_imports=[
+        helper.make_opsetid('', OPSET),
+        helper.make_opsetid('ai.onnx.ml', ML_OPSET),
+    ])
+    helper.set_model_props(onnx_model, {
+        'classes': ','.join(str(c) for c in fast_model.classes_),
+        'categorical_columns': '\t'.join(fast_model.categorical_columns),
+        'numeric_columns': '\t'.join(fast_model.numeric_columns),
+    })
+    onnx.checker.check_model(onnx_model)
+
+    tmp_path = f'{output}.{os.getpid()}.tmp'
+    onnx.save(onnx_model, tmp_path)
+    os.replace(tmp_path, output)
+    return output
+
+
+class OnnxModel:
+    # Records can be passed straight to predict_proba, without building a DataFrame
+    accepts_records = True
+
+    def __init__(self, path=ONNX_PATH, intra_op_threads=None):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if intra_op_threads:
+            options.intra_op_num_threads = intra_op_threads
+        self.session = ort.InferenceSession(path, sess_options=options, providers=['CPUExecutionProvider'])
+
+        props = self.session.get_modelmeta().custom_metadata_map
+        self.classes_ = np.array([int(c) for c in props['classes'].split(',')])
+        self.categorical_columns = props['categorical_columns'].split('\t')
+        self.numeric_columns = props['numeric_columns'].split('\t')
+
+    # Function to build the onnxruntime feed from a DataFrame or feature dictionaries
+    # Categorical values are passed as strings, the only key type of the graph's LabelEncoder
+    def feed(self, X):
+        if isinstance(X, pd.DataFrame):
+            feed = {column: X[column].astype(str).to_numpy(dtype=object) for column in self.categorical_columns}
+            feed.update({column: X[column].to_numpy(dtype=np.float64) for column in self.numeric_columns})
+            return feed
+        feed = {column: np.array([str(record[column]) for record in X], dtype=object) for column in self.categorical_columns}
+        feed.update({column: np.array([record[column] for record in X], dtype=np.float64) for column in self.numeric_columns})
+        return feed
+
+    def predict_proba(self, X):
+        return self.session.run(['probabilities'], self.feed(X))[0]
+
+    def predict(self, X):
+        return self.classes_[np.argmax(self.predict_proba(X), axis=1)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the pickled model to ONNX")
+    parser.add_argument('--model', default=MODEL_PATH)
+    parser.add_argument('--output', default=ONNX_PATH)
+    args = parser.parse_args()
+
+    from model_store import load_model
+    print(f"Wrote {export_onnx(load_model(args.model), args.output)}")
@@ -1,12 +1,24 @@
 import numpy as np
 import pandas as pd
 import streamlit as st
-import joblib
-import json
-# input file
-model = joblib.load('model/Supermodel API Pre-Ping.pkl')
+import msgspec
 from datetime import datetime, timedelta
 from utils import numerize_ip, get_time_category
+from scoring import score
+from features import build_features
+from schema import decode_items, decode_record, merge_results, record_to_dict, split_batch
+from ip_index import fill_network_fields, fill_record_network_fields, load_ip_index
+from model_store import load_backend, load_model
+import metrics
+
+# input file, shared with the other pages through the process-wide model store
+model = load_model()
+
+
+# Function to load the IP range index once per process
+@st.cache_resource
+def get_ip_index():
+    return load_ip_index()
 
 # Title of the app
 # st.title("Text Classification Prediction")
@@ -117,19 +129,46 @@ Predict the probability for a single data entry.
     0.3579423856752602
   ```
 
+### 3. **POST /predicts/arrow**
+
+Predict the probabilities for a large batch sent as columns instead of JSON.
+
+- **URL**: `/predicts/arrow`
+- **Method**: `POST`
+- **Request Body**: 
+  - An Arrow IPC stream (`Content-Type: application/vnd.apache.arrow.stream`) or a Parquet file (`Content-Type: application/vnd.apache.parquet`, or `?format=parquet`) with one column per data field. Columns are cast to the field types, the optional fields may be left out, and `Timestamp` may also be an Arrow timestamp.
+
+- **Response**: 
+  - An Arrow IPC stream with one row per input row: a `probability_score` column, null for rejected rows, and an `error` column with the reason a row was rejected.
+
+  #### Example Request:
+  ```python
+  import pyarrow as pa, requests
+  response = requests.post(url + "/predicts/arrow?format=parquet", data=open("leads.parquet", "rb"))
+  scores = pa.ipc.open_stream(response.content).read_all().column("probability_score")
+  ```
+
+### Explanations
+
+Add `?explain=true` to either endpoint to get, for each record, an object with the `probability_score`, a `base_value` and the per-feature `contributions` to the log-odds instead of the bare score. The base value plus the contributions gives the log-odds of the score; each contribution is measured against an average training lead.
+
+### Decisions only
+
+Add `?decision=true` to either endpoint to get `1` or `0` per record, whether the score is at least 0.5, instead of the score. Identical ensemble members are evaluated once, and with several distinct members the ones that can no longer change a lead's decision are skipped. The current model is five identical pipelines, so the saving comes from evaluating them once. The decisions are always the same as thresholding the full score. It cannot be combined with `?explain=true`.
+
 ## Data Fields
 
 Each input object should contain the following fields:
 
 - **Timestamp**: String (format `YYYY-MM-DD HH:MM:SS`)
-- **AS Description**: String
+- **AS Description**: String (optional)
 - **country**: String
 - **state**: String
 - **city**: String
 - **postalcode**: Integer
-- **connection_type**: String
+- **connection_type**: String (optional)
 - **coreg_path**: String
-- **isp**: String
+- **isp**: String (optional)
 - **Male/Female**: Integer (0 for Male, 1 for Female)
 - **source**: String
 - **subid**: String
@@ -142,12 +181,14 @@ Each input object should contain the following fields:
 
 - The `Timestamp` field is used to extract the hour and derive the `Time Category`.
 - The `IP Address` is numerized to create `IP Address Numerized`.
+- When `AS Description`, `isp` or `connection_type` is left out or null, it is looked up from the `IP Address` in a local IP-range index built from the training data. IPs outside every known range get `unknown`.
 - Additional fields like `State + City`, `Source + Sub Id`, `Hour`, and `Time Category` are derived from the provided fields.
 
 ## Error Handling
 
 - Ensure that all required fields are provided in the correct format.
 - The response will include error messages if any required fields are missing or incorrectly formatted.
+- For `/predicts`, each record is validated on its own: a bad record gets an entry like `{"index": 1, "error": "..."}` in its position, and the other records are still scored. A body that is not a JSON array returns a 400 error.
 """)
 
 st.write("## API Demonstration")
@@ -193,100 +234,61 @@ json_input_1_sample = """[
 
 # Input box for user to enter JSON
 json_input_1 = st.text_area("Enter an array of json objects for multiple data entries (/predicts):", height=400, value=json_input_1_sample)
+explain_1 = st.checkbox("Include explanations (?explain=true)", key="explain_predicts")
 
 # Predict and display the result when button is clicked
 if st.button("Predict", key="predicts"):
     if json_input_1:
         try:
-            # Parse the JSON input
-            data_list = json.loads(json_input_1)
-
-            # Initialize a list to store input data for all records
-            all_input_data = []
-
-            # Process each record in the data list
-            for data in data_list:
-                # Parse input data
-                timestamp = data['Timestamp']
-                as_description = data['AS Description']
-                country = data['country']
-                state = data['state']
-                city = data['city']
-                postalcode = data['postalcode']
-                connection_type = data['connection_type']
-                coreg_path = data['coreg_path']
-                isp = data['isp']
-                male_female = data['Male/Female']
-                source = data['source']
-                subid = data['subid']
-                age = data['Age']
-                latitude = data['Latitude (generated)']
-                longitude = data['Longitude (generated)']
-                ip_address = data['IP Address']
-
-                # Compute derived fields
-                state_city = f"{state} - {city}"
-                source_subid = f"{source} - {subid}"
-                hour = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').hour
-                time_category = get_time_category(hour)
-                ip_address_numerized = numerize_ip(ip_address)
-
-                # Create a dictionary with the input data
-                input_data = {
-                    "AS Description": as_description,
-                    "country": country,
-                    "state": state,
-                    "city": city,
-                    "postalcode": postalcode,
-                    "connection_type": connection_type,
-                    "coreg_path": coreg_path,
-                    "isp": isp,
-                    "Male/Female": male_female,
-                    "source": source,
-                    "subid": subid,
-                    "Age": age,
-                    "Latitude (generated)": latitude,
-                    "Longitude (generated)": longitude,
-                    "State + City": state_city,
-                    "Source + Sub Id": source_subid,
-                    "Hour": hour,
-                    "Time Category": time_category,
-                    "IP Address Numerized": ip_address_numerized
-                }
-
-                # Append the input data to the list
-                all_input_data.append(input_data)
-
-            
-            # Convert the JSON data to a DataFrame
-            df = pd.DataFrame(all_input_data)
-            
-            # Make prediction
-            predictions = model.predict(df)
-            predict_proba = model.predict_proba(df)
-            
-            # Simplify the predict_proba output and get the probability score of class 1
-            simplified_proba = [proba[pred] for pred, proba in zip(predictions, predict_proba)]
-            probability_score_of_1 = [proba[1] for proba in predict_proba]
-            
-            # Transform probability score to 0 or 1 based on the threshold 0.5
-            transformed_proba = [1 if score >= 0.5 else 0 for score in probability_score_of_1]
+            # Decode and validate every record; bad ones become error entries
+            with metrics.timer('decode'):
+                items = split_batch(json_input_1.encode())
+                raw, index, errors = decode_items(items)
+            size = len(items)
+            if errors:
+                metrics.increment('scoring_invalid_records_total', len(errors))
+
+            # Build the feature columns for the valid records at once
+            scores = {'probability_score_of_1': np.array([])}
+            if len(raw):
+                raw = fill_network_fields(raw, get_ip_index())
+                df = build_features(raw)
+
+                # Make prediction with a single pass through the ensemble
+                scores = score(model, df)
+
+            results = scores['probability_score_of_1'].tolist()
+            if explain_1 and len(raw):
+                # Per-feature log-odds contributions for the whole batch in one pass
+                explainer = load_backend('numpy')
+                contributions, base_value = explainer.explain(df)
+                results = [
+                    {'probability_score': probability_score, 'base_value': base_value,
+                     'contributions': dict(zip(explainer.feature_names, row))}
+                    for probability_score, row in zip(results, contributions.tolist())
+                ]
 
             # Prepare the response
             response = {
-                # 'predictions': predictions.tolist(),
-                # 'simplified_proba': simplified_proba,
-                # 'probability_score_of_1': probability_score_of_1,
-                # 'transformed_proba': transformed_proba,
-                'probability_score': predict_proba[:, 1].tolist(),
+                # 'predictions': scores['predictions'].tolist(),
+                # 'simplified_proba': scores['simplified_proba'].tolist(),
+                # 'probability_score_of_1': scores['probability_score_of_1'].tolist(),
+                # 'transformed_proba': scores['transformed_proba'].tolist(),
+                'probability_score': merge_results(size, index, results, errors),
             }
             
             # Display results
             # st.json(response)
-            st.json(predict_proba[:, 1].tolist())
-        except json.JSONDecodeError:
+            st.json(response['probability_score'])
+        except msgspec.ValidationError as e:
+            # A subclass of DecodeError: the JSON is fine but a record does not match the schema
+            metrics.count_error(type(e).__name__)
+            st.write(f"An error occurred: {e}")
+        except msgspec.DecodeError:
+            metrics.count_error('invalid_json')
             st.write("Invalid JSON input. Please enter valid JSON.")
         except Exception as e:
+            metrics.count_error(type(e).__name__)
             st.write(f"An error occurred: {e}")
     else:
         st.write("Please enter some JSON input.")
@@ -318,33 +320,40 @@ json_input_2 = st.text_area("Enter JSON input for a single data entry object (/p
 if st.button("Predict", key="predict"):
     if json_input_2:
         try:
-            # Parse the JSON input
-            data = json.loads(json_input_2)
-
-             # Parse input data
-            timestamp = data['Timestamp']
-            as_description = data['AS Description']
-            country = data['country']
-            state = data['state']
-            city = data['city']
-            postalcode = data['postalcode']
-            connection_type = data['connection_type']
-            coreg_path = data['coreg_path']
-            isp = data['isp']
-            male_female = data['Male/Female']
-            source = data['source']
-            subid = data['subid']
-            age = data['Age']
-            latitude = data['Latitude (generated)']
-            longitude = data['Longitude (generated)']
-            ip_address = data['IP Address']
+            # Parse and validate the JSON input against the same schema as the API
+            with metrics.timer('decode'):
+                data = record_to_dict(decode_record(json_input_2.encode()))
+
+            # Look up the optional network fields that were left out from the IP address
+            data = fill_record_network_fields(data, get_ip_index())
+
+            # Parse input data
+            with metrics.timer('field_extraction'):
+                timestamp = data['Timestamp']
+                as_description = data['AS Description']
+                country = data['country']
+                state = data['state']
+                city = data['city']
+                postalcode = data['postalcode']
+                connection_type = data['connection_type']
+                coreg_path = data['coreg_path']
+                isp = data['isp']
+                male_female = data['Male/Female']
+                source = data['source']
+                subid = data['subid']
+                age = data['Age']
+                latitude = data['Latitude (generated)']
+                longitude = data['Longitude (generated)']
+                ip_address = data['IP Address']
 
             # Compute derived fields
             state_city = f"{state} - {city}"
             source_subid = f"{source} - {subid}"
-            hour = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').hour
+            with metrics.timer('strptime'):
+                hour = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').hour
             time_category = get_time_category(hour)
-            ip_address_numerized = numerize_ip(ip_address)
+            with metrics.timer('numerize_ip'):
+                ip_address_numerized = numerize_ip(ip_address)
 
             # Create a dictionary with the input data
             input_data = {
@@ -370,33 +379,36 @@ if st.button("Predict", key="predict"):
             }
             
             # Convert the JSON data to a DataFrame
-            df = pd.DataFrame([input_data])
-            
-            # Make prediction
-            predictions = model.predict(df)
-            predict_proba = model.predict_proba(df)
+            with metrics.timer('dataframe'):
+                df = pd.DataFrame([input_data])
             
-            # Simplify the predict_proba output and get the probability score of class 1
-            simplified_proba = [proba[pred] for pred, proba in zip(predictions, predict_proba)]
-            probability_score_of_1 = [proba[1] for proba in predict_proba]
-            
-            # Transform probability score to 0 or 1 based on the threshold 0.5
-            transformed_proba = [1 if score >= 0.5 else 0 for score in probability_score_of_1]
+            # Make prediction with a single pass through the ensemble
+            scores = score(model, df)
 
             # Prepare the response
             response = {
-                # 'predictions': predictions.tolist(),
-                # 'simplified_proba': simplified_proba,
-                # 'probability_score_of_1': probability_score_of_1,
-                # 'transformed_proba': transformed_proba,
-                'probability_score': predict_proba[:, 1].tolist(),
+                # 'predictions': scores['predictions'].tolist(),
+                # 'simplified_proba': scores['simplified_proba'].tolist(),
+                # 'probability_score_of_1': scores['probability_score_of_1'].tolist(),
+                # 'transformed_proba': scores['transformed_proba'].tolist(),
+                'probability_score': scores['probability_score_of_1'].tolist(),
             }
             
             # Display results
-            st.write(predict_proba[:, 1].tolist()[0])
-        except json.JSONDecodeError:
+            st.write(response['probability_score'][0])
+        except msgspec.ValidationError as e:
+            # A subclass of DecodeError: the JSON is fine but a record does not match the schema
+            metrics.count_error(type(e).__name__)
+            st.write(f"An error occurred: {e}")
+        except msgspec.DecodeError:
+            metrics.count_error('invalid_json')
             st.write("Invalid JSON input. Please enter valid JSON.")
         except Exception as e:
+            metrics.count_error(type(e).__name__)
             st.write(f"An error occurred: {e}")
     else:
-        st.write("Please enter some JSON input.")
\ No newline at end of file
+        st.write("Please enter some JSON input.")
+
+# Per-stage timings, batch sizes and error counts collected in this process
+with st.expander("Scoring metrics"):
+    st.code(metrics.render(), language="text")
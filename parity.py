@@ -0,0 +1,162 @@
+import argparse
+import ipaddress
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from encoding import load_encoder
+from fast_model import FastModel
+from features import RAW_FIELDS, build_features
+from model_store import load_model
+from onnx_model import OnnxModel, export_onnx
+from scoring import decide, score
+from utils import FEATURE_COLUMNS, build_input_data
+
+# Parity checks between the optimized scoring paths and the original page code
+#
+#   python parity.py --rows 5000
+#
+# Each check prints its result and the script exits non-zero on a mismatch.
+
+MODEL_PATH = 'model/Supermodel API Pre-Ping.pkl'
+DATA_PATH = 'data/Processed Linkout ML Propensity Data V8.xlsx'
+
+
+# Function to load the feature rows of the V8 dataset
+def load_rows(rows=None):
+    df = pd.read_excel(DATA_PATH)[FEATURE_COLUMNS]
+    if rows is not None:
+        df = df.head(rows)
+    return df
+
+
+# Function reproducing the original two-call scoring from the pages
+def legacy_score(model, df):
+    predictions = model.predict(df)
+    predict_proba = model.predict_proba(df)
+    simplified_proba = [proba[pred] for pred, proba in zip(predictions, predict_proba)]
+    probability_score_of_1 = [proba[1] for proba in predict_proba]
+    transformed_proba = [1 if score >= 0.5 else 0 for score in probability_score_of_1]
+    return {
+        'predictions': predictions.tolist(),
+        'simplified_proba': simplified_proba,
+        'probability_score_of_1': probability_score_of_1,
+        'transformed_proba': transformed_proba,
+    }
+
+
+# Function to check score() against the original two-call scoring
+def check_scoring(model, df):
+    expected = legacy_score(model, df)
+    actual = score(model, df)
+    for key, values in expected.items():
+        if not np.array_equal(np.asarray(values), actual[key]):
+            return False, f"{key} differs"
+    return True, f"{len(df)} rows identical"
+
+
+# Function to rebuild raw API records from the engineered V8 rows
+def to_raw_records(df):
+    raw = df.copy()
+    raw['Timestamp'] = [f"2024-05-01 {hour:02d}:00:00" for hour in df['Hour']]
+    raw['IP Address'] = [str(ipaddress.ip_address(int(ip))) for ip in df['IP Address Numerized']]
+    return raw[RAW_FIELDS]
+
+
+# Function to check build_features() against the per-record build_input_data()
+def check_features(model, df):
+    raw = to_raw_records(df)
+    expected = pd.DataFrame([build_input_data(record) for record in raw.to_dict('records')])
+    actual = build_features(raw)
+    try:
+        pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected, check_dtype=False)
+    except AssertionError as e:
+        return False, str(e).splitlines()[0]
+    return True, f"{len(df)} rows identical"
+
+
+# Function to check integer-coded features score like the strings, including unseen values
+def check_encoding(model, df, tolerance=1e-9):
+    raw = to_raw_records(df)
+    unseen = np.arange(0, len(raw), 7)
+    raw.loc[unseen, 'city'] = 'UNSEEN CITY'
+    raw.loc[unseen[::2], 'subid'] = 'unseen-subid'
+
+    expected = model.predict_proba(build_features(raw))
+    encoded = build_features(raw, load_encoder())
+    if not np.array_equal(model.predict_proba(encoded), expected):
+        return False, "sklearn scores differ"
+    max_error = np.abs(FastModel(model).predict_proba(encoded) - expected).max()
+    return max_error <= tolerance, f"max abs error {max_error:.3g} over {len(df)} rows, {len(unseen)} with unseen values"
+
+
+# Function to check the contributions add up to the log-odds of model.predict_proba
+def check_explain(model, df, tolerance=1e-9):
+    fast_model = FastModel(model)
+    contributions, base_value = fast_model.explain(df)
+    p1 = model.predict_proba(df)[:, 1]
+    if len(fast_model.vote_weights) > 1:
+        return True, f"skipped, {len(fast_model.vote_weights)} distinct members make the contributions approximate"
+    max_error = np.abs(base_value + contributions.sum(axis=1) - np.log(p1 / (1 - p1))).max()
+    return max_error <= tolerance, f"max abs log-odds error {max_error:.3g} over {len(df)} rows"
+
+
+# Function to check the NumPy soft vote against model.predict_proba
+def check_fast_path(model, df, tolerance=1e-9):
+    expected = model.predict_proba(df)
+    fast_model = FastModel(model)
+    max_error = np.abs(fast_model.predict_proba(df) - expected).max()
+    records = df.head(1000).to_dict('records')
+    max_error = max(max_error, np.abs(fast_model.predict_proba(records) - expected[:len(records)]).max())
+    max_error = max(max_error, max(abs(fast_model.predict_proba_one(record) - expected[i, 1]) for i, record in enumerate(records)))
+    return max_error <= tolerance, f"max abs error {max_error:.3g} over {len(df)} rows"
+
+
+# Function to check the onnxruntime backend against model.predict_proba
+def check_onnx(model, df, tolerance=1e-9):
+    expected = model.predict_proba(df)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        onnx_model = OnnxModel(export_onnx(model, os.path.join(tmp_dir, 'model.onnx')))
+        max_error = np.abs(onnx_model.predict_proba(df) - expected).max()
+    return max_error <= tolerance, f"max abs error {max_error:.3g} over {len(df)} rows"
+
+
+# Function to check the early-exit decisions against the thresholded scores, for both backends
+def check_decision(model, df):
+    mismatches, exit_rates = 0, []
+    for candidate in [model, FastModel(model)]:
+        for threshold in [0.1, 0.5, 0.9]:
+            decisions, exit_rate = decide(candidate, df, threshold)
+            mismatches += int((decisions != score(model, df, threshold)['transformed_proba']).sum())
+            exit_rates.append(exit_rate)
+    return mismatches == 0, f"{mismatches} mismatched decisions over {len(df)} rows, early-exit rate {min(exit_rates):.0%}-{max(exit_rates):.0%}"
+
+
+CHECKS = {
+    'scoring': check_scoring,
+    'features': check_features,
+    'fast_path': check_fast_path,
+    'encoding': check_encoding,
+    'explain': check_explain,
+    'onnx': check_onnx,
+    'decision': check_decision,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check optimized scoring paths against the joblib model")
+    parser.add_argument('--rows', type=int, default=None, help="Only check the first N rows")
+    parser.add_argument('--check', choices=sorted(CHECKS), action='append', help="Run only these checks")
+    args = parser.parse_args()
+
+    model = load_model(MODEL_PATH)
+    df = load_rows(args.rows)
+
+    failed = False
+    for name in args.check or CHECKS:
+        ok, message = CHECKS[name](model, df)
+        print(f"{name}: {'OK' if ok else 'FAIL'} ({message})")
+        failed = failed or not ok
+    raise SystemExit(1 if failed else 0)
@@ -0,0 +1,335 @@
+import argparse
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from model_store import MODEL_PATH, backend_path, evict_model, load_backend, load_model, model_signature
+
+# Versioned model registry with background loading and hot swap
+#
+#   python registry.py publish "model/Supermodel API Pre-Ping.pkl" 2024-06-01
+#   python registry.py activate 2024-06-01
+#   python registry.py shadow 2024-06-02
+#   python registry.py list
+#
+# Every version lives in REGISTRY_DIR/<version>/model.pkl (with model.onnx next
+# to it for the onnx backend). The CURRENT and SHADOW files name the active and
+# the shadow version. Without a CURRENT file the service keeps scoring
+# model_store.MODEL_PATH.
+#
+# ModelManager polls those files in a background thread. A new version is
+# loaded, warmed up and smoke tested off the request path, then swapped in with
+# a single reference assignment: requests in flight finish on the model they
+# started with and the old version is evicted from the model store. A shadow
+# version scores a sampled fraction of traffic on a separate thread and its
+# differences from the active model are recorded in the metrics.
+
+REGISTRY_DIR = os.environ.get('MODEL_REGISTRY', 'model/registry')
+REGISTRY_POLL_SECONDS = float(os.environ.get('REGISTRY_POLL_SECONDS', '5'))
+# Smoke test limits for a new version
+SMOKE_ROUNDS = int(os.environ.get('SMOKE_ROUNDS', '20'))
+SMOKE_MAX_P99_MS = float(os.environ.get('SMOKE_MAX_P99_MS', '1000'))
+SMOKE_TOLERANCE = 1e-9
+# Fraction of scored requests that are also scored by the shadow version
+SHADOW_SAMPLE_RATE = float(os.environ.get('SHADOW_SAMPLE_RATE', '0.05'))
+SHADOW_MAX_PENDING = 8
+
+SCORE_DIFF_BUCKETS = (1e-9, 1e-6, 1e-4, 0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+# Function to get the pickle of a registry version
+def version_path(version, registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, version, 'model.pkl')
+
+
+# Function to list the versions in the registry, oldest name first
+def list_versions(registry_dir=REGISTRY_DIR):
+    if not os.path.isdir(registry_dir):
+        return []
+    return sorted(name for name in os.listdir(registry_dir) if os.path.isfile(version_path(name, registry_dir)))
+
+
+# Function to read the version named by a pointer file (CURRENT or SHADOW)
+def read_pointer(name, registry_dir=REGISTRY_DIR):
+    try:
+        with open(os.path.join(registry_dir, name)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# Function to point CURRENT or SHADOW at a version atomically, None removes the pointer
+def write_pointer(name, version, registry_dir=REGISTRY_DIR):
+    path = os.path.join(registry_dir, name)
+    if version is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if version not in list_versions(registry_dir):
+        raise ValueError(f"Unknown model version: {version}")
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(version + '\n')
+    os.replace(tmp_path, path)
+
+
+# Function to copy a model (and its ONNX export, if any) into the registry as a new version
+def publish(source, version, registry_dir=REGISTRY_DIR):
+    target = os.path.join(registry_dir, version)
+    if os.path.exists(target):
+        raise ValueError(f"Model version already exists: {version}")
+    # Copy into a temporary directory first, so pollers never see half a version
+    tmp_dir = os.path.join(registry_dir, f'.{version}.{os.getpid()}.tmp')
+    os.makedirs(tmp_dir)
+    shutil.copy2(source, os.path.join(tmp_dir, 'model.pkl'))
+    onnx_source = backend_path('onnx', source)
+    if os.path.exists(onnx_source):
+        shutil.copy2(onnx_source, os.path.join(tmp_dir, 'model.onnx'))
+    os.replace(tmp_dir, target)
+    return target
+
+
+# Function to check a loaded model gives sane, fast and backend-consistent scores
+def smoke_test(model, model_input, path, backend, rounds=SMOKE_ROUNDS, max_p99_ms=SMOKE_MAX_P99_MS):
+    latencies = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        proba = model.predict_proba(model_input)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    proba = np.asarray(proba)
+    if proba.ndim != 2 or proba.shape[1] != 2 or not np.all(np.isfinite(proba)):
+        raise ValueError(f"Smoke test: predict_proba returned shape {proba.shape} or non-finite values")
+    if np.any(proba < 0) or np.any(proba > 1) or not np.allclose(proba.sum(axis=1), 1.0):
+        raise ValueError("Smoke test: probabilities outside [0, 1] or not summing to 1")
+    p99 = float(np.percentile(latencies, 99))
+    if p99 > max_p99_ms:
+        raise ValueError(f"Smoke test: p99 latency {p99:.1f} ms over {max_p99_ms:.0f} ms")
+
+    # The faster backends must agree with the pickled model they were built from
+    if backend != 'sklearn' and os.path.exists(path):
+        reference = load_model(path)
+        reference_input = pd.DataFrame(model_input) if getattr(model, 'accepts_records', False) else model_input
+        max_error = float(np.abs(reference.predict_proba(reference_input) - proba).max())
+        if max_error > SMOKE_TOLERANCE:
+            raise ValueError(f"Smoke test: {backend} differs from the pickle by {max_error:.3g}")
+        if backend == 'onnx':
+            evict_model(path)
+    return {'p99_ms': p99, 'rounds': rounds}
+
+
+class ModelManager:
+    def __init__(self, backend, make_input, fallback_path=MODEL_PATH, registry_dir=REGISTRY_DIR,
+                 poll_seconds=REGISTRY_POLL_SECONDS, shadow_sample_rate=SHADOW_SAMPLE_RATE, prepare=None):
+        self.backend = backend
+        # Function building the warm-up and smoke test input of a model
+        self.make_input = make_input
+        # Function adding per-model state to a loaded slot before it is swapped in, e.g. a score baseline
+        self.prepare = prepare
+        self.fallback_path = fallback_path
+        self.registry_dir = registry_dir
+        self.poll_seconds = poll_seconds
+        self.shadow_sample_rate = shadow_sample_rate
+
+        # Each slot is a dict of version, path, signature and model, replaced as a whole on swap
+        self.active = None
+        self.shadow = None
+        # failed holds, per slot, the signature of the last version that failed to load there
+        self.status = {'loading': None, 'last_error': None, 'swaps': 0, 'failed': {'active': None, 'shadow': None}}
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._shadow_executor = None
+        # One permit per shadow batch queued or running, taken by request threads and returned by the shadow thread
+        self._shadow_slots = threading.BoundedSemaphore(SHADOW_MAX_PENDING)
+        self._check_lock = threading.Lock()
+
+    # Function to find the pickle and the file signature for a version, None meaning the fallback model
+    def resolve(self, version):
+        path = version_path(version, self.registry_dir) if version is not None else self.fallback_path
+        return path, model_signature(backend_path(self.backend, path))
+
+    # Function to load, warm up and smoke test a version without touching the active one
+    def load(self, version):
+        path, signature = self.resolve(version)
+        self.status['loading'] = version or path
+        try:
+            start = time.perf_counter()
+            model = load_backend(self.backend, path)
+            model_input = self.make_input(model)
+            smoke = smoke_test(model, model_input, path, self.backend)
+            metrics.observe('model_load_seconds', time.perf_counter() - start)
+            slot = {'version': version, 'path': path, 'signature': signature, 'model': model,
+                    'smoke': smoke, 'loaded_at': time.time()}
+            if self.prepare is not None:
+                self.prepare(slot)
+        finally:
+            self.status['loading'] = None
+        return slot
+
+    # Function to evict a version's files from the model store unless another slot still uses them
+    def evict(self, slot):
+        if slot is None:
+            return
+        in_use = {s['path'] for s in (self.active, self.shadow) if s is not None}
+        if slot['path'] not in in_use:
+            evict_model(backend_path(self.backend, slot['path']))
+            evict_model(slot['path'])
+
+    # Function to bring the active and shadow slots in line with the registry pointers
+    def check(self):
+        with self._check_lock:
+            self.check_slot('active', read_pointer('CURRENT', self.registry_dir))
+            self.check_slot('shadow', read_pointer('SHADOW', self.registry_dir))
+
+    def check_slot(self, name, version):
+        current = getattr(self, name)
+        if name == 'shadow' and version is None:
+            if current is not None:
+                self.shadow = None
+                self.evict(current)
+            return
+        try:
+            path, signature = self.resolve(version)
+        except OSError as e:
+            self.status['last_error'] = f"{name} {version}: {e}"
+            return
+        if current is not None and current['signature'] == signature:
+            return
+        # Do not retry a version that already failed until its file changes
+        if self.status['failed'][name] == signature:
+            return
+
+        try:
+            slot = self.load(version)
+        except Exception as e:
+            self.status['failed'][name] = signature
+            self.status['last_error'] = f"{name} {version or path}: {e}"
+            metrics.increment('model_swap_failures_total', slot=name)
+            return
+        # A single assignment, so every request sees either the old or the new model
+        setattr(self, name, slot)
+        self.status['failed'][name] = None
+        if name == 'active' and current is not None:
+            self.status['swaps'] += 1
+            metrics.increment('model_swaps_total')
+        self.evict(current)
+
+    # Function to load the first active model in the foreground, then watch the registry
+    def start(self):
+        self._stop.clear()
+        self._shadow_executor = ThreadPoolExecutor(1, thread_name_prefix='shadow')
+        # Batches cancelled by an earlier stop() never returned their permits
+        self._shadow_slots = threading.BoundedSemaphore(SHADOW_MAX_PENDING)
+        self.check()
+        if self.active is None:
+            raise RuntimeError(self.status['last_error'] or "No model could be loaded")
+        self._thread = threading.Thread(target=self.watch, name='model-registry', daemon=True)
+        self._thread.start()
+
+    def watch(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_seconds)
+            self._wake.clear()
+            if not self._stop.is_set():
+                self.check()
+
+    # Function to make the watcher look at the registry now instead of at the next poll
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._shadow_executor is not None:
+            self._shadow_executor.shutdown(wait=False, cancel_futures=True)
+            self._shadow_executor = None
+
+    # Function to score a sampled request with the shadow version in the background
+    def maybe_shadow(self, model_input, active_scores):
+        shadow = self.shadow
+        if shadow is None or self._shadow_executor is None or random.random() >= self.shadow_sample_rate:
+            return
+        if not self._shadow_slots.acquire(blocking=False):
+            metrics.increment('shadow_skipped_total')
+            return
+        try:
+            self._shadow_executor.submit(self.shadow_score, shadow, model_input, np.asarray(active_scores))
+        except RuntimeError:
+            # The executor was shut down meanwhile
+            self._shadow_slots.release()
+
+    def shadow_score(self, shadow, model_input, active_scores):
+        try:
+            shadow_scores = np.asarray(shadow['model'].predict_proba(model_input))[:, 1]
+            diff = np.abs(shadow_scores - active_scores)
+            hist = metrics.histogram('shadow_score_abs_diff', SCORE_DIFF_BUCKETS)
+            for value in diff.tolist():
+                hist.observe(value)
+            flips = int(np.count_nonzero((shadow_scores >= 0.5) != (active_scores >= 0.5)))
+            metrics.increment('shadow_rows_total', len(diff))
+            if flips:
+                metrics.increment('shadow_decision_flips_total', flips)
+        except Exception as e:
+            metrics.count_error(f'shadow_{type(e).__name__}')
+        finally:
+            self._shadow_slots.release()
+
+    # Function to describe the registry and the loaded versions, e.g. for an admin endpoint
+    def describe(self):
+        def slot_info(slot):
+            if slot is None:
+                return None
+            return {key: slot[key] for key in ['version', 'path', 'smoke', 'loaded_at']}
+
+        return {
+            'backend': self.backend,
+            'registry': self.registry_dir,
+            'versions': list_versions(self.registry_dir),
+            'current_pointer': read_pointer('CURRENT', self.registry_dir),
+            'shadow_pointer': read_pointer('SHADOW', self.registry_dir),
+            'active': slot_info(self.active),
+            'shadow': slot_info(self.shadow),
+            'shadow_sample_rate': self.shadow_sample_rate,
+            'loading': self.status['loading'],
+            'swaps': self.status['swaps'],
+            'last_error': self.status['last_error'],
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the versioned model registry")
+    parser.add_argument('--registry', default=REGISTRY_DIR)
+    commands = parser.add_subparsers(dest='command', required=True)
+    publish_parser = commands.add_parser('publish', help="Copy a model into the registry as a new version")
+    publish_parser.add_argument('source')
+    publish_parser.add_argument('version')
+    publish_parser.add_argument('--activate', action='store_true')
+    commands.add_parser('activate', help="Make a version the active model").add_argument('version')
+    commands.add_parser('shadow', help="Shadow-score a version, 'none' to stop").add_argument('version')
+    commands.add_parser('list', help="List the versions and pointers")
+    args = parser.parse_args()
+
+    if args.command == 'publish':
+        print(f"Published {publish(args.source, args.version, args.registry)}")
+        if args.activate:
+            write_pointer('CURRENT', args.version, args.registry)
+    elif args.command == 'activate':
+        write_pointer('CURRENT', args.version, args.registry)
+    elif args.command == 'shadow':
+        write_pointer('SHADOW', None if args.version == 'none' else args.version, args.registry)
+    else:
+        current, shadow = read_pointer('CURRENT', args.registry), read_pointer('SHADOW', args.registry)
+        for version in list_versions(args.registry):
+            marks = [name for name, pointer in [('current', current), ('shadow', shadow)] if pointer == version]
+            print(version, ' '.join(marks))
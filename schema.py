@@ -0,0 +1,254 @@
+import ipaddress
+import typing
+
+import msgspec
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from features import TIMESTAMP_FORMAT
+from utils import IPV4_PATTERN
+
+# Typed schema of a raw API record, matching the Data Fields in pages/🔥_API_Demo.py
+#
+# Requests are decoded straight from bytes by msgspec: the outer array is split
+# into raw items in one pass and every item is validated against LeadRecord on
+# its own, so a bad lead becomes an error entry instead of failing the batch.
+# Lossless conversions (e.g. "97526" for postalcode) are accepted. The network
+# fields may be left out; ip_index.py fills them in from the IP Address.
+
+
+class LeadRecord(msgspec.Struct, kw_only=True):
+    timestamp: str = msgspec.field(name="Timestamp")
+    as_description: str | None = msgspec.field(default=None, name="AS Description")
+    country: str = msgspec.field(name="country")
+    state: str = msgspec.field(name="state")
+    city: str = msgspec.field(name="city")
+    postalcode: int = msgspec.field(name="postalcode")
+    connection_type: str | None = msgspec.field(default=None, name="connection_type")
+    coreg_path: str = msgspec.field(name="coreg_path")
+    isp: str | None = msgspec.field(default=None, name="isp")
+    male_female: int = msgspec.field(name="Male/Female")
+    source: str = msgspec.field(name="source")
+    subid: str = msgspec.field(name="subid")
+    age: int = msgspec.field(name="Age")
+    latitude: float = msgspec.field(name="Latitude (generated)")
+    longitude: float = msgspec.field(name="Longitude (generated)")
+    ip_address: str = msgspec.field(name="IP Address")
+
+
+# Field names as they appear in the JSON, in declaration order
+RECORD_FIELDS = [field.encode_name for field in msgspec.structs.fields(LeadRecord)]
+
+# Fields that may be left out or null
+OPTIONAL_FIELDS = [field.encode_name for field in msgspec.structs.fields(LeadRecord) if not field.required]
+
+ARROW_TYPES = {str: pa.string(), int: pa.int64(), float: pa.float64()}
+
+
+# Function to get the Arrow type of a LeadRecord field annotation, optional fields being nullable
+def arrow_type(annotation):
+    types = [t for t in typing.get_args(annotation) if t is not type(None)] or [annotation]
+    return ARROW_TYPES[types[0]]
+
+
+# Arrow schema of a record, for columnar uploads and the audit log
+RECORD_ARROW_SCHEMA = pa.schema([
+    pa.field(field.encode_name, arrow_type(field.type)) for field in msgspec.structs.fields(LeadRecord)
+])
+
+_record_decoder = msgspec.json.Decoder(LeadRecord, strict=False)
+_batch_decoder = msgspec.json.Decoder(list[msgspec.Raw])
+
+
+# Function to decode one record, raising msgspec.ValidationError on a bad field
+def decode_record(body):
+    return _record_decoder.decode(body)
+
+
+# Function to turn a decoded record into the raw-record dict used by utils.build_input_data
+def record_to_dict(record):
+    return dict(zip(RECORD_FIELDS, msgspec.structs.astuple(record)))
+
+
+# Function to find records whose Timestamp or IP Address cannot be parsed
+def invalid_values(frame):
+    errors = {}
+    timestamps = pd.to_datetime(frame['Timestamp'], format=TIMESTAMP_FORMAT, errors='coerce')
+    for i in np.flatnonzero(timestamps.isna().to_numpy()):
+        errors[i] = f"Timestamp does not match format '{TIMESTAMP_FORMAT}': {frame['Timestamp'].iat[i]!r}"
+
+    is_ipv4 = frame['IP Address'].str.match(IPV4_PATTERN, na=False).to_numpy(dtype=bool)
+    for i in np.flatnonzero(~is_ipv4):
+        try:
+            ipaddress.ip_address(frame['IP Address'].iat[i])
+        except ValueError as e:
+            errors.setdefault(i, str(e))
+    return errors
+
+
+# Fields typed int or float, which rows read from a file may hold as text, blanks or fractions
+NUMERIC_TYPES = {field.encode_name: field.type for field in msgspec.structs.fields(LeadRecord) if field.type in (int, float)}
+
+
+# Function to convert the numeric fields of a frame read from a file, finding records where one is
+# missing, not a number or, for an int field, not a whole number; returns the converted frame and the errors
+def coerce_numbers(frame):
+    errors = {}
+    frame = frame.copy(deep=False)
+    for field, field_type in NUMERIC_TYPES.items():
+        if field not in frame.columns:
+            continue
+        values = pd.to_numeric(frame[field], errors='coerce').to_numpy(dtype=np.float64)
+        bad = ~np.isfinite(values)
+        if field_type is int:
+            bad |= values != np.round(values)
+        for i in np.flatnonzero(bad):
+            errors.setdefault(i, f"Expected `{field_type.__name__}`, got {frame[field].iat[i]!r} - at `$.{field}`")
+        # Rejected rows get a placeholder, so int fields keep an integer dtype
+        frame[field] = np.where(bad, 0, values).astype(np.int64) if field_type is int else values
+    return frame, errors
+
+
+# Function to split a /predicts body into the undecoded JSON of each record
+def split_batch(body):
+    return _batch_decoder.decode(body)
+
+
+# Function to decode split records into columns of valid records and per-record errors
+# offset is the position of items[0] in the whole body, for the index and error entries
+def decode_items(items, offset=0):
+    records, index, errors = [], [], []
+    for i, item in enumerate(items, offset):
+        try:
+            records.append(_record_decoder.decode(item))
+            index.append(i)
+        except msgspec.ValidationError as e:
+            errors.append({'index': i, 'error': str(e)})
+
+    # Transpose the records into one column per field
+    if records:
+        columns = zip(*map(msgspec.structs.astuple, records))
+        frame = pd.DataFrame(dict(zip(RECORD_FIELDS, map(list, columns))))
+    else:
+        frame = pd.DataFrame({field: [] for field in RECORD_FIELDS})
+    index = np.asarray(index, dtype=np.intp)
+
+    bad_values = invalid_values(frame) if records else {}
+    if bad_values:
+        keep = np.ones(len(frame), dtype=bool)
+        for i, message in bad_values.items():
+            keep[i] = False
+            errors.append({'index': int(index[i]), 'error': message})
+        frame = frame[keep].reset_index(drop=True)
+        index = index[keep]
+        errors.sort(key=lambda entry: entry['index'])
+
+    return frame, index, errors
+
+
+# Function to lay out scores and error entries in input order
+def merge_results(size, index, scores, errors):
+    results = [None] * size
+    for i, value in zip(index.tolist(), scores):
+        results[i] = value
+    for entry in errors:
+        results[entry['index']] = entry
+    return results
+
+
+# Function to cast a column to the type of a schema field; when the whole column will not cast, values are
+# cast one by one and those that still fail become nulls with an error message for their row
+def cast_column(column, field):
+    try:
+        return column.cast(field.type), {}
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        pass
+    values, errors = [], {}
+    for i, value in enumerate(column.to_pylist()):
+        try:
+            values.append(pa.array([value], column.type).cast(field.type)[0].as_py())
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            values.append(None)
+            errors[i] = f"Expected `{field.type}`, got {value!r} - at `$.{field.name}`"
+    return pa.array(values, field.type), errors
+
+
+# Function to read an Arrow IPC stream or Parquet body into a table with RECORD_ARROW_SCHEMA and the
+# errors of rows with a value that does not cast to the schema type, like the JSON decoder rejects them
+# Arrow timestamps are formatted like the JSON Timestamp and missing optional columns become nulls
+def read_record_table(body, body_format='arrow'):
+    buffer = pa.py_buffer(body)
+    if body_format == 'parquet':
+        table = pq.read_table(pa.BufferReader(buffer))
+    elif body_format == 'arrow':
+        table = pa.ipc.open_stream(buffer).read_all()
+    else:
+        raise ValueError(f"Unknown body format: {body_format}")
+
+    columns, errors = [], {}
+    for field in RECORD_ARROW_SCHEMA:
+        if field.name not in table.column_names:
+            if field.name not in OPTIONAL_FIELDS:
+                raise KeyError(field.name)
+            columns.append(pa.nulls(len(table), field.type))
+            continue
+        column = table.column(field.name)
+        if pa.types.is_timestamp(column.type):
+            # %S prints fractional seconds for finer units, so truncate to seconds first
+            column = pc.strftime(column.cast(pa.timestamp('s', column.type.tz), safe=False), format=TIMESTAMP_FORMAT)
+        column, cast_errors = cast_column(column, field)
+        for i, message in cast_errors.items():
+            errors.setdefault(i, message)
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=RECORD_ARROW_SCHEMA), errors
+
+
+# Function to split a record table into a frame of valid records and per-record errors, like decode_items
+# cast_errors are the rows read_record_table could not cast, by position
+def decode_table(table, cast_errors=None):
+    errors = [{'index': int(i), 'error': message} for i, message in (cast_errors or {}).items()]
+    valid = np.ones(len(table), dtype=bool)
+    valid[list(cast_errors or ())] = False
+    for name in RECORD_FIELDS:
+        column = table.column(name)
+        if name in OPTIONAL_FIELDS or column.null_count == 0:
+            continue
+        for i in np.flatnonzero(column.is_null().to_numpy(zero_copy_only=False)):
+            if valid[i]:
+                errors.append({'index': int(i), 'error': f"Expected `{column.type}`, got `null` - at `$.{name}`"})
+            valid[i] = False
+
+    # Filtering in Arrow keeps integer columns without nulls, so they convert to pandas without a copy
+    if not valid.all():
+        table = table.filter(pa.array(valid))
+    frame = table.to_pandas()
+    index = np.flatnonzero(valid)
+
+    bad_values = invalid_values(frame) if len(frame) else {}
+    if bad_values:
+        keep = np.ones(len(frame), dtype=bool)
+        for i, message in bad_values.items():
+            keep[i] = False
+            errors.append({'index': int(index[i]), 'error': message})
+        frame = frame[keep].reset_index(drop=True)
+        index = index[keep]
+    errors.sort(key=lambda entry: entry['index'])
+    return frame, index, errors
+
+
+# Function to lay out scores and error messages in input order as an Arrow table
+def merge_results_arrow(size, index, scores, errors):
+    probability_score = np.zeros(size)
+    probability_score[index] = scores
+    missing = np.ones(size, dtype=bool)
+    missing[index] = False
+    messages = [None] * size
+    for entry in errors:
+        messages[entry['index']] = entry['error']
+    return pa.table({
+        'probability_score': pa.array(probability_score, mask=missing),
+        'error': pa.array(messages, pa.string()),
+    })
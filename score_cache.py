@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict
+
+from utils import FEATURE_COLUMNS
+
+# Bounded LRU/TTL cache of probability scores for repeated pre-ping leads
+#
+# The key is the engineered feature row (the input_data dict the pages build),
+# so repeats that only differ in Timestamp within the same hour share an entry.
+# Entries belong to one model artifact and are dropped when it changes.
+
+
+# Function to normalize a feature value so equal values hash the same across NumPy and Python types
+def canonical(value):
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+# Function to build the cache key of one input_data dictionary
+def cache_key(input_data):
+    return tuple(canonical(input_data[column]) for column in FEATURE_COLUMNS)
+
+
+# Function to build the cache keys of every row of a feature DataFrame
+def frame_keys(df):
+    return [tuple(canonical(value) for value in row) for row in df[FEATURE_COLUMNS].itertuples(index=False, name=None)]
+
+
+class ScoreCache:
+    def __init__(self, max_size=100_000, ttl_seconds=3600.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._model_signature = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    # Function to drop every entry when the scores came from a different model artifact
+    def validate(self, model_signature):
+        if model_signature == self._model_signature:
+            return
+        with self._lock:
+            if model_signature != self._model_signature:
+                if self._entries:
+                    self.invalidations += 1
+                self._entries.clear()
+                self._model_signature = model_signature
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            score, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return score
+
+    # Function to look up many keys at once, returning the scores found and the positions missed
+    def get_many(self, keys):
+        scores = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            scores[i] = self.get(key)
+            if scores[i] is None:
+                missing.append(i)
+        return scores, missing
+
+    def put(self, key, score):
+        with self._lock:
+            self._entries[key] = (score, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'ttl_seconds': self.ttl_seconds,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
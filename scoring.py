@@ -0,0 +1,125 @@
+import weakref
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import VotingClassifier
+
+import metrics
+
+# Threshold used to turn the probability score into a 0/1 decision
+THRESHOLD = 0.5
+# Early decisions must clear the threshold by this much, so rounding differences
+# from the full soft vote cannot flip one
+DECISION_MARGIN = 1e-9
+
+# Identical member groups of every VotingClassifier seen by decide()
+_member_groups = weakref.WeakKeyDictionary()
+
+
+# Function to score a feature DataFrame with a single pass through the ensemble
+def score(model, df, threshold=THRESHOLD):
+    # Run the VotingClassifier once; the labels are derived from these probabilities
+    metrics.observe_batch_size(len(df))
+    with metrics.timer('model'):
+        predict_proba = model.predict_proba(df)
+
+    # Soft voting picks the class with the highest averaged probability
+    predicted_index = np.argmax(predict_proba, axis=1)
+    predictions = model.classes_[predicted_index]
+
+    # Probability of the predicted class and probability of class 1
+    simplified_proba = predict_proba[np.arange(len(predict_proba)), predicted_index]
+    probability_score_of_1 = predict_proba[:, 1]
+
+    # Transform probability score to 0 or 1 based on the threshold
+    transformed_proba = (probability_score_of_1 >= threshold).astype(int)
+
+    return {
+        'predictions': predictions,
+        'simplified_proba': simplified_proba,
+        'probability_score_of_1': probability_score_of_1,
+        'transformed_proba': transformed_proba,
+    }
+
+
+# Function to group the members of a soft VotingClassifier whose fitted state is identical, as
+# [vote weight, estimator, count]; identical members always vote the same, so one evaluation counts for all
+def member_groups(model):
+    groups = _member_groups.get(model)
+    if groups is None:
+        weights = model.weights if model.weights is not None else [1.0] * len(model.estimators_)
+        total = sum(w for w in weights if w is not None)
+        by_hash = {}
+        for w, estimator in zip(weights, model.estimators_):
+            if w is not None:
+                group = by_hash.setdefault(joblib.hash(estimator), [0.0, estimator, 0])
+                group[0] += w / total
+                group[2] += 1
+        groups = _member_groups[model] = list(by_hash.values())
+    return groups
+
+
+# Function to get the soft-vote members of a model as (vote weight, function scoring a subset of rows, members
+# it stands for); None when the model is not a soft vote that can be taken apart (e.g. the ONNX backend)
+def vote_members(model, X):
+    if hasattr(model, 'vote_members'):
+        return model.vote_members(X)
+    if not isinstance(model, VotingClassifier) or model.voting != 'soft':
+        return None
+    return [
+        (w, lambda rows, estimator=estimator: estimator.predict_proba(X.iloc[rows])[:, 1], count)
+        for w, estimator, count in member_groups(model)
+    ]
+
+
+# Function to take a subset of rows of a DataFrame or a list of feature dictionaries
+def take_rows(X, rows):
+    if isinstance(X, pd.DataFrame):
+        return X.iloc[rows]
+    return [X[i] for i in rows]
+
+
+# Function to get only the 0/1 decisions, which match score()['transformed_proba']
+# Identical members are merged into one group first. Groups are evaluated heaviest
+# first, each only on the rows still undecided: the groups not yet evaluated can
+# add anywhere between 0 and their vote weight, so a row is settled once its
+# partial vote is above the threshold, or stays below it even if every remaining
+# group votes 1. Returns the decisions and the share of group evaluations skipped
+# by that early exit. With a single group (every member identical) nothing can
+# exit early and all of the saving comes from the merge, which is counted apart
+# in decision_member_evaluations_deduplicated_total.
+def decide(model, X, threshold=THRESHOLD):
+    n = len(X)
+    members = vote_members(model, X)
+    if members is None:
+        return score(model, X, threshold)['transformed_proba'], 0.0
+
+    metrics.observe_batch_size(n)
+    decisions = np.zeros(n, dtype=int)
+    rows = np.arange(n)
+    vote = np.zeros(n)
+    remaining = 1.0
+    evaluated = 0
+    with metrics.timer('model'):
+        for weight, member_proba, count in sorted(members, key=lambda member: -member[0]):
+            if len(rows) == 0:
+                break
+            remaining -= weight
+            vote[rows] += weight * member_proba(rows)
+            evaluated += len(rows)
+            settled_one = vote[rows] >= threshold + DECISION_MARGIN
+            settled_zero = vote[rows] + remaining < threshold - DECISION_MARGIN
+            decisions[rows[settled_one]] = 1
+            rows = rows[~(settled_one | settled_zero)]
+        # Rows within DECISION_MARGIN of the threshold get the full soft vote
+        if len(rows):
+            decisions[rows] = model.predict_proba(take_rows(X, rows))[:, 1] >= threshold
+
+    member_total = n * sum(count for _, _, count in members)
+    group_total = n * len(members)
+    if member_total:
+        metrics.increment('decision_member_evaluations_total', member_total)
+        metrics.increment('decision_member_evaluations_deduplicated_total', member_total - group_total)
+        metrics.increment('decision_group_evaluations_early_exit_total', group_total - evaluated)
+    return decisions, (1.0 - evaluated / group_total if group_total else 0.0)
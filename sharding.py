@@ -0,0 +1,118 @@
+import functools
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from encoding import load_encoder
+from features import build_features
+from ip_index import fill_network_fields, load_ip_index
+from model_store import load_backend
+from schema import decode_items
+from scoring import score
+
+# Parallel scoring of very large /predicts payloads
+#
+# A batch with more than SHARD_SIZE records is split into shards of that size.
+# Each shard is decoded, feature engineered and scored on its own and the
+# results are put back in input order by the caller.
+#
+# SHARD_MODE=thread runs the shards on a thread pool: NumPy and pandas release
+# the GIL for much of the work, and nothing is copied. SHARD_MODE=process runs
+# them on a pool of spawned worker processes. The API process runs the registry
+# watcher, the audit writer, the shadow scorer and BLAS threads, and a forked
+# child could inherit a lock one of them was holding, so the workers start from
+# a fresh interpreter instead. Each loads the model (memory-mapped, so the pages
+# are shared through the page cache), the category encoder and the IP index
+# once. The raw record JSON goes to the workers and the scores come back, with
+# the shard's frames when the caller keeps a drift monitor or an audit log. A
+# new pool is started when the model changes.
+
+SHARD_MODE = os.environ.get('SHARD_MODE', 'thread')
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '5000'))
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', str(os.cpu_count() or 1)))
+
+
+# Function to decode, enrich and score one shard, without the score cache; returns the input positions
+# of the valid records, their scores, the error entries and, with with_frames, the raw and feature frames
+def score_items(items, offset, model, encoder=None, ip_index=None, with_frames=False):
+    raw, index, errors = decode_items(items, offset)
+    if len(raw) == 0:
+        return index, [], errors, None
+    if ip_index is not None:
+        raw = fill_network_fields(raw, ip_index)
+    df = build_features(raw, encoder)
+    scores = score(model, df)['probability_score_of_1'].tolist()
+    return index, scores, errors, (raw, df) if with_frames else None
+
+
+# Model, category encoder and IP index of a worker process, loaded once by init_worker
+_worker = {}
+
+
+def init_worker(backend, model_path, encode_categories, enrich_from_ip):
+    _worker['model'] = load_backend(backend, model_path)
+    _worker['encoder'] = load_encoder() if encode_categories else None
+    _worker['ip_index'] = load_ip_index() if enrich_from_ip else None
+
+
+# Function run in a worker process
+def run_shard(items, offset, with_frames):
+    return score_items(items, offset, _worker['model'], _worker['encoder'], _worker['ip_index'], with_frames)
+
+
+class ShardedScorer:
+    def __init__(self, mode=SHARD_MODE, shard_size=SHARD_SIZE, workers=SHARD_WORKERS, backend='sklearn'):
+        if mode not in ('thread', 'process'):
+            raise ValueError(f"Unknown shard mode: {mode}")
+        self.mode = mode
+        self.shard_size = shard_size
+        self.workers = workers
+        # Backend the worker processes load the model with
+        self.backend = backend
+        self._executor = None
+        self._context = None
+        self._lock = threading.Lock()
+
+    # Function to decide whether a batch is large enough to shard
+    def enabled(self, size):
+        return self.workers > 1 and size > self.shard_size
+
+    # Function to get the pool, starting new workers when the model slot or the encoder or IP index changed
+    def executor(self, slot, encoder, ip_index):
+        context = (slot['signature'], encoder is not None, ip_index is not None) if self.mode == 'process' else None
+        with self._lock:
+            if self._executor is not None and self._context == context:
+                return self._executor
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+            if self.mode == 'thread':
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='shard')
+            else:
+                self._executor = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=init_worker,
+                    initargs=(self.backend, slot['path'], encoder is not None, ip_index is not None))
+            self._context = context
+            return self._executor
+
+    # Function to score every shard in parallel with the model of a registry slot
+    def map(self, items, slot, encoder=None, ip_index=None, with_frames=False):
+        offsets = range(0, len(items), self.shard_size)
+        shards = [items[offset:offset + self.shard_size] for offset in offsets]
+        metrics.observe('shard_count', len(shards), metrics.BATCH_SIZE_BUCKETS)
+        executor = self.executor(slot, encoder, ip_index)
+        if self.mode == 'thread':
+            function = functools.partial(score_items, model=slot['model'], encoder=encoder, ip_index=ip_index,
+                                         with_frames=with_frames)
+        else:
+            function = functools.partial(run_shard, with_frames=with_frames)
+        with metrics.timer('sharded_scoring'):
+            return list(executor.map(function, shards, offsets))
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self._context = None
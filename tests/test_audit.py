@@ -0,0 +1,99 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import api
+from audit import AuditSink, audit_files, read_audit, replay
+from features import build_features
+from model_store import MODEL_PATH, load_model
+from scoring import score
+from sharding import ShardedScorer
+from test_scoring import RECORDS
+
+# Audit log round trip and the sharded /predicts path feeding it
+
+
+class RecordingMonitor:
+    # Stands in for the drift monitor and counts the rows it is given
+    def __init__(self):
+        self.rows = 0
+        self.score_model = None
+
+    def set_score_baseline(self, score_table, score_model=None):
+        self.score_model = score_model
+
+    def update(self, df, scores, raw=None):
+        assert len(df) == len(scores) == len(raw)
+        self.rows += len(df)
+
+
+# Function to read every row the sink wrote to its directory
+def audited_rows(directory):
+    frames = [batch.to_pandas() for _, batch in read_audit(audit_files(directory))]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+@pytest.fixture(scope='module')
+def service():
+    api.manager.start()
+    yield api
+    api.manager.stop()
+
+
+def test_audit_round_trip_replays_the_logged_scores(tmp_path):
+    model = load_model(MODEL_PATH)
+    raw = pd.DataFrame(RECORDS)
+    df = build_features(raw)
+    scores = score(model, df)['probability_score_of_1']
+
+    sink = AuditSink(str(tmp_path))
+    sink.record_frame(raw, df, 'v1', scores)
+    sink.flush()
+    sink.close_file()
+
+    rows = audited_rows(str(tmp_path))
+    assert rows['model_version'].tolist() == ['v1'] * len(RECORDS)
+    np.testing.assert_array_equal(rows['probability_score'], scores)
+    for from_features in [False, True]:
+        summary = replay(audit_files(str(tmp_path)), model, from_features=from_features)
+        assert summary['v1']['rows'] == len(RECORDS)
+        assert summary['v1']['max_abs_diff'] < 1e-9
+        assert summary['v1']['decision_flips'] == 0
+
+
+def test_audit_buffer_overwrites_the_oldest_rows(tmp_path):
+    raw = pd.DataFrame(RECORDS)
+    df = build_features(raw)
+    sink = AuditSink(str(tmp_path), capacity=len(RECORDS))
+    sink.record_frame(raw, df, 'old', np.zeros(len(raw)))
+    sink.record_frame(raw, df, 'new', np.ones(len(raw)))
+    sink.flush()
+    sink.close_file()
+    assert audited_rows(str(tmp_path))['model_version'].unique().tolist() == ['new']
+
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_sharded_batches_reach_the_audit_log_and_drift_monitor(service, monkeypatch, tmp_path, mode):
+    sink = AuditSink(str(tmp_path))
+    monitor = RecordingMonitor()
+    sharder = ShardedScorer(mode, shard_size=2, workers=2)
+    monkeypatch.setattr(api, 'auditor', sink)
+    monkeypatch.setattr(api, 'sharder', sharder)
+    monkeypatch.setattr(api, 'score_cache', None)
+    monkeypatch.setitem(api.state, 'drift', monitor)
+
+    body = json.dumps(RECORDS + [dict(RECORDS[0], Timestamp='yesterday')]).encode()
+    try:
+        results = api.score_batch(body)
+    finally:
+        sharder.shutdown()
+    sink.flush()
+    sink.close_file()
+
+    assert 'error' in results[-1]
+    rows = audited_rows(str(tmp_path))
+    assert len(rows) == len(RECORDS)
+    assert sorted(rows['probability_score']) == sorted(results[:-1])
+    assert monitor.rows == len(RECORDS)
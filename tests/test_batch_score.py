@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+import batch_score
+from test_scoring import RECORDS
+
+# Chunked readers and --resume of the batch scorer
+
+
+# Function to write the inline leads, repeated so they span several chunks, in the given format
+def write_input(path, rows):
+    if path.suffix == '.csv':
+        rows.to_csv(path, index=False)
+    elif path.suffix == '.jsonl':
+        rows.to_json(path, orient='records', lines=True)
+    elif path.suffix == '.parquet':
+        rows.to_parquet(path, index=False, row_group_size=3)
+    else:
+        rows.to_excel(path, index=False)
+
+
+@pytest.mark.parametrize('extension', ['.csv', '.jsonl', '.parquet', '.xlsx'])
+def test_readers_skip_rows_before_chunking(tmp_path, extension):
+    rows = pd.DataFrame(RECORDS * 2)
+    path = tmp_path / f'leads{extension}'
+    write_input(path, rows)
+    for skip_rows in [0, 4, len(rows)]:
+        chunks = list(batch_score.read_chunks(str(path), 2, skip_rows))
+        read = pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame(columns=rows.columns)
+        assert all(len(chunk) <= 2 for chunk in chunks)
+        assert read['IP Address'].tolist() == rows['IP Address'][skip_rows:].tolist()
+
+
+def test_resume_skips_the_rows_already_written(tmp_path, monkeypatch):
+    input_path = tmp_path / 'leads.csv'
+    write_input(input_path, pd.DataFrame(RECORDS * 2))
+    expected = tmp_path / 'expected.csv'
+    batch_score.run(str(input_path), str(expected), chunk_size=4, log=None)
+
+    # Stop the first run after its first chunk has been written and checkpointed
+    output = tmp_path / 'scores.csv'
+    write_checkpoint = batch_score.write_checkpoint
+
+    def crash_after_first_chunk(path, checkpoint):
+        write_checkpoint(path, checkpoint)
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(batch_score, 'write_checkpoint', crash_after_first_chunk)
+    with pytest.raises(KeyboardInterrupt):
+        batch_score.run(str(input_path), str(output), chunk_size=4, log=None)
+    monkeypatch.undo()
+
+    read_chunks = batch_score.read_chunks
+    skipped = []
+
+    def recording_read_chunks(path, chunk_size, skip_rows=0):
+        skipped.append(skip_rows)
+        return read_chunks(path, chunk_size, skip_rows)
+
+    monkeypatch.setattr(batch_score, 'read_chunks', recording_read_chunks)
+    batch_score.run(str(input_path), str(output), chunk_size=4, resume=True, log=None)
+    assert skipped == [4]
+    pd.testing.assert_frame_equal(pd.read_csv(output), pd.read_csv(expected))
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from drift import SCORE_FIELD, DriftMonitor, build_drift_baseline, build_score_baseline, score_artifact_name
+from features import build_features
+from model_store import MODEL_PATH, load_model
+from test_scoring import RECORDS
+
+# Drift sketches against a baseline built from the inline leads
+
+
+# Function to build the features of the inline leads repeated n times
+def leads(n=20):
+    return build_features(pd.DataFrame(RECORDS * n))
+
+
+def test_training_traffic_shows_no_drift():
+    df = leads()
+    scores = load_model(MODEL_PATH).predict_proba(df)[:, 1]
+    monitor = DriftMonitor(build_drift_baseline(df), build_score_baseline(df))
+    monitor.update(df, scores)
+    report = monitor.report()
+    assert report['rows'] == len(df)
+    assert report['drifted'] == []
+    assert report['fields'][SCORE_FIELD]['psi'] < 1e-6
+
+
+def test_unseen_values_are_flagged():
+    df = leads()
+    monitor = DriftMonitor(build_drift_baseline(df))
+    shifted = df.assign(source='brand-new-source')
+    monitor.update(shifted, np.full(len(df), 0.5))
+    report = monitor.report()
+    assert report['fields']['source']['unseen_rate'] == 1.0
+    assert 'source' in report['drifted']
+    assert report['fields']['source']['heavy_hitters'][0]['value'] == 'brand-new-source'
+
+
+def test_score_counts_start_over_with_a_new_model_baseline(tmp_path):
+    df = leads()
+    monitor = DriftMonitor(build_drift_baseline(df), build_score_baseline(df), score_model='old')
+    monitor.update(df, np.zeros(len(df)))
+    assert SCORE_FIELD in monitor.report()['drifted']
+
+    monitor.set_score_baseline(build_score_baseline(df), 'new')
+    report = monitor.report()
+    assert monitor.score_model == 'new'
+    assert report['fields'][SCORE_FIELD]['psi'] == 0.0
+    assert SCORE_FIELD not in report['drifted']
+
+    monitor.set_score_baseline(None, 'unmonitored')
+    monitor.update(df, np.zeros(len(df)))
+    assert SCORE_FIELD not in monitor.report()['fields']
+
+
+def test_score_artifact_depends_on_the_model_file(tmp_path):
+    copy = tmp_path / 'model.pkl'
+    copy.write_bytes(open(MODEL_PATH, 'rb').read())
+    assert score_artifact_name(str(copy)) == score_artifact_name(MODEL_PATH)
+    copy.write_bytes(copy.read_bytes() + b'\0')
+    assert score_artifact_name(str(copy)) != score_artifact_name(MODEL_PATH)
@@ -0,0 +1,38 @@
+import pandas as pd
+import pyarrow as pa
+
+from ip_index import MISSING_VALUE, NETWORK_FIELDS, IpIndex, IpRanges, fill_network_fields, fill_record_network_fields
+
+# Range lookups of the IP index on a hand-built table
+
+# 1.2.3.0/24, written as half-open integer bounds
+RANGES = pa.table({
+    'start': pa.array([0x01020300], pa.int64()),
+    'end': pa.array([0x01020400], pa.int64()),
+    'AS Description': ['TEST-AS'],
+    'isp': ['Test ISP'],
+    'connection_type': ['Cable/DSL'],
+})
+
+
+def test_ipv4_hits_and_ipv6_with_the_same_integer_misses():
+    index = IpIndex([IpRanges(RANGES)])
+    raw = pd.DataFrame({'IP Address': ['1.2.3.4', '::1.2.3.4', '1.2.4.1', '2001:db8::1']})
+    filled = fill_network_fields(raw, index)
+    assert filled['isp'].tolist() == ['Test ISP', MISSING_VALUE, MISSING_VALUE, MISSING_VALUE]
+
+    assert fill_record_network_fields({'IP Address': '1.2.3.4'}, index)['AS Description'] == 'TEST-AS'
+    assert fill_record_network_fields({'IP Address': '::1.2.3.4'}, index)['AS Description'] == MISSING_VALUE
+
+
+def test_only_missing_fields_are_filled():
+    index = IpIndex([IpRanges(RANGES)])
+    raw = pd.DataFrame({'IP Address': ['1.2.3.4'], 'AS Description': ['GIVEN-AS'], 'isp': [None]})
+    filled = fill_network_fields(raw, index)
+    assert filled.loc[0, NETWORK_FIELDS].tolist() == ['GIVEN-AS', 'Test ISP', 'Cable/DSL']
+
+
+def test_earlier_layers_win():
+    override = RANGES.set_column(3, 'isp', pa.array(['Local ISP']))
+    index = IpIndex([IpRanges(override), IpRanges(RANGES)])
+    assert index.lookup_one(0x01020304, 4)['isp'] == 'Local ISP'
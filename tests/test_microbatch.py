@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+import pytest
+from starlette.requests import Request
+
+import api
+from microbatch import MicroBatcher
+from test_scoring import RECORDS
+
+# Coalescing of concurrent /predict calls and how their failures are answered
+
+
+# Function to build a POST request carrying a JSON body
+def json_request(body):
+    async def receive():
+        return {'type': 'http.request', 'body': json.dumps(body).encode(), 'more_body': False}
+    return Request({'type': 'http', 'method': 'POST', 'headers': [], 'query_string': b''}, receive)
+
+
+def test_concurrent_submits_share_one_call_and_keep_their_results():
+    calls = []
+
+    def score_many(items):
+        calls.append(list(items))
+        return [item * 10 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(score_many, max_batch_size=8, max_delay_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(5)))
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert calls == [[0, 1, 2, 3, 4]]
+
+
+def test_batches_are_capped_at_the_max_size():
+    sizes = []
+
+    def score_many(items):
+        sizes.append(len(items))
+        return items
+
+    async def main():
+        batcher = MicroBatcher(score_many, max_batch_size=3, max_delay_ms=50)
+        try:
+            return await asyncio.gather(*(batcher.submit(i) for i in range(7)))
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == list(range(7))
+    assert max(sizes) == 3 and sum(sizes) == 7
+
+
+def test_a_failing_batch_fails_its_callers_and_the_next_batch_still_runs():
+    def score_many(items):
+        if 'bad' in items:
+            raise RuntimeError('model crashed')
+        return items
+
+    async def main():
+        batcher = MicroBatcher(score_many, max_batch_size=8, max_delay_ms=1)
+        try:
+            with pytest.raises(RuntimeError):
+                await batcher.submit('bad')
+            return await batcher.submit('good')
+        finally:
+            await batcher.stop()
+
+    assert asyncio.run(main()) == 'good'
+
+
+def test_batcher_failures_are_server_errors(monkeypatch):
+    def score_many(items):
+        raise ValueError('backend failure')
+
+    async def main():
+        batcher = MicroBatcher(score_many)
+        monkeypatch.setattr(api, 'batcher', batcher)
+        try:
+            valid = await api.predict(json_request(RECORDS[0]))
+            invalid = await api.predict(json_request(dict(RECORDS[0], Timestamp='yesterday')))
+        finally:
+            await batcher.stop()
+        return valid, invalid
+
+    monkeypatch.setattr(api, 'score_cache', None)
+    valid, invalid = asyncio.run(main())
+    assert valid.status_code == 500
+    assert invalid.status_code == 400
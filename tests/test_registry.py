@@ -0,0 +1,163 @@
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+import api
+import metrics
+from model_store import MODEL_PATH
+from registry import SHADOW_MAX_PENDING, ModelManager, list_versions, publish, read_pointer, write_pointer
+
+# Model registry pointers, hot swap and rollback, and the admin endpoints that move them
+
+
+# Function to read a counter of this process
+def counter(name, **labels):
+    return metrics._counters.get((name, metrics.label_key(labels)), 0)
+
+
+# Function to build a manager on a registry holding two copies of the bundled model and a broken version
+def registry_manager(registry_dir):
+    for version in ['v1', 'v2']:
+        publish(MODEL_PATH, version, str(registry_dir))
+    broken = registry_dir / 'broken.pkl'
+    broken.write_bytes(b'not a model')
+    publish(str(broken), 'broken', str(registry_dir))
+    return ModelManager('sklearn', api.warm_up_input, registry_dir=str(registry_dir))
+
+
+# Function to build a stand-in for a request carrying the given headers
+def admin_request(headers):
+    return types.SimpleNamespace(headers=headers)
+
+
+@pytest.mark.parametrize('token, headers, allowed', [
+    (None, {}, False),
+    (None, {'X-Admin-Token': ''}, False),
+    ('secret', {}, False),
+    ('secret', {'X-Admin-Token': 'wrong'}, False),
+    ('secret', {'X-Admin-Token': 'secret'}, True),
+])
+def test_admin_calls_need_the_configured_token(monkeypatch, token, headers, allowed):
+    monkeypatch.setattr(api, 'ADMIN_TOKEN', token)
+    denied = api.admin_denied(admin_request(headers))
+    assert (denied is None) == allowed
+    if not allowed:
+        assert denied.status_code == 403
+
+
+class BlockingModel:
+    # Shadow model that holds the shadow thread until released
+    def __init__(self):
+        self.release = threading.Event()
+
+    def predict_proba(self, model_input):
+        self.release.wait(5)
+        return np.column_stack([1.0 - np.asarray(model_input), np.asarray(model_input)])
+
+
+def test_shadow_backlog_is_bounded_and_permits_come_back():
+    manager = ModelManager('sklearn', lambda model: None, shadow_sample_rate=1.0)
+    model = BlockingModel()
+    manager.shadow = {'model': model}
+    manager._shadow_executor = ThreadPoolExecutor(1)
+    skipped = counter('shadow_skipped_total')
+
+    threads = [threading.Thread(target=manager.maybe_shadow, args=([0.5], [0.5])) for _ in range(4 * SHADOW_MAX_PENDING)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter('shadow_skipped_total') - skipped == 3 * SHADOW_MAX_PENDING
+
+    model.release.set()
+    manager._shadow_executor.shutdown(wait=True)
+    # Every permit was returned, and no more than the bound
+    for _ in range(SHADOW_MAX_PENDING):
+        assert manager._shadow_slots.acquire(blocking=False)
+    assert not manager._shadow_slots.acquire(blocking=False)
+
+
+def test_duplicate_and_unknown_versions_are_rejected(tmp_path):
+    registry_manager(tmp_path)
+    assert list_versions(str(tmp_path)) == ['broken', 'v1', 'v2']
+    with pytest.raises(ValueError):
+        publish(MODEL_PATH, 'v1', str(tmp_path))
+    with pytest.raises(ValueError):
+        write_pointer('CURRENT', 'v3', str(tmp_path))
+
+
+def test_activate_and_roll_back(tmp_path):
+    manager = registry_manager(tmp_path)
+    manager.check()
+    assert manager.active['version'] is None
+    assert manager.active['path'] == MODEL_PATH
+
+    write_pointer('CURRENT', 'v1', str(tmp_path))
+    manager.check()
+    first = manager.active
+    assert first['version'] == 'v1'
+
+    write_pointer('CURRENT', 'v2', str(tmp_path))
+    manager.check()
+    assert manager.active['version'] == 'v2'
+    assert manager.status['swaps'] == 2
+
+    # Rolling back is pointing CURRENT at the earlier version again
+    write_pointer('CURRENT', 'v1', str(tmp_path))
+    manager.check()
+    assert manager.active['version'] == 'v1'
+    assert manager.active['signature'] == first['signature']
+    assert read_pointer('CURRENT', str(tmp_path)) == 'v1'
+
+
+def test_failed_version_keeps_the_active_model_and_is_not_retried(tmp_path):
+    manager = registry_manager(tmp_path)
+    write_pointer('CURRENT', 'v1', str(tmp_path))
+    manager.check()
+    failures = counter('model_swap_failures_total', slot='active')
+
+    write_pointer('CURRENT', 'broken', str(tmp_path))
+    manager.check()
+    manager.check()
+    assert manager.active['version'] == 'v1'
+    assert manager.status['failed']['active'] is not None
+    assert counter('model_swap_failures_total', slot='active') - failures == 1
+
+    write_pointer('CURRENT', 'v2', str(tmp_path))
+    manager.check()
+    assert manager.active['version'] == 'v2'
+    assert manager.status['failed']['active'] is None
+
+
+def test_failing_active_and_shadow_versions_are_each_loaded_once(tmp_path, monkeypatch):
+    manager = registry_manager(tmp_path)
+    broken = tmp_path / 'broken2.pkl'
+    broken.write_bytes(b'not a model either')
+    publish(str(broken), 'broken2', str(tmp_path))
+    manager.check()
+
+    loads = []
+    load = manager.load
+
+    def recording_load(version):
+        loads.append(version)
+        return load(version)
+
+    monkeypatch.setattr(manager, 'load', recording_load)
+    write_pointer('CURRENT', 'broken', str(tmp_path))
+    write_pointer('SHADOW', 'broken2', str(tmp_path))
+    for _ in range(3):
+        manager.check()
+    assert sorted(loads) == ['broken', 'broken2']
+    assert manager.active['path'] == MODEL_PATH
+    assert manager.shadow is None
+
+    # A shadow that loads does not clear the marker of the failed active version
+    write_pointer('SHADOW', 'v1', str(tmp_path))
+    manager.check()
+    manager.check()
+    assert sorted(loads) == ['broken', 'broken2', 'v1']
+    assert manager.shadow['version'] == 'v1'
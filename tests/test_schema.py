@@ -0,0 +1,166 @@
+import io
+import json
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import api
+import batch_score
+from schema import coerce_numbers, decode_items, invalid_values, merge_results, split_batch
+from test_scoring import RECORDS
+from utils import numerize_ips
+
+# Per-record error isolation in the /predicts decoders and the batch scorer
+
+
+def test_bad_records_become_error_entries_in_place():
+    records = [
+        RECORDS[0],
+        dict(RECORDS[1], Timestamp='yesterday'),
+        dict(RECORDS[2], **{'IP Address': '999.1.1'}),
+        {key: value for key, value in RECORDS[3].items() if key != 'Age'},
+        dict(RECORDS[4], postalcode='not a number'),
+        RECORDS[1],
+    ]
+    frame, index, errors = decode_items(split_batch(json.dumps(records).encode()))
+    assert index.tolist() == [0, 5]
+    assert frame['subid'].tolist() == [RECORDS[0]['subid'], RECORDS[1]['subid']]
+    assert [entry['index'] for entry in errors] == [1, 2, 3, 4]
+    assert 'Timestamp' in errors[0]['error']
+    assert '999.1.1' in errors[1]['error']
+    assert 'Age' in errors[2]['error']
+    assert 'postalcode' in errors[3]['error']
+
+    results = merge_results(len(records), index, [0.25, 0.75], errors)
+    assert results[0] == 0.25 and results[5] == 0.75
+    assert [results[i]['index'] for i in range(1, 5)] == [1, 2, 3, 4]
+
+
+def test_optional_network_fields_may_be_left_out():
+    record = {key: value for key, value in RECORDS[0].items() if key not in ('AS Description', 'isp', 'connection_type')}
+    frame, index, errors = decode_items(split_batch(json.dumps([record]).encode()))
+    assert errors == []
+    assert frame['isp'].tolist() == [None]
+
+
+def test_numbers_read_from_files_are_checked_per_row():
+    frame = pd.DataFrame({
+        'Age': ['61', None, 'abc', '40.5', 30],
+        'Latitude (generated)': [42.4, 35.8, 26.1, float('inf'), '30.2'],
+    })
+    converted, errors = coerce_numbers(frame)
+    assert sorted(errors) == [1, 2, 3]
+    assert converted['Age'].dtype == np.int64
+    assert converted['Age'].iloc[[0, 4]].tolist() == [61, 30]
+    assert converted['Latitude (generated)'].iloc[4] == 30.2
+    # The input frame is left as it was
+    assert frame['Age'].tolist()[0] == '61'
+
+
+def test_batch_scorer_rejects_bad_rows_and_scores_the_rest(tmp_path):
+    rows = pd.DataFrame(RECORDS)
+    rows[['Age', 'postalcode']] = rows[['Age', 'postalcode']].astype(object)
+    rows.loc[1, 'Age'] = None
+    rows.loc[2, 'postalcode'] = 'abc'
+    rows.loc[3, 'Timestamp'] = 'yesterday'
+    input_path = tmp_path / 'leads.csv'
+    rows.to_csv(input_path, index=False)
+    output_path = tmp_path / 'scores.csv'
+
+    log = tmp_path / 'log.txt'
+    with open(log, 'w') as f:
+        batch_score.run(str(input_path), str(output_path), chunk_size=2, log=f)
+
+    result = pd.read_csv(output_path)
+    assert result['row'].tolist() == list(range(len(RECORDS)))
+    assert result['error'].notna().tolist() == [False, True, True, True, False]
+    assert result['probability_score'].notna().tolist() == [True, False, False, False, True]
+    assert f"Scored 2 of {len(RECORDS)} rows" in log.read_text()
+
+
+def test_ipv4_with_a_trailing_newline_is_rejected():
+    frame = pd.DataFrame({'Timestamp': ['2024-05-01 00:00:00'] * 3, 'IP Address': ['1.2.3.4\n', '1.2.3.4', '::1']})
+    assert list(invalid_values(frame)) == [0]
+    assert numerize_ips(['1.2.3.4', '::1']).tolist() == [16909060, 1]
+
+
+@pytest.fixture(scope='module')
+def service():
+    api.manager.start()
+    yield api
+    api.manager.stop()
+
+
+# Function to write a DataFrame of records as an Arrow IPC stream or Parquet body
+def table_body(rows, body_format):
+    table = pa.Table.from_pandas(rows, preserve_index=False)
+    sink = io.BytesIO()
+    if body_format == 'parquet':
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    return sink.getvalue()
+
+
+# Function to score a table body and read the probability_score and error columns of the response
+def score_rows(rows, body_format='arrow'):
+    response = api.score_table(table_body(rows, body_format), body_format)
+    assert response.status_code == 200
+    results = pa.ipc.open_stream(response.body).read_all()
+    return results.column('probability_score').to_pylist(), results.column('error').to_pylist()
+
+
+@pytest.mark.parametrize('body_format', ['arrow', 'parquet'])
+def test_table_bodies_score_like_json(service, body_format):
+    scores, errors = score_rows(pd.DataFrame(RECORDS), body_format)
+    assert errors == [None] * len(RECORDS)
+    np.testing.assert_allclose(scores, api.score_batch(json.dumps(RECORDS).encode()))
+
+
+def test_bad_table_rows_become_per_row_errors(service):
+    rows = pd.DataFrame(RECORDS)
+    rows['Timestamp'] = rows['Timestamp'].astype(object)
+    rows.loc[1, 'Timestamp'] = 'yesterday'
+    rows['subid'] = rows['subid'].astype(object)
+    rows.loc[2, 'subid'] = None
+    scores, errors = score_rows(rows)
+    assert [error is not None for error in errors] == [False, True, True, False, False]
+    assert 'Timestamp' in errors[1] and 'subid' in errors[2]
+    assert scores[1] is None and scores[2] is None
+    np.testing.assert_allclose([scores[i] for i in (0, 3, 4)],
+                               [api.score_batch(json.dumps(RECORDS).encode())[i] for i in (0, 3, 4)])
+
+
+def test_values_that_do_not_cast_are_per_row_errors(service):
+    rows = pd.DataFrame(RECORDS)
+    rows['postalcode'] = rows['postalcode'].astype(str)
+    rows.loc[1, 'postalcode'] = 'abc'
+    rows['Age'] = rows['Age'].astype(float)
+    rows.loc[3, 'Age'] = 61.5
+    scores, errors = score_rows(rows)
+    assert [error is not None for error in errors] == [False, True, False, True, False]
+    assert 'postalcode' in errors[1] and 'Age' in errors[3]
+    assert [score is None for score in scores] == [False, True, False, True, False]
+
+
+def test_arrow_timestamps_are_accepted(service):
+    rows = pd.DataFrame(RECORDS)
+    rows['Timestamp'] = pd.to_datetime(rows['Timestamp'])
+    scores, errors = score_rows(rows)
+    assert errors == [None] * len(RECORDS)
+    np.testing.assert_allclose(scores, api.score_batch(json.dumps(RECORDS).encode()))
+
+
+def test_empty_table_gives_an_empty_result(service):
+    assert score_rows(pd.DataFrame(RECORDS).iloc[:0]) == ([], [])
+
+
+def test_unreadable_body_or_missing_column_is_rejected(service):
+    assert api.score_table(b'not arrow', 'arrow').status_code == 400
+    assert api.score_table(b'not parquet', 'parquet').status_code == 400
+    rows = pd.DataFrame(RECORDS).drop(columns=['Age'])
+    assert api.score_table(table_body(rows, 'arrow'), 'arrow').status_code == 400
@@ -0,0 +1,49 @@
+import pandas as pd
+
+import score_cache
+from features import build_features
+from score_cache import ScoreCache, cache_key, frame_keys
+from test_scoring import RECORDS
+from utils import build_input_data
+
+# Score cache keys, LRU and TTL eviction and invalidation on a model change
+
+
+def test_frame_keys_match_the_single_record_keys():
+    df = build_features(pd.DataFrame(RECORDS))
+    assert frame_keys(df) == [cache_key(build_input_data(record)) for record in RECORDS]
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ScoreCache(max_size=2)
+    cache.put('a', 0.1)
+    cache.put('b', 0.2)
+    assert cache.get('a') == 0.1
+    cache.put('c', 0.3)
+    assert cache.get('b') is None
+    assert cache.get_many(['a', 'b', 'c']) == ([0.1, None, 0.3], [1])
+    assert cache.stats()['evictions'] == 1
+
+
+def test_entries_expire_after_the_ttl(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(score_cache.time, 'monotonic', lambda: now[0])
+    cache = ScoreCache(ttl_seconds=10)
+    cache.put('a', 0.1)
+    now[0] += 5
+    assert cache.get('a') == 0.1
+    now[0] += 6
+    assert cache.get('a') is None
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['size'] == 0
+
+
+def test_a_new_model_signature_drops_every_entry():
+    cache = ScoreCache()
+    cache.validate('v1')
+    cache.put('a', 0.1)
+    cache.validate('v1')
+    assert cache.get('a') == 0.1
+    cache.validate('v2')
+    assert cache.get('a') is None
+    assert cache.stats()['invalidations'] == 1
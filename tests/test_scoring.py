@@ -0,0 +1,151 @@
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import api
+from encoding import load_encoder
+from fast_model import FastModel
+from features import build_features
+from model_store import MODEL_PATH, load_model
+from score_cache import ScoreCache
+from scoring import decide, score
+from utils import FEATURE_COLUMNS, build_input_data
+
+# Regression guard for the scoring paths against the original two-call page code,
+# on a handful of inline leads so it runs without the V8 workbook
+
+RECORDS = [
+    {"Timestamp": "2024-05-01 00:00:00", "AS Description": "ATT-INTERNET4", "country": "US", "state": "OR",
+     "city": "GRANTS PASS", "postalcode": 97526, "connection_type": "Cable/DSL", "coreg_path": "15",
+     "isp": "AT&T Wireless", "Male/Female": 0, "source": "whatifmedia-linkout", "subid": "1006", "Age": 61,
+     "Latitude (generated)": 42.4394, "Longitude (generated)": -123.3272, "IP Address": "107.116.110.60"},
+    {"Timestamp": "2024-05-18 00:00:00", "AS Description": "CELLCO-PART", "country": "US", "state": "NC",
+     "city": "LEXINGTON", "postalcode": 27292, "connection_type": "Cellular", "coreg_path": "5",
+     "isp": "Verizon Wireless", "Male/Female": 0, "source": "whatifmedia-linkout", "subid": "1799", "Age": 53,
+     "Latitude (generated)": 35.824, "Longitude (generated)": -80.2534, "IP Address": "174.210.72.204"},
+    {"Timestamp": "2024-05-13 00:00:00", "AS Description": "ATT-INTERNET4", "country": "US", "state": "FL",
+     "city": "FORT LAUDERDALE", "postalcode": 33325, "connection_type": "Cable/DSL", "coreg_path": "3",
+     "isp": "AT&T Internet", "Male/Female": 0, "source": "whatifmedia-linkout", "subid": "2027", "Age": 62,
+     "Latitude (generated)": 26.1223, "Longitude (generated)": -80.1434, "IP Address": "99.73.70.54"},
+    # Values the model never saw, an afternoon hour and an IPv6 address
+    {"Timestamp": "2024-06-02 14:35:10", "AS Description": "NEW-AS", "country": "US", "state": "TX",
+     "city": "NOWHERE", "postalcode": 73301, "connection_type": "Satellite", "coreg_path": "999",
+     "isp": "New ISP", "Male/Female": 1, "source": "new-source", "subid": "abc", "Age": 25,
+     "Latitude (generated)": 30.2672, "Longitude (generated)": -97.7431, "IP Address": "2001:db8::1"},
+    {"Timestamp": "2024-05-20 21:00:00", "AS Description": "T-MOBILE-AS21928", "country": "US", "state": "NY",
+     "city": "BROOKLYN", "postalcode": 11201, "connection_type": "Cellular", "coreg_path": "368",
+     "isp": "T-Mobile USA", "Male/Female": 1, "source": "Tibrio", "subid": "1006", "Age": 34,
+     "Latitude (generated)": 40.6943, "Longitude (generated)": -73.9903, "IP Address": "172.58.1.10"},
+]
+
+
+@pytest.fixture(scope='module')
+def model():
+    return load_model(MODEL_PATH)
+
+
+@pytest.fixture(scope='module')
+def service():
+    api.manager.start()
+    yield api
+    api.manager.stop()
+
+
+@pytest.fixture(scope='module')
+def df():
+    return pd.DataFrame([build_input_data(record) for record in RECORDS])
+
+
+# Function reproducing the original predict + predict_proba scoring from the pages
+def legacy_score(model, df):
+    predictions = model.predict(df)
+    predict_proba = model.predict_proba(df)
+    probability_score_of_1 = [proba[1] for proba in predict_proba]
+    return {
+        'predictions': predictions.tolist(),
+        'simplified_proba': [proba[pred] for pred, proba in zip(predictions, predict_proba)],
+        'probability_score_of_1': probability_score_of_1,
+        'transformed_proba': [1 if p >= 0.5 else 0 for p in probability_score_of_1],
+    }
+
+
+def test_score_matches_legacy(model, df):
+    expected = legacy_score(model, df)
+    result = score(model, df)
+    for key, values in expected.items():
+        assert np.asarray(result[key]).tolist() == values, key
+
+
+def test_fast_model_matches_predict_proba(model, df):
+    fast_model = FastModel(model)
+    expected = model.predict_proba(df)
+    np.testing.assert_allclose(fast_model.predict_proba(df), expected, rtol=0, atol=1e-9)
+    records = df.to_dict('records')
+    np.testing.assert_allclose(fast_model.predict_proba(records), expected, rtol=0, atol=1e-9)
+    np.testing.assert_allclose([fast_model.predict_proba_one(r) for r in records], expected[:, 1], rtol=0, atol=1e-9)
+
+
+# Unseen categories must reach the unknown slot without pandas deprecation warnings
+@pytest.mark.filterwarnings('error::DeprecationWarning')
+def test_fast_model_scores_encoded_categories(model):
+    raw = pd.DataFrame(RECORDS)
+    plain = build_features(raw)
+    encoded = build_features(raw, load_encoder())
+    fast_model = FastModel(model)
+    expected = model.predict_proba(plain)
+    np.testing.assert_allclose(fast_model.predict_proba(plain), expected, rtol=0, atol=1e-9)
+    np.testing.assert_allclose(fast_model.predict_proba(encoded), expected, rtol=0, atol=1e-9)
+
+
+def test_onnx_matches_predict_proba(model, df, tmp_path):
+    pytest.importorskip('onnxruntime')
+    from onnx_model import OnnxModel, export_onnx
+
+    onnx_model = OnnxModel(export_onnx(model, str(tmp_path / 'model.onnx')))
+    np.testing.assert_allclose(onnx_model.predict_proba(df), model.predict_proba(df), rtol=0, atol=1e-9)
+
+
+@pytest.mark.parametrize('threshold', [0.1, 0.5, 0.9])
+def test_decide_matches_score(model, df, threshold):
+    expected = score(model, df, threshold)['transformed_proba'].tolist()
+    for candidate in [model, FastModel(model)]:
+        decisions, early_exit_rate = decide(candidate, df, threshold)
+        assert decisions.tolist() == expected
+        # The pickled members are identical, so they form one group and nothing can exit early
+        assert early_exit_rate == 0.0
+
+
+# Function to get the explain=true results of a /predicts body of the given records
+def explain_batch(records):
+    return json.loads(api.score_batch(json.dumps(records).encode(), explain=True).body)
+
+
+def test_explanations_add_up_to_the_log_odds(service, monkeypatch):
+    monkeypatch.setattr(api, 'explanation_cache', ScoreCache())
+    results = explain_batch(RECORDS)
+    for result in results:
+        assert list(result['contributions']) == FEATURE_COLUMNS
+        log_odds = result['base_value'] + sum(result['contributions'].values())
+        # Compared through the sigmoid, as some leads score 1.0 where the logit is infinite
+        assert 1 / (1 + np.exp(-log_odds)) == pytest.approx(result['probability_score'], abs=1e-12)
+
+
+def test_repeated_explanations_come_from_the_cache(service, monkeypatch):
+    cache = ScoreCache()
+    monkeypatch.setattr(api, 'explanation_cache', cache)
+    first = explain_batch(RECORDS)
+    assert cache.stats()['hits'] == 0
+    assert explain_batch(RECORDS) == first
+    assert cache.stats()['hits'] == len(RECORDS)
+
+
+def test_single_and_batch_explanations_have_the_same_shape(service):
+    batch = explain_batch(RECORDS)
+    for record, expected in zip(RECORDS, batch):
+        single = api.score_one(json.dumps(record).encode(), explain=True)
+        assert single.keys() == expected.keys()
+        assert list(single['contributions']) == list(expected['contributions'])
+        assert single['probability_score'] == pytest.approx(expected['probability_score'], abs=1e-9)
+        assert single['base_value'] == pytest.approx(expected['base_value'])
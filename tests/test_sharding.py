@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import api
+from sharding import ShardedScorer
+from test_scoring import RECORDS
+
+# Sharded /predicts scoring must give the same results, in input order, as scoring in one piece
+
+
+@pytest.fixture(scope='module')
+def service():
+    api.manager.start()
+    yield api
+    api.manager.stop()
+
+
+# Function to build a /predicts body with bad records spread over several shards
+def batch_body():
+    records = []
+    for i, record in enumerate(RECORDS * 3):
+        records.append(dict(record, Timestamp='yesterday') if i % 4 == 3 else record)
+    return json.dumps(records).encode()
+
+
+@pytest.mark.parametrize('mode', ['thread', 'process'])
+def test_sharded_results_match_unsharded_in_input_order(service, monkeypatch, mode):
+    monkeypatch.setattr(api, 'score_cache', None)
+    monkeypatch.setattr(api, 'sharder', None)
+    expected = api.score_batch(batch_body())
+
+    sharder = ShardedScorer(mode, shard_size=2, workers=3)
+    monkeypatch.setattr(api, 'sharder', sharder)
+    try:
+        results = api.score_batch(batch_body())
+    finally:
+        sharder.shutdown()
+    assert len(results) == len(expected)
+    for got, want in zip(results, expected):
+        if isinstance(want, dict):
+            assert got == want
+        else:
+            assert got == pytest.approx(want, abs=1e-12)
+
+
+def test_small_batches_and_single_workers_are_not_sharded():
+    assert not ShardedScorer('thread', shard_size=10, workers=4).enabled(10)
+    assert ShardedScorer('thread', shard_size=10, workers=4).enabled(11)
+    assert not ShardedScorer('thread', shard_size=10, workers=1).enabled(1000)
+
+
+def test_process_pool_is_spawned_and_restarted_for_a_new_model(service):
+    sharder = ShardedScorer('process', shard_size=2, workers=2)
+    slot = api.manager.active
+    try:
+        executor = sharder.executor(slot, None, None)
+        assert executor._mp_context.get_start_method() == 'spawn'
+        assert sharder.executor(slot, None, None) is executor
+        assert sharder.executor(dict(slot, signature=('other', 0, 0)), None, None) is not executor
+    finally:
+        sharder.shutdown()
@@ -1,4 +1,8 @@
 import ipaddress
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
 
 # Function to numerize IP address
 def numerize_ip(ip_address):
@@ -13,4 +17,95 @@ def get_time_category(hour):
     elif 12 <= hour < 18:
         return "12 - 18"
     else:
-        return "18 - 24"
\ No newline at end of file
+        return "18 - 24"
+
+# Dotted-quad IPv4 with the same octet rules as the ipaddress module; \Z, unlike $, rejects a trailing newline
+IPV4_PATTERN = r'^(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.(25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\Z'
+
+# Bin edges and labels for the vectorized Time Category, negative hours fall in "18 - 24" like get_time_category
+TIME_CATEGORY_BINS = [0, 6, 12, 18]
+TIME_CATEGORY_LABELS = np.array(["18 - 24", "0 - 6", "6 - 12", "12 - 18", "18 - 24"], dtype=object)
+
+# Function to numerize a whole column of IP addresses
+def numerize_ips(ip_addresses):
+    ip_addresses = pd.Series(ip_addresses, dtype=object).astype(str)
+    octets = ip_addresses.str.extract(IPV4_PATTERN)
+    is_ipv4 = octets[0].notna().to_numpy()
+
+    numerized = np.zeros(len(ip_addresses), dtype=np.int64)
+    if is_ipv4.any():
+        o = octets[is_ipv4].to_numpy(dtype=np.int64)
+        numerized[is_ipv4] = (o[:, 0] << 24) | (o[:, 1] << 16) | (o[:, 2] << 8) | o[:, 3]
+    if is_ipv4.all():
+        return numerized
+
+    # IPv6 and malformed addresses go through the ipaddress module, which raises on bad input
+    others = [numerize_ip(ip) for ip in ip_addresses[~is_ipv4]]
+    if all(value <= np.iinfo(np.int64).max for value in others):
+        numerized[~is_ipv4] = others
+        return numerized
+    numerized = numerized.astype(object)
+    numerized[~is_ipv4] = others
+    return numerized
+
+# Function to determine Time Category for a whole column of hours
+def get_time_categories(hours):
+    return TIME_CATEGORY_LABELS[np.digitize(np.asarray(hours), TIME_CATEGORY_BINS)]
+
+# Columns expected by the model, in training order
+FEATURE_COLUMNS = [
+    "AS Description",
+    "country",
+    "state",
+    "city",
+    "postalcode",
+    "connection_type",
+    "coreg_path",
+    "isp",
+    "Male/Female",
+    "source",
+    "subid",
+    "Age",
+    "Latitude (generated)",
+    "Longitude (generated)",
+    "State + City",
+    "Source + Sub Id",
+    "Hour",
+    "Time Category",
+    "IP Address Numerized",
+]
+
+# Function to build the model input dictionary from a raw API record
+def build_input_data(data):
+    # Parse input data
+    timestamp = data['Timestamp']
+    state = data['state']
+    city = data['city']
+    source = data['source']
+    subid = data['subid']
+    ip_address = data['IP Address']
+
+    # Compute derived fields
+    hour = datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S').hour
+
+    return {
+        "AS Description": data['AS Description'],
+        "country": data['country'],
+        "state": state,
+        "city": city,
+        "postalcode": data['postalcode'],
+        "connection_type": data['connection_type'],
+        "coreg_path": data['coreg_path'],
+        "isp": data['isp'],
+        "Male/Female": data['Male/Female'],
+        "source": source,
+        "subid": subid,
+        "Age": data['Age'],
+        "Latitude (generated)": data['Latitude (generated)'],
+        "Longitude (generated)": data['Longitude (generated)'],
+        "State + City": f"{state} - {city}",
+        "Source + Sub Id": f"{source} - {subid}",
+        "Hour": hour,
+        "Time Category": get_time_category(hour),
+        "IP Address Numerized": numerize_ip(ip_address)
+    }
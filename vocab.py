@@ -0,0 +1,57 @@
+import pyarrow as pa
+
+from artifacts import load_artifact, metadata_int, with_metadata
+
+ARTIFACT_NAME = 'vocabularies'
+
+# Categorical fields offered in the prediction form
+VOCAB_FIELDS = [
+    'AS Description',
+    'country',
+    'state',
+    'city',
+    'isp',
+    'source',
+    'subid',
+    'connection_type',
+    'coreg_path',
+]
+
+
+# Function to build the vocabulary artifact from the training DataFrame
+def build_vocabularies(df):
+    fields, values, counts = [], [], []
+    for field in VOCAB_FIELDS:
+        # value_counts(sort=False) keeps the order of unique(), which the form relies on for defaults
+        value_counts = df[field].value_counts(sort=False, dropna=False)
+        fields.extend([field] * len(value_counts))
+        values.extend(str(value) for value in value_counts.index)
+        counts.extend(int(count) for count in value_counts.to_numpy())
+
+    table = pa.table({
+        'field': pa.array(fields, pa.string()).dictionary_encode(),
+        'value': pa.array(values, pa.string()),
+        'count': pa.array(counts, pa.int64()),
+    })
+    return with_metadata(table, rows=len(df))
+
+
+# Function to load the vocabulary artifact
+def load_vocabulary_table(df=None):
+    return load_artifact(ARTIFACT_NAME, build_vocabularies, df=df)
+
+
+# Function to load the category vocabularies as lists, keyed by field
+def load_vocabularies():
+    table = load_vocabulary_table()
+    fields = table.column('field').to_pylist()
+    values = table.column('value').to_pylist()
+    vocabularies = {field: [] for field in VOCAB_FIELDS}
+    for field, value in zip(fields, values):
+        vocabularies[field].append(value)
+    return vocabularies
+
+
+# Function to get the number of training rows behind the vocabularies
+def load_row_count():
+    return metadata_int(load_vocabulary_table(), 'rows')